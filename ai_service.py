@@ -3,112 +3,313 @@ import aiohttp
 import logging
 import json
 import asyncio
+import os
 import time
+from collections import OrderedDict
 from typing import List, Dict, Callable, Optional
 
-# Cấu hình API VLLM
-VLLM_API_URL = "http://localhost:8000/v1/completions"
-VLLM_STREAM_API_URL = "http://localhost:8000/v1/completions"
+from sse_parser import SSEDecoder, iter_completion_deltas
+from vllm_router import BackendPool, VLLM_BACKENDS, VLLM_MAX_ATTEMPTS
+
+# Cấu hình API VLLM (danh sách replica được cấu hình qua VLLM_BACKENDS trong vllm_router.py)
 VLLM_MODEL = "Qwen/Qwen2.5-3B-Instruct-AWQ"  # Thêm tên mô hình mặc định
+VLLM_MAX_TOKENS = int(os.getenv("VLLM_MAX_TOKENS", "1024"))  # Số token tối đa cho mỗi câu trả lời
+
+# Cấu hình connection pool dùng chung cho các request đến VLLM
+VLLM_POOL_LIMIT = int(os.getenv("VLLM_POOL_LIMIT", "100"))  # Tổng số kết nối tối đa
+VLLM_POOL_LIMIT_PER_HOST = int(os.getenv("VLLM_POOL_LIMIT_PER_HOST", "0"))  # 0 = không giới hạn theo host
+VLLM_KEEPALIVE_TIMEOUT = float(os.getenv("VLLM_KEEPALIVE_TIMEOUT", "30"))  # Giữ kết nối rảnh (giây)
+VLLM_DNS_CACHE_TTL = int(os.getenv("VLLM_DNS_CACHE_TTL", "300"))  # Cache DNS (giây)
+
+# Dấu hiệu của các phản hồi lỗi/bị cắt ngắn (không được lưu vào cache câu trả lời)
+ERROR_RESPONSE_MARKERS = (
+    "Xin lỗi, tôi đang gặp vấn đề",
+    "[Quá thời gian chờ",
+    "[Lỗi kết nối",
+    "(Phản hồi bị cắt ngắn"
+)
+
+# Các role được render vào prompt ChatML và phần mở đầu lượt trả lời của assistant
+CHATML_ROLES = ("system", "user", "assistant")
+CHATML_ASSISTANT_START = "<|im_start|>assistant\n"
+
+# Số hội thoại tối đa được theo dõi để tính tỉ lệ tái sử dụng prefix
+PREFIX_TRACKER_MAX_KEYS = int(os.getenv("PREFIX_TRACKER_MAX_KEYS", "10000"))
 
 logger = logging.getLogger(__name__)
 
+class PrefixReuseTracker:
+    """
+    Đo tỉ lệ prompt có thể tái sử dụng từ prefix cache của VLLM: với mỗi hội thoại,
+    so sánh prompt mới với prompt trước đó đã gửi tới cùng replica
+    """
+
+    def __init__(self, max_keys: int = PREFIX_TRACKER_MAX_KEYS):
+        self.max_keys = max_keys
+        self._last_prompts: "OrderedDict[str, tuple]" = OrderedDict()
+        self.total_prompt_chars = 0
+        self.reused_prefix_chars = 0
+        self.requests = 0
+
+    def record(self, key: str, backend_url: str, prompt: str) -> int:
+        """
+        Ghi nhận prompt vừa gửi, trả về số ký tự prefix trùng với prompt trước của hội thoại
+        """
+        reused = 0
+        previous = self._last_prompts.pop(key, None)
+        if previous is not None and previous[0] == backend_url:
+            reused = len(os.path.commonprefix([previous[1], prompt]))
+        self._last_prompts[key] = (backend_url, prompt)
+        if len(self._last_prompts) > self.max_keys:
+            self._last_prompts.popitem(last=False)
+
+        self.requests += 1
+        self.total_prompt_chars += len(prompt)
+        self.reused_prefix_chars += reused
+        return reused
+
+    def forget(self, key: str):
+        self._last_prompts.pop(key, None)
+
+    def snapshot(self) -> Dict:
+        ratio = self.reused_prefix_chars / self.total_prompt_chars if self.total_prompt_chars else 0.0
+        return {
+            "requests": self.requests,
+            "total_prompt_chars": self.total_prompt_chars,
+            "reused_prefix_chars": self.reused_prefix_chars,
+            "prefix_reuse_ratio": round(ratio, 4)
+        }
+
+class AbortStats:
+    """
+    Thống kê các lượt sinh bị hủy giữa chừng (người dùng dừng hoặc ngắt kết nối),
+    dùng để ước lượng năng lực backend được giải phóng
+    """
+
+    def __init__(self):
+        self.aborted_requests = 0
+        self.generated_tokens = 0
+        self.freed_tokens = 0
+
+    def record(self, generated_deltas: int, max_tokens: int = VLLM_MAX_TOKENS):
+        # VLLM stream mỗi event xấp xỉ một token
+        self.aborted_requests += 1
+        self.generated_tokens += generated_deltas
+        self.freed_tokens += max(0, max_tokens - generated_deltas)
+
+    def snapshot(self) -> Dict:
+        return {
+            "aborted_requests": self.aborted_requests,
+            "tokens_generated_before_abort": self.generated_tokens,
+            "freed_tokens_estimate": self.freed_tokens
+        }
+
 class AIService:
+    # Session aiohttp dùng chung cho toàn bộ process, được quản lý bởi lifespan trong main.py
+    _session: Optional[aiohttp.ClientSession] = None
+    # Tập replica VLLM dùng để định tuyến request
+    _pool: Optional[BackendPool] = None
+    # Thống kê tái sử dụng prefix theo hội thoại
+    prefix_stats = PrefixReuseTracker()
+    # Thống kê các lượt sinh bị hủy
+    abort_stats = AbortStats()
+
+    @classmethod
+    async def configure_backends(cls, urls: List[str]) -> BackendPool:
+        """
+        Thay thế tập replica VLLM (ví dụ để trỏ tới các server giả lập khi test)
+        """
+        if cls._pool is not None:
+            await cls._pool.stop_health_checks()
+        cls._pool = BackendPool(urls)
+        if cls._session is not None and not cls._session.closed:
+            cls._pool.start_health_checks(cls._session)
+        return cls._pool
+
+    @classmethod
+    def get_pool(cls) -> BackendPool:
+        if cls._pool is None:
+            cls._pool = BackendPool(VLLM_BACKENDS)
+        return cls._pool
+
+    @classmethod
+    async def start(cls) -> aiohttp.ClientSession:
+        """
+        Khởi tạo session dùng chung với connection pool keep-alive và health check các replica
+        """
+        if cls._session is None or cls._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=VLLM_POOL_LIMIT,
+                limit_per_host=VLLM_POOL_LIMIT_PER_HOST,
+                keepalive_timeout=VLLM_KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=VLLM_DNS_CACHE_TTL,
+                use_dns_cache=True
+            )
+            cls._session = aiohttp.ClientSession(
+                connector=connector,
+                headers={"Content-Type": "application/json"}
+            )
+            logger.info(
+                f"VLLM HTTP pool started (limit={VLLM_POOL_LIMIT}, "
+                f"limit_per_host={VLLM_POOL_LIMIT_PER_HOST}, keepalive={VLLM_KEEPALIVE_TIMEOUT}s)"
+            )
+            cls.get_pool().start_health_checks(cls._session)
+        return cls._session
+
+    @classmethod
+    async def close(cls):
+        """
+        Đóng session dùng chung khi ứng dụng tắt
+        """
+        if cls._pool is not None:
+            await cls._pool.stop_health_checks()
+        if cls._session is not None and not cls._session.closed:
+            await cls._session.close()
+            logger.info("VLLM HTTP pool closed")
+        cls._session = None
+
+    @classmethod
+    async def get_session(cls) -> aiohttp.ClientSession:
+        """
+        Lấy session dùng chung, tự khởi tạo nếu chưa có (ví dụ khi chạy ngoài lifespan)
+        """
+        if cls._session is None or cls._session.closed:
+            return await cls.start()
+        return cls._session
+
     @staticmethod
     async def generate_response_stream(
         messages: List[Dict[str, str]], 
-        callback: Callable[[str], None]
+        callback: Callable[[str], None],
+        affinity_key: Optional[str] = None,
+        prompt: Optional[str] = None
     ) -> str:
         """
-        Gửi request đến VLLM API và stream phản hồi
+        Gửi request đến VLLM API và stream phản hồi.
+        Nếu replica lỗi trước khi trả về token đầu tiên, request được thử lại trên replica khác.
+        affinity_key (thường là client_id) giữ hội thoại trên cùng một replica để tận dụng prefix cache.
+        prompt: prompt ChatML đã render sẵn (ví dụ từ ConversationPrompt), khi đó messages được bỏ qua.
         """
         try:
-            # Format prompt từ messages
-            prompt = AIService.format_prompt(messages)
+            # Format prompt từ messages nếu chưa có prompt render sẵn
+            if prompt is None:
+                prompt = AIService.format_prompt(messages)
             
             # Chuẩn bị request cho VLLM
             request_data = {
                 "model": VLLM_MODEL,  # Thêm trường model vào request
                 "prompt": prompt,
-                "max_tokens": 1024,  # Tăng max_tokens lên để có câu trả lời dài hơn
+                "max_tokens": VLLM_MAX_TOKENS,
                 "temperature": 0.3,
                 "stream": True,
                 "stop": ["<|im_end|>"]
             }
             
-            full_response = ""
-            last_chunk_time = time.time()
+            # Gom các delta vào list và chỉ nối chuỗi một lần ở cuối
+            response_parts: List[str] = []
             stream_timeout = 30  # 30 giây timeout cho stream
             
-            # Gửi request đến VLLM API với stream=True
-            async with aiohttp.ClientSession() as session:
+            session = await AIService.get_session()
+            pool = AIService.get_pool()
+            tried = set()
+            completed = False
+            
+            for attempt in range(VLLM_MAX_ATTEMPTS):
+                backend = pool.acquire(exclude=tried, affinity_key=affinity_key)
+                if backend is None:
+                    break
+                tried.add(backend)
+                if affinity_key is not None:
+                    AIService.prefix_stats.record(affinity_key, backend.base_url, prompt)
+                
+                decoder = SSEDecoder()
+                last_chunk_time = time.time()
+                response = None
+                
+                # Gửi request đến replica đã chọn với stream=True qua session dùng chung
                 try:
                     async with session.post(
-                        VLLM_STREAM_API_URL,
+                        backend.completions_url,
                         json=request_data,
                         headers={"Content-Type": "application/json"},
                         timeout=aiohttp.ClientTimeout(total=60)  # 60 giây timeout tổng
                     ) as response:
                         if response.status != 200:
                             error_text = await response.text()
-                            logger.error(f"VLLM API error: {response.status} - {error_text}")
+                            logger.error(f"VLLM API error ({backend.base_url}): {response.status} - {error_text}")
+                            # Lỗi phía server hoặc quá tải: thử replica khác
+                            if response.status >= 500 or response.status == 429:
+                                pool.record_failure(backend)
+                                continue
                             logger.error(f"Request data: {json.dumps(request_data)}")
                             error_msg = "Xin lỗi, tôi đang gặp vấn đề kỹ thuật. Vui lòng thử lại sau."
                             callback(error_msg)
                             return error_msg
                         
-                        # Xử lý stream response
-                        async for line in response.content:
-                            # Cập nhật thời gian nhận chunk cuối cùng
-                            last_chunk_time = time.time()
-                            
-                            if line:
-                                try:
-                                    line_text = line.decode('utf-8').strip()
-                                    
-                                    # Bỏ qua các dòng trống
-                                    if not line_text or line_text == "data: [DONE]":
-                                        continue
-                                        
-                                    # Loại bỏ prefix "data: " nếu có
-                                    if line_text.startswith("data: "):
-                                        line_text = line_text[6:]
-                                    
-                                    # Parse JSON
-                                    chunk = json.loads(line_text)
-                                    if "choices" in chunk and len(chunk["choices"]) > 0:
-                                        delta = chunk["choices"][0].get("text", "")
-                                        
-                                        # Chỉ xử lý nếu delta không phải là phần của prompt
-                                        if full_response or not prompt.endswith(delta):
-                                            full_response += delta
-                                            # Gửi từng delta ngay lập tức
-                                            callback(delta)
-                                            # Thêm small delay để đảm bảo UI có thời gian cập nhật
-                                            await asyncio.sleep(0.01)
-                                except json.JSONDecodeError as e:
-                                    logger.error(f"JSON decode error: {str(e)}, line: {line_text}")
-                                    continue
-                                except Exception as e:
-                                    logger.error(f"Error parsing stream chunk: {str(e)}")
-                                    continue
-                            
-                            # Kiểm tra timeout
-                            if time.time() - last_chunk_time > stream_timeout:
+                        # Xử lý stream response theo từng khối byte nhận được
+                        async for data in response.content.iter_any():
+                            # Kiểm tra timeout giữa hai khối liên tiếp
+                            now = time.time()
+                            if now - last_chunk_time > stream_timeout:
                                 logger.warning("Stream timeout reached")
                                 # Gửi thông báo timeout
                                 callback("\n\n[Quá thời gian chờ. Phản hồi bị cắt ngắn.]")
                                 break
-                
+                            last_chunk_time = now
+                            
+                            for delta in iter_completion_deltas(decoder.feed(data)):
+                                # Chỉ xử lý nếu delta không phải là phần của prompt
+                                if response_parts or not prompt.endswith(delta):
+                                    response_parts.append(delta)
+                                    # Chuyển delta cho callback (phía gọi tự gom frame)
+                                    callback(delta)
+                            
+                            # Nhường event loop, không thêm độ trễ nhân tạo
+                            await asyncio.sleep(0)
+                        else:
+                            for delta in iter_completion_deltas(decoder.flush()):
+                                if response_parts or not prompt.endswith(delta):
+                                    response_parts.append(delta)
+                                    callback(delta)
+                    
+                    pool.record_success(backend)
+                    completed = True
+                    break
+                    
                 except asyncio.TimeoutError:
-                    logger.error("Request timeout")
+                    logger.error(f"Request timeout ({backend.base_url})")
+                    pool.record_failure(backend)
+                    if not response_parts:
+                        continue
                     callback("\n\n[Quá thời gian chờ phản hồi từ máy chủ.]")
-                    return full_response + "\n\n[Quá thời gian chờ phản hồi từ máy chủ.]"
-                
+                    return "".join(response_parts) + "\n\n[Quá thời gian chờ phản hồi từ máy chủ.]"
+                    
                 except aiohttp.ClientError as e:
-                    logger.error(f"AIOHTTP client error: {str(e)}")
+                    logger.error(f"AIOHTTP client error ({backend.base_url}): {str(e)}")
+                    pool.record_failure(backend)
+                    if not response_parts:
+                        continue
                     callback("\n\n[Lỗi kết nối đến máy chủ AI.]")
-                    return full_response + "\n\n[Lỗi kết nối đến máy chủ AI.]"
+                    return "".join(response_parts) + "\n\n[Lỗi kết nối đến máy chủ AI.]"
+                
+                except asyncio.CancelledError:
+                    # Người dùng dừng hoặc ngắt kết nối: đóng hẳn kết nối HTTP để VLLM hủy request ngay
+                    if response is not None:
+                        response.close()
+                    AIService.abort_stats.record(len(response_parts))
+                    logger.info(f"Generation aborted on {backend.base_url} after {len(response_parts)} deltas")
+                    raise
+                
+                finally:
+                    pool.release(backend)
+            
+            if not completed:
+                # Không replica nào trả lời được sau tất cả các lần thử
+                logger.error(f"No VLLM backend could serve the request after {len(tried)} attempt(s)")
+                callback("\n\n[Lỗi kết nối đến máy chủ AI.]")
+                return "\n\n[Lỗi kết nối đến máy chủ AI.]"
+            
+            full_response = "".join(response_parts)
             
             # Loại bỏ token kết thúc nếu có
             if "<|im_end|>" in full_response:
@@ -123,82 +324,113 @@ class AIService:
             return error_msg
     
     @staticmethod
-    async def generate_response(messages: List[Dict[str, str]]) -> str:
+    async def generate_response(
+        messages: List[Dict[str, str]],
+        affinity_key: Optional[str] = None,
+        prompt: Optional[str] = None,
+        max_tokens: int = VLLM_MAX_TOKENS
+    ) -> str:
         """
         Gửi request đến VLLM API và nhận phản hồi (non-streaming)
         """
         try:
-            # Format prompt từ messages
-            prompt = AIService.format_prompt(messages)
+            # Format prompt từ messages nếu chưa có prompt render sẵn
+            if prompt is None:
+                prompt = AIService.format_prompt(messages)
             
             # Chuẩn bị request cho VLLM
             request_data = {
                 "model": VLLM_MODEL,  # Thêm trường model vào request
                 "prompt": prompt,
-                "max_tokens": 1024,
+                "max_tokens": max_tokens,
                 "temperature": 0.3,
                 "stop": ["<|im_end|>"]
             }
             
-            # Gửi request đến VLLM API
-            async with aiohttp.ClientSession() as session:
+            session = await AIService.get_session()
+            pool = AIService.get_pool()
+            tried = set()
+            
+            for attempt in range(VLLM_MAX_ATTEMPTS):
+                backend = pool.acquire(exclude=tried, affinity_key=affinity_key)
+                if backend is None:
+                    break
+                tried.add(backend)
+                if affinity_key is not None:
+                    AIService.prefix_stats.record(affinity_key, backend.base_url, prompt)
+                
+                # Gửi request đến replica đã chọn qua session dùng chung
                 try:
                     async with session.post(
-                        VLLM_API_URL,
+                        backend.completions_url,
                         json=request_data,
                         headers={"Content-Type": "application/json"},
                         timeout=aiohttp.ClientTimeout(total=30)  # 30 giây timeout
                     ) as response:
                         if response.status != 200:
                             error_text = await response.text()
-                            logger.error(f"VLLM API error: {response.status} - {error_text}")
+                            logger.error(f"VLLM API error ({backend.base_url}): {response.status} - {error_text}")
+                            # Lỗi phía server hoặc quá tải: thử replica khác
+                            if response.status >= 500 or response.status == 429:
+                                pool.record_failure(backend)
+                                continue
                             logger.error(f"Request data: {json.dumps(request_data)}")
                             return "Xin lỗi, tôi đang gặp vấn đề kỹ thuật. Vui lòng thử lại sau."
                         
                         # Parse phản hồi
                         response_data = await response.json()
-                        
-                        # Lấy text từ phản hồi
-                        generated_text = response_data["choices"][0]["text"]
-                        
-                        # Loại bỏ phần prompt gốc nếu có
-                        if generated_text.startswith(prompt):
-                            generated_text = generated_text[len(prompt):]
-                        
-                        # Loại bỏ token kết thúc nếu có
-                        if "<|im_end|>" in generated_text:
-                            generated_text = generated_text.split("<|im_end|>")[0]
-                        
-                        return generated_text.strip()
+                    
+                    pool.record_success(backend)
+                    
+                    # Lấy text từ phản hồi
+                    generated_text = response_data["choices"][0]["text"]
+                    
+                    # Loại bỏ phần prompt gốc nếu có
+                    if generated_text.startswith(prompt):
+                        generated_text = generated_text[len(prompt):]
+                    
+                    # Loại bỏ token kết thúc nếu có
+                    if "<|im_end|>" in generated_text:
+                        generated_text = generated_text.split("<|im_end|>")[0]
+                    
+                    return generated_text.strip()
                 except asyncio.TimeoutError:
-                    logger.error("Request timeout in non-streaming mode")
-                    return "Xin lỗi, tôi đang gặp vấn đề kết nối. Vui lòng thử lại sau."
+                    logger.error(f"Request timeout in non-streaming mode ({backend.base_url})")
+                    pool.record_failure(backend)
                 except aiohttp.ClientError as e:
-                    logger.error(f"AIOHTTP client error in non-streaming mode: {str(e)}")
-                    return "Xin lỗi, tôi đang gặp vấn đề kết nối. Vui lòng thử lại sau."
+                    logger.error(f"AIOHTTP client error in non-streaming mode ({backend.base_url}): {str(e)}")
+                    pool.record_failure(backend)
+                finally:
+                    pool.release(backend)
+            
+            logger.error(f"No VLLM backend could serve the request after {len(tried)} attempt(s)")
+            return "Xin lỗi, tôi đang gặp vấn đề kết nối. Vui lòng thử lại sau."
                     
         except Exception as e:
             logger.exception(f"Error generating AI response: {str(e)}")
             return "Xin lỗi, tôi đang gặp vấn đề kỹ thuật. Vui lòng thử lại sau."
     
+    @staticmethod
+    def is_error_response(text: str) -> bool:
+        """
+        Kiểm tra phản hồi có phải thông báo lỗi hoặc bị cắt ngắn không
+        """
+        return not text or any(marker in text for marker in ERROR_RESPONSE_MARKERS)
+    
+    @staticmethod
+    def render_message(msg: Dict[str, str]) -> str:
+        """
+        Render một tin nhắn theo định dạng ChatML của Qwen (chuỗi rỗng nếu role không hợp lệ)
+        """
+        if msg["role"] in CHATML_ROLES:
+            # Nội dung (kể cả code blocks) được giữ nguyên định dạng
+            return f"<|im_start|>{msg['role']}\n{msg['content']}<|im_end|>\n"
+        return ""
+    
     @staticmethod
     def format_prompt(messages: List[Dict[str, str]]) -> str:
         """
         Format tin nhắn thành prompt phù hợp với Qwen2.5-3B-Instruct
         """
-        formatted_prompt = ""
-        
-        for msg in messages:
-            if msg["role"] == "user":
-                formatted_prompt += f"<|im_start|>user\n{msg['content']}<|im_end|>\n"
-            elif msg["role"] == "assistant":
-                # Đảm bảo code blocks được giữ nguyên định dạng
-                content = msg["content"]
-                formatted_prompt += f"<|im_start|>assistant\n{content}<|im_end|>\n"
-            elif msg["role"] == "system":
-                formatted_prompt += f"<|im_start|>system\n{msg['content']}<|im_end|>\n"
-        
-        # Thêm token bắt đầu cho assistant để model biết cần trả lời
-        formatted_prompt += "<|im_start|>assistant\n"
-        
-        return formatted_prompt
+        # Thêm token bắt đầu cho assistant ở cuối để model biết cần trả lời
+        return "".join(AIService.render_message(msg) for msg in messages) + CHATML_ASSISTANT_START
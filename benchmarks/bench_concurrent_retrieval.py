@@ -0,0 +1,126 @@
+# benchmarks/bench_concurrent_retrieval.py
+"""
+Benchmark truy vấn PDF đồng thời: mỗi client có session riêng, N thread truy vấn cùng lúc
+(retrieve_relevant_chunks = encode câu hỏi + tìm trong FAISS). So sánh hai chế độ:
+  - global:      mỗi truy vấn giữ một khóa chung cho cả server (như trước khi có khóa riêng cho từng session)
+  - per-session: khóa đọc/ghi riêng của từng session, encode ngoài khóa (cách pdf_service đang làm)
+Với --ingest, một thread ghi liên tục thêm chunk vào session của client 0 trong lúc đo.
+
+Chạy: python benchmarks/bench_concurrent_retrieval.py [--clients 1 10 50] [--queries 20] [--chunks 2000] [--ingest]
+
+Chunk và vector của session được sinh ngẫu nhiên, câu hỏi được encode bằng embedding model thật.
+Thông lượng của chế độ per-session tăng theo số client tới khi hết CPU; chế độ global đứng yên.
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+os.environ.setdefault("PDF_SESSION_PERSIST", "0")
+os.environ.setdefault("DOC_CACHE_ENABLED", "0")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pdf_service
+from pdf_service import EMBEDDING_DIM, locked_session, mark_changed, retrieve_relevant_chunks
+from vector_index import normalize
+
+QUESTIONS = [
+    "Tài liệu nói gì về doanh thu quý 3?",
+    "What are the main risks mentioned in the report?",
+    "Điều kiện bảo hành của sản phẩm là gì?",
+    "Summarize the methodology section.",
+    "Ai là người chịu trách nhiệm phê duyệt ngân sách?"
+]
+
+def add_chunks(client_id, num_chunks, rng):
+    """Thêm num_chunks chunk ngẫu nhiên vào session của client như một lần flush khi ingest"""
+    vectors = normalize(rng.normal(size=(num_chunks, EMBEDDING_DIM)))
+    with locked_session(client_id) as session:
+        doc = session["file_info"].setdefault("bench", {
+            "name": "bench.pdf", "path": "bench.pdf", "chunks": 0, "pages": 0, "complete": True, "truncated": False
+        })
+        ids = np.arange(session["next_id"], session["next_id"] + num_chunks, dtype=np.int64)
+        session["index"].add_with_ids(vectors, ids)
+        session["next_id"] += num_chunks
+        for chunk_id in ids.tolist():
+            session["id_to_pos"][chunk_id] = len(session["chunks"])
+            session["chunk_ids"].append(chunk_id)
+            session["chunks"].append(f"Chunk {chunk_id} " + "nội dung " * 60)
+            session["metadata"].append({"source_file": "bench.pdf", "doc_id": "bench",
+                                        "chunk_index": chunk_id, "page": chunk_id // 4 + 1})
+        doc["chunks"] += num_chunks
+        mark_changed(session)
+
+def run_clients(num_clients, queries, global_lock):
+    """Mỗi thread truy vấn session của một client; trả về (thông lượng truy vấn/giây, độ trễ ms)"""
+    latencies = [[] for _ in range(num_clients)]
+    barrier = threading.Barrier(num_clients + 1)
+
+    def client(i):
+        barrier.wait()
+        for q in range(queries):
+            question = QUESTIONS[(i + q) % len(QUESTIONS)]
+            start = time.perf_counter()
+            if global_lock is not None:
+                with global_lock:
+                    retrieve_relevant_chunks(question, f"client-{i}")
+            else:
+                retrieve_relevant_chunks(question, f"client-{i}")
+            latencies[i].append((time.perf_counter() - start) * 1000)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(num_clients)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    all_latencies = np.concatenate([np.array(items) for items in latencies])
+    return len(all_latencies) / elapsed, all_latencies
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--queries", type=int, default=20, help="số truy vấn của mỗi client")
+    parser.add_argument("--chunks", type=int, default=2000, help="số chunk trong session của mỗi client")
+    parser.add_argument("--ingest", action="store_true", help="thêm chunk liên tục vào session client-0 trong lúc đo")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    for i in range(max(args.clients)):
+        add_chunks(f"client-{i}", args.chunks, rng)
+    # Làm nóng model
+    retrieve_relevant_chunks(QUESTIONS[0], "client-0")
+
+    stop = threading.Event()
+    writer = None
+    if args.ingest:
+        def ingest():
+            writer_rng = np.random.default_rng(1)
+            while not stop.is_set():
+                add_chunks("client-0", 64, writer_rng)
+                time.sleep(0.01)
+        writer = threading.Thread(target=ingest, daemon=True)
+        writer.start()
+
+    print(f"{'clients':>8} {'mode':>12} {'queries/s':>10} {'p50 (ms)':>9} {'p99 (ms)':>9}")
+    try:
+        for num_clients in args.clients:
+            for mode in ["global", "per-session"]:
+                global_lock = threading.Lock() if mode == "global" else None
+                throughput, latencies = run_clients(num_clients, args.queries, global_lock)
+                print(f"{num_clients:>8} {mode:>12} {throughput:>10.1f} "
+                      f"{np.percentile(latencies, 50):>9.2f} {np.percentile(latencies, 99):>9.2f}")
+    finally:
+        stop.set()
+        if writer is not None:
+            writer.join()
+    print(f"client-0 chunks: {len(pdf_service.get_user_pdf_session('client-0')['chunks'])}")
+
+if __name__ == "__main__":
+    main()
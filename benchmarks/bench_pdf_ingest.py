@@ -0,0 +1,79 @@
+# benchmarks/bench_pdf_ingest.py
+"""
+Benchmark ingest PDF trên các file trong uploads/: đo tốc độ đọc + chia chunk (pages/sec)
+và tốc độ tạo vector cho chunk (embeddings/sec), so sánh encode từng chunk (cách cũ)
+với encode_chunks (một lần gọi model theo batch).
+
+Chạy: python benchmarks/bench_pdf_ingest.py [--pdf-dir uploads] [--batch-size 64] [--repeat 3]
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pdf_service
+from pdf_service import embedding_model, encode_chunks, read_pdf
+
+def encode_one_by_one(chunks):
+    """Tái hiện vòng lặp cũ trong process_pdf_file: một lần gọi model cho mỗi chunk"""
+    return np.vstack([embedding_model.encode([chunk["content"]]) for chunk in chunks])
+
+def best_time(fn, arg, repeat):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(arg)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def main():
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pdf-dir", default=os.path.join(repo_dir, "uploads"))
+    parser.add_argument("--batch-size", type=int, default=pdf_service.EMBEDDING_BATCH_SIZE)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    pdf_service.EMBEDDING_BATCH_SIZE = args.batch_size
+    pdf_files = sorted(glob.glob(os.path.join(args.pdf_dir, "*.pdf")))
+    if not pdf_files:
+        print(f"No PDF files found in {args.pdf_dir}")
+        return
+
+    # Làm nóng model để lần đo đầu không tính thời gian khởi tạo
+    embedding_model.encode(["warm up"])
+
+    total_pages = total_chunks = 0
+    total_read = total_old = total_new = 0.0
+    print(f"{'file':<40} {'pages':>6} {'chunks':>7} {'pages/s':>9} {'old emb/s':>10} {'new emb/s':>10}")
+    for path in pdf_files:
+        read_time, chunks = best_time(read_pdf, path, args.repeat)
+        pages = len({chunk.get("page", 1) for chunk in chunks})
+        if not chunks:
+            continue
+        old_time, old_vectors = best_time(encode_one_by_one, chunks, args.repeat)
+        new_time, new_vectors = best_time(encode_chunks, chunks, args.repeat)
+        if not np.allclose(old_vectors, new_vectors, atol=1e-4):
+            print(f"WARNING: vectors differ for {os.path.basename(path)}")
+
+        total_pages += pages
+        total_chunks += len(chunks)
+        total_read += read_time
+        total_old += old_time
+        total_new += new_time
+        name = os.path.basename(path)[-40:]
+        print(f"{name:<40} {pages:>6} {len(chunks):>7} {pages / read_time:>9.1f} "
+              f"{len(chunks) / old_time:>10.1f} {len(chunks) / new_time:>10.1f}")
+
+    if total_chunks:
+        print(f"{'total':<40} {total_pages:>6} {total_chunks:>7} {total_pages / total_read:>9.1f} "
+              f"{total_chunks / total_old:>10.1f} {total_chunks / total_new:>10.1f}")
+
+if __name__ == "__main__":
+    main()
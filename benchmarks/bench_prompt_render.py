@@ -0,0 +1,104 @@
+# benchmarks/bench_prompt_render.py
+"""
+Micro-benchmark: thời gian dựng prompt ChatML mỗi lượt khi hội thoại dài dần.
+So sánh cách cũ (render lại toàn bộ lịch sử bằng += mỗi lượt, pdf_query sao chép list lịch sử)
+với ConversationPrompt (chỉ render tin nhắn mới).
+
+Chạy: python benchmarks/bench_prompt_render.py [--turns 1000] [--answer-chars 1500]
+
+Lịch sử không bị cắt trong benchmark để thấy rõ chi phí theo độ dài hội thoại.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ai_service import AIService
+from prompt_cache import ConversationPrompt
+
+WINDOW = 10
+
+WORDS = ["mô", "hình", "ngôn", "ngữ", "dữ", "liệu", "hệ", "thống", "xử", "lý", "code", "python", "câu", "trả", "lời"]
+
+def make_text(rng, chars):
+    words = []
+    size = 0
+    while size < chars:
+        word = rng.choice(WORDS)
+        words.append(word)
+        size += len(word) + 1
+    return " ".join(words)
+
+def old_format_prompt(messages):
+    """Tái hiện AIService.format_prompt cũ (nối chuỗi += qua toàn bộ lịch sử)"""
+    formatted_prompt = ""
+    for msg in messages:
+        if msg["role"] == "user":
+            formatted_prompt += f"<|im_start|>user\n{msg['content']}<|im_end|>\n"
+        elif msg["role"] == "assistant":
+            content = msg["content"]
+            formatted_prompt += f"<|im_start|>assistant\n{content}<|im_end|>\n"
+        elif msg["role"] == "system":
+            formatted_prompt += f"<|im_start|>system\n{msg['content']}<|im_end|>\n"
+    formatted_prompt += "<|im_start|>assistant\n"
+    return formatted_prompt
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=1000)
+    parser.add_argument("--question-chars", type=int, default=200)
+    parser.add_argument("--answer-chars", type=int, default=1500)
+    parser.add_argument("--pdf", action="store_true", help="Mô phỏng pdf_query (câu hỏi cuối được thay bằng câu hỏi kèm context)")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    history = [{"role": "system", "content": make_text(rng, 600)}]
+    rendered = ConversationPrompt()
+    checkpoints = sorted({10, 50, 100, 250, 500, args.turns})
+    old_total = new_total = 0.0
+    old_window = new_window = 0.0
+
+    print(f"thời gian trung bình mỗi lượt trong {WINDOW} lượt gần nhất")
+    print(f"{'turn':>6} {'prompt chars':>13} {'old (ms)':>10} {'new (ms)':>10}")
+    for turn in range(1, args.turns + 1):
+        question = make_text(rng, args.question_chars)
+        history.append({"role": "user", "content": question})
+        tail = {"role": "user", "content": question + "\n\n" + make_text(rng, 2000)} if args.pdf else None
+
+        start = time.perf_counter()
+        if tail is not None:
+            old_prompt = old_format_prompt(history[:-1] + [tail])
+        else:
+            old_prompt = old_format_prompt(history)
+        old_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if tail is not None:
+            new_prompt = rendered.render(history, upto=len(history) - 1, tail=tail)
+        else:
+            new_prompt = rendered.render(history)
+        new_time = time.perf_counter() - start
+
+        assert old_prompt == new_prompt, f"prompt mismatch at turn {turn}"
+        old_total += old_time
+        new_total += new_time
+        if turn % WINDOW == 0 or turn in checkpoints:
+            old_window = new_window = 0.0
+        old_window += old_time
+        new_window += new_time
+        if turn in checkpoints:
+            count = (turn - 1) % WINDOW + 1
+            print(f"{turn:>6} {len(new_prompt):>13} {old_window / count * 1000:>10.3f} {new_window / count * 1000:>10.3f}")
+
+        history.append({"role": "assistant", "content": make_text(rng, args.answer_chars)})
+
+    print(f"total over {args.turns} turns: old {old_total * 1000:.1f} ms, new {new_total * 1000:.1f} ms")
+    print(f"messages rendered: old {sum(2 * t for t in range(1, args.turns + 1))}, new {rendered.rendered_messages}")
+    # format_prompt hiện tại phải cho cùng kết quả với cách cũ
+    assert AIService.format_prompt(history) == old_format_prompt(history)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# benchmarks/bench_query_embedding.py
+"""
+Benchmark encode câu hỏi khi có nhiều client đồng thời: N coroutine, mỗi coroutine encode lần lượt
+các câu hỏi của mình. So sánh:
+  - per-request: mỗi câu hỏi một lần gọi model trên thread riêng (asyncio.to_thread)
+  - batched:     embedding_service.EmbeddingService gom các câu hỏi đồng thời thành micro-batch
+Báo cáo thông lượng, độ trễ p50/p99 của từng request và phân bố kích thước batch.
+
+Chạy: python benchmarks/bench_query_embedding.py [--clients 1 10 50] [--queries 20] [--window-ms 5]
+                                                 [--max-batch 32] [--repeat 0.0]
+
+--repeat là tỉ lệ câu hỏi lặp lại câu đã hỏi (để đo tác dụng của cache vector LRU).
+Cần embedding model thật (sentence-transformers).
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+os.environ.setdefault("PDF_SESSION_PERSIST", "0")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from embedding_service import EmbeddingService
+from pdf_service import embedding_model
+
+TOPICS = ["doanh thu", "bảo hành", "rủi ro", "ngân sách", "hợp đồng", "nhân sự", "quy trình", "kết quả thử nghiệm"]
+
+def make_questions(num_clients, queries, repeat, seed=0):
+    rng = random.Random(seed)
+    asked = []
+    questions = []
+    for client in range(num_clients):
+        client_questions = []
+        for q in range(queries):
+            if asked and rng.random() < repeat:
+                question = rng.choice(asked)
+            else:
+                question = f"Tài liệu nói gì về {rng.choice(TOPICS)} trong phần {client}.{q}?"
+                asked.append(question)
+            client_questions.append(question)
+        questions.append(client_questions)
+    return questions
+
+async def run(questions, embed):
+    latencies = []
+
+    async def client(client_questions):
+        for question in client_questions:
+            start = time.perf_counter()
+            await embed(question)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(client_questions) for client_questions in questions))
+    elapsed = time.perf_counter() - start
+    return len(latencies) / elapsed, np.array(latencies)
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--queries", type=int, default=20, help="số câu hỏi của mỗi client")
+    parser.add_argument("--window-ms", type=float, default=5.0)
+    parser.add_argument("--max-batch", type=int, default=32)
+    parser.add_argument("--repeat", type=float, default=0.0)
+    args = parser.parse_args()
+
+    # Làm nóng model
+    embedding_model.encode(["warm up"])
+
+    async def per_request(question):
+        return await asyncio.to_thread(embedding_model.encode, [question])
+
+    print(f"{'clients':>8} {'mode':>12} {'queries/s':>10} {'p50 (ms)':>9} {'p99 (ms)':>9}  batches")
+    for num_clients in args.clients:
+        questions = make_questions(num_clients, args.queries, args.repeat)
+        throughput, latencies = await run(questions, per_request)
+        print(f"{num_clients:>8} {'per-request':>12} {throughput:>10.1f} "
+              f"{np.percentile(latencies, 50):>9.2f} {np.percentile(latencies, 99):>9.2f}")
+
+        service = EmbeddingService(window=args.window_ms / 1000, max_batch=args.max_batch)
+        throughput, latencies = await run(questions, service.embed)
+        stats = service.snapshot()
+        service.close()
+        print(f"{num_clients:>8} {'batched':>12} {throughput:>10.1f} "
+              f"{np.percentile(latencies, 50):>9.2f} {np.percentile(latencies, 99):>9.2f}  "
+              f"avg {stats['avg_batch_size']}, cache hits {stats['cache_hits']}, "
+              f"histogram {stats['batch_size_histogram']}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,98 @@
+# benchmarks/bench_semantic_chunking.py
+"""
+Benchmark chia chunk ngữ nghĩa: so sánh cách cũ (ma trận cosine N×N + trung bình bằng vòng lặp Python)
+với semantic_chunker.chunk_sentences (tổng vector chạy theo chunk, O(N·d)) trên 50, 500, 5000 câu,
+đồng thời kiểm tra ranh giới chunk của hai cách giống nhau.
+
+Chạy: python benchmarks/bench_semantic_chunking.py [--sizes 50 500 5000] [--dim 384]
+
+Vector câu được sinh ngẫu nhiên theo từng "chủ đề" liên tiếp để similarity dao động quanh ngưỡng,
+nên không cần tải embedding model.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from semantic_chunker import chunk_sentences
+
+WORDS = ["dữ", "liệu", "mô", "hình", "hệ", "thống", "máy", "học", "kết", "quả", "phân", "tích", "tài", "liệu"]
+
+def make_page(num_sentences, dim, seed=0):
+    rng = np.random.default_rng(seed)
+    text_rng = random.Random(seed)
+    sentences = []
+    vectors = []
+    topic = rng.normal(size=dim)
+    for i in range(num_sentences):
+        if text_rng.random() < 0.15:
+            topic = rng.normal(size=dim)
+        vectors.append(topic + rng.normal(scale=0.55, size=dim))
+        words = [text_rng.choice(WORDS) for _ in range(text_rng.randint(5, 30))]
+        sentences.append(" ".join(words).capitalize() + ".")
+    return sentences, np.asarray(vectors, dtype=np.float32)
+
+def old_chunking(sentences, sentence_embeddings, max_chunk_size=1000, similarity_threshold=0.7):
+    """Tái hiện semantic_chunking cũ (cosine_similarity của sklearn thay bằng numpy tương đương)"""
+    normalized = sentence_embeddings / np.linalg.norm(sentence_embeddings, axis=1, keepdims=True)
+    similarity_matrix = normalized @ normalized.T
+
+    ranges = []
+    current_chunk = []
+    current_chunk_text = ""
+    for i, sentence in enumerate(sentences):
+        if not current_chunk or (len(current_chunk) > 0 and
+                                 np.mean([similarity_matrix[i][j] for j in current_chunk]) >= similarity_threshold):
+            if len(current_chunk_text + sentence) <= max_chunk_size:
+                current_chunk.append(i)
+                current_chunk_text += " " + sentence
+            else:
+                ranges.append((current_chunk[0], i) if current_chunk else None)
+                current_chunk = [i]
+                current_chunk_text = sentence
+        else:
+            ranges.append((current_chunk[0], i))
+            current_chunk = [i]
+            current_chunk_text = sentence
+    if current_chunk_text:
+        ranges.append((current_chunk[0], len(sentences)))
+    # Cách cũ tạo một chunk rỗng nếu câu đầu tiên dài hơn max_chunk_size
+    return [r for r in ranges if r is not None]
+
+def boundary_agreement(a, b):
+    starts_a = {start for start, _ in a}
+    starts_b = {start for start, _ in b}
+    return len(starts_a & starts_b) / len(starts_a | starts_b)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[50, 500, 5000])
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--tolerance", type=float, default=0.99, help="Tỉ lệ ranh giới trùng khớp tối thiểu")
+    args = parser.parse_args()
+
+    print(f"{'sentences':>10} {'chunks':>7} {'old (ms)':>10} {'new (ms)':>10} {'speedup':>8} {'agreement':>10}")
+    for size in args.sizes:
+        sentences, vectors = make_page(size, args.dim)
+
+        start = time.perf_counter()
+        old_ranges = old_chunking(sentences, vectors)
+        old_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        new_ranges = chunk_sentences(sentences, vectors)
+        new_time = time.perf_counter() - start
+
+        agreement = boundary_agreement(old_ranges, new_ranges)
+        print(f"{size:>10} {len(new_ranges):>7} {old_time * 1000:>10.2f} {new_time * 1000:>10.2f} "
+              f"{old_time / new_time:>8.1f} {agreement:>10.4f}")
+        if agreement < args.tolerance:
+            print(f"WARNING: chunk boundaries differ beyond tolerance for {size} sentences")
+
+if __name__ == "__main__":
+    main()
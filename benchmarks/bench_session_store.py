@@ -0,0 +1,92 @@
+# benchmarks/bench_session_store.py
+"""
+Benchmark lưu/mở lại session PDF trên đĩa: với mỗi kích thước session (số chunk) đo thời gian ghi,
+thời gian mở lại (mmap và đọc toàn bộ) và RAM tăng thêm sau khi mở lại + một lần tìm kiếm.
+
+Chạy: python benchmarks/bench_session_store.py [--sizes 1000 10000 100000] [--dim 384] [--repeat 5]
+
+Vector và nội dung chunk được sinh ngẫu nhiên nên không cần tải embedding model.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from session_store import SessionStore
+from vector_index import build_id_index, normalize
+
+def rss_bytes():
+    """RSS hiện tại của process (đọc từ /proc, 0 nếu không có)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+def make_session(num_chunks, dim, seed=0):
+    rng = np.random.default_rng(seed)
+    vectors = normalize(rng.normal(size=(num_chunks, dim)))
+    index = build_id_index(dim, "flat", vectors, np.arange(num_chunks))
+    chunks = [f"Chunk {i} " + "nội dung " * 60 for i in range(num_chunks)]
+    return {
+        "index": index,
+        "chunks": chunks,
+        "metadata": [{"source_file": "bench.pdf", "doc_id": "bench", "chunk_index": i, "page": i // 4 + 1}
+                     for i in range(num_chunks)],
+        "chunk_ids": list(range(num_chunks)),
+        "next_id": num_chunks,
+        "file_info": {"bench": {"name": "bench.pdf", "path": "bench.pdf", "chunks": num_chunks,
+                                "pages": num_chunks // 4 + 1, "complete": True, "truncated": False}},
+        "last_access": time.time()
+    }
+
+def measure_load(store, client_id, query, mmap, repeat):
+    best = float("inf")
+    rss_delta = 0
+    resident = 0
+    for _ in range(repeat):
+        before = rss_bytes()
+        start = time.perf_counter()
+        session = store.load(client_id, mmap=mmap)
+        session["index"].search(query, 5)
+        best = min(best, time.perf_counter() - start)
+        rss_delta = max(rss_delta, rss_bytes() - before)
+        resident = store.resident_bytes(session)
+        del session
+    return best, rss_delta, resident
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    query = np.random.default_rng(1).normal(size=(1, args.dim)).astype(np.float32)
+    print(f"{'chunks':>8} {'save (ms)':>10} {'mmap load (ms)':>15} {'full load (ms)':>15} "
+          f"{'mmap RSS (MB)':>14} {'full RSS (MB)':>14} {'resident mmap/full (MB)':>24}")
+    with tempfile.TemporaryDirectory() as root:
+        store = SessionStore(root=root)
+        for size in args.sizes:
+            client_id = f"bench-{size}"
+            session = make_session(size, args.dim)
+            start = time.perf_counter()
+            store.write(client_id, store.serialize(client_id, session))
+            save_time = time.perf_counter() - start
+            del session
+
+            mmap_time, mmap_rss, mmap_resident = measure_load(store, client_id, query, True, args.repeat)
+            full_time, full_rss, full_resident = measure_load(store, client_id, query, False, args.repeat)
+            mb = 1024 * 1024
+            print(f"{size:>8} {save_time * 1000:>10.1f} {mmap_time * 1000:>15.2f} {full_time * 1000:>15.2f} "
+                  f"{mmap_rss / mb:>14.1f} {full_rss / mb:>14.1f} "
+                  f"{mmap_resident / mb:>11.1f}/{full_resident / mb:<12.1f}")
+        print(store.snapshot({}))
+
+if __name__ == "__main__":
+    main()
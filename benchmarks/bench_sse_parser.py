@@ -0,0 +1,120 @@
+# benchmarks/bench_sse_parser.py
+"""
+Micro-benchmark: so sánh parser SSE cũ (từng dòng + json.loads + nối chuỗi +=)
+với SSEDecoder mới trên một stream /v1/completions khoảng 4k token.
+
+Chạy: python benchmarks/bench_sse_parser.py [--input recorded_stream.txt] [--tokens 4096]
+
+Nếu không có --input, script tự tạo một stream giả lập theo đúng định dạng vLLM
+(có ký tự tiếng Việt nhiều byte) rồi cắt thành các khối ngẫu nhiên để mô phỏng
+ranh giới gói tin mạng cắt ngang event và ký tự UTF-8.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sse_parser import SSEDecoder, iter_completion_deltas
+
+WORDS = ["Xin", " chào", ",", " đây", " là", " câu", " trả", " lời", " chi", " tiết", " về",
+         " mô", " hình", " ngôn", " ngữ", ".", "\n", " Hệ", " thống", " xử", " lý", " dữ", " liệu"]
+
+def make_stream(num_tokens, seed=0):
+    """Tạo stream SSE giống vLLM: mỗi token một event 'data: {...}\\n\\n'"""
+    rng = random.Random(seed)
+    lines = []
+    for i in range(num_tokens):
+        event = {
+            "id": "cmpl-bench",
+            "object": "text_completion",
+            "created": 1700000000,
+            "model": "Qwen/Qwen2.5-3B-Instruct-AWQ",
+            "choices": [{"index": 0, "text": rng.choice(WORDS), "logprobs": None, "finish_reason": None}]
+        }
+        lines.append(f"data: {json.dumps(event, ensure_ascii=False)}\n\n")
+    lines.append("data: [DONE]\n\n")
+    return "".join(lines).encode("utf-8")
+
+def split_random(data, seed=1, min_size=1, max_size=512):
+    """Cắt byte stream thành các khối ngẫu nhiên như khi đọc từ socket"""
+    rng = random.Random(seed)
+    pieces = []
+    pos = 0
+    while pos < len(data):
+        size = rng.randint(min_size, max_size)
+        pieces.append(data[pos:pos + size])
+        pos += size
+    return pieces
+
+def old_parser(lines):
+    """Tái hiện vòng lặp cũ trong AIService.generate_response_stream"""
+    full_response = ""
+    for line in lines:
+        if line:
+            try:
+                line_text = line.decode('utf-8').strip()
+                if not line_text or line_text == "data: [DONE]":
+                    continue
+                if line_text.startswith("data: "):
+                    line_text = line_text[6:]
+                chunk = json.loads(line_text)
+                if "choices" in chunk and len(chunk["choices"]) > 0:
+                    delta = chunk["choices"][0].get("text", "")
+                    full_response += delta
+            except json.JSONDecodeError:
+                continue
+            except Exception:
+                continue
+    return full_response
+
+def new_parser(pieces):
+    decoder = SSEDecoder()
+    parts = []
+    for piece in pieces:
+        parts.extend(iter_completion_deltas(decoder.feed(piece)))
+    parts.extend(iter_completion_deltas(decoder.flush()))
+    return "".join(parts)
+
+def bench(fn, arg, repeat):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(arg)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", help="File chứa stream SSE đã ghi lại từ vLLM")
+    parser.add_argument("--tokens", type=int, default=4096)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.input:
+        with open(args.input, "rb") as f:
+            data = f.read()
+    else:
+        data = make_stream(args.tokens)
+
+    # Parser cũ nhận từng dòng (như aiohttp StreamReader), parser mới nhận khối ngẫu nhiên
+    lines = data.splitlines(keepends=True)
+    pieces = split_random(data)
+
+    old_time, old_result = bench(old_parser, lines, args.repeat)
+    new_time, new_result = bench(new_parser, pieces, args.repeat)
+
+    if old_result != new_result:
+        print("WARNING: kết quả hai parser khác nhau")
+
+    print(f"stream: {len(data)} bytes, {len(lines)} lines, {len(pieces)} network chunks")
+    print(f"old parser: {old_time * 1000:.2f} ms")
+    print(f"new parser: {new_time * 1000:.2f} ms")
+    print(f"speedup:    {old_time / new_time:.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# benchmarks/bench_ws_protocol.py
+"""
+Đo số byte trên đường truyền cho mỗi token của câu trả lời, so sánh:
+- json cũ: json.dumps mặc định (escape ký tự tiếng Việt thành \\uXXXX)
+- json mới: ensure_ascii=False, không khoảng trắng
+- binary: 1 byte loại tin nhắn + nội dung UTF-8 (subprotocol chatbot.bin.v1)
+mỗi loại có/không có permessage-deflate (mô phỏng bằng zlib raw deflate giữ context giữa các frame).
+
+Chạy: python benchmarks/bench_ws_protocol.py [--tokens 1000] [--tokens-per-frame 1 4 16]
+
+Số byte gồm cả header frame websocket phía server (2 byte, 4 byte nếu payload >= 126 byte).
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ws_protocol import encode_message
+
+WORDS = ["Xin", " chào", ",", " đây", " là", " câu", " trả", " lời", " chi", " tiết", " về",
+         " mô", " hình", " ngôn", " ngữ", ".", "\n", " Hệ", " thống", " xử", " lý", " dữ", " liệu",
+         " ```", "python", " def", " hàm", "(", ")", ":"]
+
+def frame_header_size(payload_len):
+    if payload_len < 126:
+        return 2
+    if payload_len < 65536:
+        return 4
+    return 10
+
+def make_messages(num_tokens, tokens_per_frame, seed=0):
+    rng = random.Random(seed)
+    tokens = [rng.choice(WORDS) for _ in range(num_tokens)]
+    messages = [{"type": "stream_start"}]
+    for i in range(0, num_tokens, tokens_per_frame):
+        messages.append({"type": "stream_chunk", "content": "".join(tokens[i:i + tokens_per_frame])})
+    messages.append({"type": "stream_end"})
+    return messages
+
+def encode_old_json(message):
+    return json.dumps(message).encode("utf-8")
+
+def encode_new_json(message):
+    return encode_message(message).encode("utf-8")
+
+def encode_binary(message):
+    return encode_message(message, binary=True)
+
+def wire_bytes(payloads, deflate):
+    total = 0
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    for payload in payloads:
+        if deflate:
+            # permessage-deflate: flush đồng bộ cuối mỗi tin nhắn và bỏ 4 byte 00 00 ff ff
+            payload = (compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+        total += len(payload) + frame_header_size(len(payload))
+    return total
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=1000)
+    parser.add_argument("--tokens-per-frame", type=int, nargs="+", default=[1, 4, 16],
+                        help="Số token mỗi frame (phụ thuộc cấu hình StreamCoalescer)")
+    args = parser.parse_args()
+
+    encoders = [("json (old)", encode_old_json), ("json", encode_new_json), ("binary", encode_binary)]
+    print(f"{'tokens/frame':>12} {'encoding':>12} {'bytes/token':>12} {'+deflate':>10}")
+    for tokens_per_frame in args.tokens_per_frame:
+        messages = make_messages(args.tokens, tokens_per_frame)
+        for name, encoder in encoders:
+            payloads = [encoder(message) for message in messages]
+            raw = wire_bytes(payloads, deflate=False) / args.tokens
+            compressed = wire_bytes(payloads, deflate=True) / args.tokens
+            print(f"{tokens_per_frame:>12} {name:>12} {raw:>12.2f} {compressed:>10.2f}")
+
+if __name__ == "__main__":
+    main()
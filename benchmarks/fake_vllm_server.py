@@ -0,0 +1,100 @@
+# benchmarks/fake_vllm_server.py
+"""
+Server giả lập endpoint /v1/completions của VLLM để đo tải mà không cần GPU.
+
+Chạy: python benchmarks/fake_vllm_server.py --port 8000 --tokens-per-sec 50 --ttft 0.2 --error-rate 0.01
+
+Hỗ trợ cả chế độ stream (SSE "data: {...}\\n\\n" ... "data: [DONE]") lẫn non-stream,
+và endpoint /health để health check của vllm_router hoạt động bình thường.
+Có thể chạy nhiều instance trên các cổng khác nhau rồi đặt
+VLLM_BACKENDS=http://localhost:8000,http://localhost:8001 để thử định tuyến nhiều replica.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import web
+
+WORDS = ["Xin", " chào", ",", " đây", " là", " câu", " trả", " lời", " giả", " lập", " từ",
+         " server", " thử", " tải", ".", "\n", " Hệ", " thống", " đang", " hoạt", " động", " tốt"]
+
+class FakeVLLM:
+    def __init__(self, tokens_per_sec, ttft, error_rate, max_tokens, seed=None):
+        self.tokens_per_sec = tokens_per_sec
+        self.ttft = ttft
+        self.error_rate = error_rate
+        self.max_tokens = max_tokens
+        self.rng = random.Random(seed)
+        self.active = 0
+        self.requests = 0
+        self.aborted = 0
+
+    def event(self, text, finish_reason=None):
+        return {
+            "id": "cmpl-fake",
+            "object": "text_completion",
+            "created": int(time.time()),
+            "model": "fake",
+            "choices": [{"index": 0, "text": text, "logprobs": None, "finish_reason": finish_reason}]
+        }
+
+    async def completions(self, request):
+        body = await request.json()
+        self.requests += 1
+        if self.rng.random() < self.error_rate:
+            return web.Response(status=503, text="fake error")
+
+        num_tokens = min(int(body.get("max_tokens", self.max_tokens)), self.max_tokens)
+        interval = 1.0 / self.tokens_per_sec if self.tokens_per_sec > 0 else 0
+        tokens = [self.rng.choice(WORDS) for _ in range(num_tokens)]
+
+        if not body.get("stream"):
+            await asyncio.sleep(self.ttft + interval * num_tokens)
+            return web.json_response(self.event("".join(tokens), "length"))
+
+        self.active += 1
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        try:
+            await asyncio.sleep(self.ttft)
+            for token in tokens:
+                await response.write(f"data: {json.dumps(self.event(token), ensure_ascii=False)}\n\n".encode("utf-8"))
+                if interval:
+                    await asyncio.sleep(interval)
+            await response.write(b"data: [DONE]\n\n")
+        except (ConnectionResetError, asyncio.CancelledError):
+            # Client (chatbot) đã hủy request
+            self.aborted += 1
+            raise
+        finally:
+            self.active -= 1
+        return response
+
+    async def health(self, request):
+        return web.Response(text="ok")
+
+    async def stats(self, request):
+        return web.json_response({"active": self.active, "requests": self.requests, "aborted": self.aborted})
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--tokens-per-sec", type=float, default=50, help="Tốc độ sinh token của mỗi request")
+    parser.add_argument("--ttft", type=float, default=0.2, help="Thời gian tới token đầu tiên (giây)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Tỉ lệ request trả về HTTP 503")
+    parser.add_argument("--max-tokens", type=int, default=256, help="Số token tối đa mỗi câu trả lời")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    fake = FakeVLLM(args.tokens_per_sec, args.ttft, args.error_rate, args.max_tokens, args.seed)
+    app = web.Application()
+    app.router.add_post("/v1/completions", fake.completions)
+    app.router.add_get("/health", fake.health)
+    app.router.add_get("/stats", fake.stats)
+    web.run_app(app, host=args.host, port=args.port)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+# benchmarks/load_test.py
+"""
+Load test cho chatbot: mở N kết nối /ws/{client_id} đồng thời, gửi tin nhắn chat và
+pdf_query, tải các file PDF mẫu lên /upload_pdf, rồi báo cáo p50/p95/p99 của TTFT,
+độ trễ giữa các chunk, độ trễ toàn phần, throughput và CPU/RSS của server.
+
+Ví dụ:
+    python benchmarks/fake_vllm_server.py --port 8000 &
+    python main.py &
+    python benchmarks/load_test.py --users 100 --turns 5 --pdf-ratio 0.3 --server-pid <pid của main.py>
+
+Kết quả được lưu dạng JSON trong benchmarks/results/ để so sánh giữa các lần chạy.
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import random
+import time
+import uuid
+
+import aiohttp
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+CHAT_QUESTIONS = [
+    "Giải thích ngắn gọn về mô hình ngôn ngữ lớn.",
+    "Viết hàm Python tính số Fibonacci thứ n.",
+    "So sánh TCP và UDP.",
+    "Làm sao để tối ưu truy vấn SQL chậm?",
+    "Tóm tắt các nguyên tắc SOLID."
+]
+PDF_QUESTIONS = [
+    "Tài liệu này nói về điều gì?",
+    "Liệt kê các kỹ năng được nhắc đến trong tài liệu.",
+    "Yêu cầu chính trong tài liệu là gì?"
+]
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "mean": sum(values) / len(values) if values else None
+    }
+
+class ProcessSampler:
+    """
+    Lấy mẫu CPU/RSS của process server (dùng psutil nếu có, nếu không đọc /proc trên Linux)
+    """
+
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.cpu = []
+        self.rss = []
+        self._task = None
+
+    def _read_proc(self):
+        with open(f"/proc/{self.pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        cpu_ticks = int(fields[11]) + int(fields[12])
+        with open(f"/proc/{self.pid}/statm") as f:
+            rss_pages = int(f.read().split()[1])
+        return cpu_ticks / os.sysconf("SC_CLK_TCK"), rss_pages * os.sysconf("SC_PAGE_SIZE")
+
+    async def _run(self):
+        try:
+            import psutil
+            process = psutil.Process(self.pid)
+            process.cpu_percent(None)
+            while True:
+                await asyncio.sleep(self.interval)
+                self.cpu.append(process.cpu_percent(None))
+                self.rss.append(process.memory_info().rss)
+        except ImportError:
+            last_cpu, _ = self._read_proc()
+            last_time = time.monotonic()
+            while True:
+                await asyncio.sleep(self.interval)
+                cpu_seconds, rss = self._read_proc()
+                now = time.monotonic()
+                self.cpu.append(100.0 * (cpu_seconds - last_cpu) / (now - last_time))
+                self.rss.append(rss)
+                last_cpu, last_time = cpu_seconds, now
+
+    def start(self):
+        if self.pid:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+
+    def report(self):
+        if not self.cpu:
+            return None
+        return {
+            "cpu_percent": summarize(self.cpu),
+            "rss_bytes_max": max(self.rss),
+            "rss_bytes_mean": sum(self.rss) / len(self.rss)
+        }
+
+class Results:
+    def __init__(self):
+        self.ttft = []
+        self.inter_chunk = []
+        self.end_to_end = []
+        self.upload = []
+        self.chunks = 0
+        self.chars = 0
+        self.answers = 0
+        self.errors = 0
+        self.rejected = 0
+        self.queued = 0
+
+async def upload_pdf(session, base_url, client_id, pdf_path, results):
+    data = aiohttp.FormData()
+    data.add_field("client_id", client_id)
+    with open(pdf_path, "rb") as f:
+        data.add_field("pdf_file", f.read(), filename=os.path.basename(pdf_path), content_type="application/pdf")
+    start = time.perf_counter()
+    async with session.post(f"{base_url}/upload_pdf", data=data) as response:
+        body = await response.json(content_type=None)
+        if response.status not in (200, 202):
+            results.errors += 1
+            return False
+    # File được xử lý nền: chờ job xong để thời gian upload gồm cả thời gian xử lý
+    job_id = body.get("job_id")
+    while job_id:
+        async with session.get(f"{base_url}/upload_pdf/{job_id}") as response:
+            job = await response.json(content_type=None)
+        if response.status != 200 or job.get("status") == "error":
+            results.errors += 1
+            return False
+        if job.get("status") == "done":
+            break
+        await asyncio.sleep(0.2)
+    results.upload.append(time.perf_counter() - start)
+    return True
+
+async def run_turn(ws, message, results, timeout):
+    """
+    Gửi một tin nhắn và đo thời gian cho tới khi nhận stream_end
+    """
+    sent_at = time.perf_counter()
+    await ws.send_str(json.dumps(message))
+    first_chunk_at = None
+    last_chunk_at = None
+    deadline = sent_at + timeout
+    while True:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            results.errors += 1
+            return
+        msg = await ws.receive(timeout=remaining)
+        if msg.type == aiohttp.WSMsgType.TEXT:
+            data = json.loads(msg.data)
+        elif msg.type == aiohttp.WSMsgType.BINARY:
+            # Giao thức nhị phân không được phân tích ở đây; coi như một chunk
+            data = {"type": "stream_chunk", "content": ""}
+        else:
+            results.errors += 1
+            return
+        kind = data.get("type")
+        now = time.perf_counter()
+        if kind == "stream_chunk":
+            if first_chunk_at is None:
+                first_chunk_at = now
+                results.ttft.append(now - sent_at)
+            else:
+                results.inter_chunk.append(now - last_chunk_at)
+            last_chunk_at = now
+            results.chunks += 1
+            results.chars += len(data.get("content", ""))
+        elif kind == "queued":
+            results.queued += 1
+        elif kind == "error":
+            if data.get("code"):
+                results.rejected += 1
+            else:
+                results.errors += 1
+            if data.get("code"):
+                return
+        elif kind == "stream_end":
+            results.end_to_end.append(now - sent_at)
+            results.answers += 1
+            return
+
+async def simulated_user(index, args, pdf_files, results, session):
+    client_id = f"loadtest_{uuid.uuid4().hex[:8]}_{index}"
+    rng = random.Random(args.seed + index if args.seed is not None else None)
+    ws_url = args.url.replace("http", "ws", 1) + f"/ws/{client_id}"
+
+    has_pdf = False
+    if pdf_files and rng.random() < args.pdf_ratio:
+        has_pdf = await upload_pdf(session, args.url, client_id, rng.choice(pdf_files), results)
+
+    try:
+        async with session.ws_connect(ws_url, heartbeat=None) as ws:
+            for _ in range(args.turns):
+                if has_pdf:
+                    message = {"action": "pdf_query", "content": rng.choice(PDF_QUESTIONS)}
+                else:
+                    message = {"content": rng.choice(CHAT_QUESTIONS)}
+                await run_turn(ws, message, results, args.timeout)
+                if args.think_time:
+                    await asyncio.sleep(rng.uniform(0, args.think_time))
+    except Exception as e:
+        results.errors += 1
+        print(f"user {index} failed: {e}")
+
+async def main_async(args):
+    pdf_files = sorted(glob.glob(os.path.join(args.pdf_dir, "*.pdf")))
+    results = Results()
+    sampler = ProcessSampler(args.server_pid)
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        sampler.start()
+        start = time.perf_counter()
+        users = []
+        for i in range(args.users):
+            users.append(asyncio.create_task(simulated_user(i, args, pdf_files, results, session)))
+            if args.ramp_up:
+                await asyncio.sleep(args.ramp_up / args.users)
+        await asyncio.gather(*users)
+        duration = time.perf_counter() - start
+        await sampler.stop()
+
+    metrics = None
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"{args.url}/metrics") as response:
+                if response.status == 200:
+                    metrics = await response.json()
+    except Exception:
+        pass
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": vars(args),
+        "duration_sec": duration,
+        "answers": results.answers,
+        "errors": results.errors,
+        "rejected": results.rejected,
+        "queued_notices": results.queued,
+        "throughput": {
+            "answers_per_sec": results.answers / duration if duration else 0,
+            "chunks_per_sec": results.chunks / duration if duration else 0,
+            "chars_per_sec": results.chars / duration if duration else 0
+        },
+        "ttft_sec": summarize(results.ttft),
+        "inter_chunk_latency_sec": summarize(results.inter_chunk),
+        "end_to_end_sec": summarize(results.end_to_end),
+        "upload_sec": summarize(results.upload),
+        "server_process": sampler.report(),
+        "server_metrics": metrics
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8081", help="Địa chỉ chatbot (main.py)")
+    parser.add_argument("--users", type=int, default=50, help="Số kết nối websocket đồng thời")
+    parser.add_argument("--turns", type=int, default=3, help="Số tin nhắn mỗi người dùng")
+    parser.add_argument("--pdf-ratio", type=float, default=0.3, help="Tỉ lệ người dùng tải PDF và hỏi pdf_query")
+    parser.add_argument("--pdf-dir", default=os.path.join(REPO_DIR, "uploads"), help="Thư mục chứa PDF mẫu")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Thời gian nghỉ tối đa giữa hai tin nhắn")
+    parser.add_argument("--ramp-up", type=float, default=0.0, help="Thời gian mở dần tất cả kết nối (giây)")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Timeout cho mỗi lượt hỏi đáp")
+    parser.add_argument("--server-pid", type=int, default=None, help="PID của server để đo CPU/RSS")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--output", default=None, help="File JSON kết quả (mặc định benchmarks/results/<thời gian>.json)")
+    args = parser.parse_args()
+
+    report = asyncio.run(main_async(args))
+
+    output = args.output or os.path.join(BENCH_DIR, "results", f"load_test_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+    print(json.dumps({k: report[k] for k in ("answers", "errors", "rejected", "throughput", "ttft_sec", "end_to_end_sec")}, indent=2))
+    print(f"Saved results to {output}")
+
+if __name__ == "__main__":
+    main()
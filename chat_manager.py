@@ -1,32 +1,90 @@
 # chat_manager.py
-import json
 import logging
 import uuid
 import asyncio
-from typing import Dict, List, Set
+import os
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Set
 from fastapi import WebSocket, WebSocketDisconnect
 
 from ai_service import AIService
-from pdf_service import retrieve_relevant_chunks, get_pdf_db_info, clear_pdf_data
+from stream_coalescer import StreamCoalescer
+from outbound_queue import OutboundQueue
+from ws_protocol import negotiate_protocol
+from prompt_cache import ConversationPrompt
+from token_budget import count_tokens, prompt_budget, trim_history
+from response_cache import response_cache, build_cache_key, build_scope_key, RESPONSE_CACHE_ENABLED
+from generation_scheduler import generation_scheduler, GenerationRejected
+from history_compactor import history_compactor, make_summary_message, HISTORY_COMPACTION_ENABLED
+from pdf_service import retrieve_relevant_chunks, get_pdf_db_info, clear_pdf_data, remove_document
+from embedding_service import embedding_service
 
 logger = logging.getLogger(__name__)
 
+# Cách cắt lịch sử khi vượt budget token: "prefix_stable" cắt xuống HISTORY_TRIM_TARGET_RATIO của budget
+# (ít lần cắt hơn, prefix prompt giữ nguyên qua nhiều lượt để tận dụng prefix cache của VLLM);
+# "legacy" cắt vừa đủ budget ở mỗi lượt
+PROMPT_LAYOUT = os.getenv("PROMPT_LAYOUT", "prefix_stable")
+HISTORY_TRIM_TARGET_RATIO = float(os.getenv("HISTORY_TRIM_TARGET_RATIO", "0.75"))
+# Tỉ lệ tối đa của budget prompt dành cho context PDF, phần còn lại dành cho lịch sử
+PDF_CONTEXT_MAX_RATIO = float(os.getenv("PDF_CONTEXT_MAX_RATIO", "0.5"))
+# Số lượt chat tối đa chờ xử lý của mỗi client
+CHAT_JOB_QUEUE_MAX = int(os.getenv("CHAT_JOB_QUEUE_MAX", "16"))
+
+# Hàng đợi gửi của kết nối mà worker đang chạy phục vụ (đặt trong task worker, các task con thừa hưởng)
+_worker_outbound: ContextVar[Optional[OutboundQueue]] = ContextVar("worker_outbound", default=None)
+
 class ConnectionManager:
     def __init__(self):
         # Lưu trữ các kết nối websocket đang hoạt động
         self.active_connections: Dict[str, WebSocket] = {}
+        # Hàng đợi gửi (một task ghi) của mỗi kết nối
+        self.outbound_queues: Dict[str, OutboundQueue] = {}
         # Lưu trữ lịch sử trò chuyện cho mỗi người dùng
         self.chat_histories: Dict[str, List[Dict[str, str]]] = {}
+        # Prompt ChatML đã render của mỗi hội thoại (chỉ render thêm tin nhắn mới mỗi lượt)
+        self.rendered_prompts: Dict[str, ConversationPrompt] = {}
         # Theo dõi người dùng đang nhận stream
         self.streaming_clients: Set[str] = set()
+        # Task gọi VLLM đang chạy của mỗi client và các client đã yêu cầu dừng
+        self.generation_tasks: Dict[str, asyncio.Task] = {}
+        self.stop_requested: Set[str] = set()
+        # Hàng đợi lượt chat và worker xử lý tuần tự của mỗi kết nối
+        self.chat_jobs: Dict[str, asyncio.Queue] = {}
+        self.chat_workers: Dict[str, asyncio.Task] = {}
+        # Task tóm tắt lịch sử đang chạy nền của mỗi client
+        self.compaction_tasks: Dict[str, asyncio.Task] = {}
     
     async def connect(self, websocket: WebSocket, client_id: str):
         """
         Kết nối một client vào websocket
         """
-        await websocket.accept()
+        # Dùng giao thức nhị phân nếu client đề nghị, mặc định JSON
+        subprotocol = negotiate_protocol(websocket)
+        await websocket.accept(subprotocol=subprotocol)
         self.active_connections[client_id] = websocket
         
+        # Kết nối cũ cùng client_id (nếu còn) không nhận tin nhắn nữa, worker của nó dừng lại
+        previous_queue = self.outbound_queues.pop(client_id, None)
+        if previous_queue is not None:
+            previous_queue.on_closed = None
+            previous_queue.close()
+        self._stop_chat_worker(client_id)
+        
+        outbound = OutboundQueue(
+            websocket,
+            client_id,
+            on_closed=self._on_outbound_closed,
+            binary=subprotocol is not None
+        )
+        self.outbound_queues[client_id] = outbound
+        outbound.start()
+        
+        # Worker xử lý các lượt chat theo thứ tự, vòng nhận tin nhắn không phải chờ stream
+        jobs = asyncio.Queue(maxsize=CHAT_JOB_QUEUE_MAX)
+        self.chat_jobs[client_id] = jobs
+        self.chat_workers[client_id] = asyncio.create_task(self._chat_worker(client_id, jobs, outbound))
+        
         # Khởi tạo lịch sử trò chuyện nếu chưa có
         if client_id not in self.chat_histories:
             self.chat_histories[client_id] = [
@@ -44,20 +102,116 @@ class ConnectionManager:
         
         logger.info(f"Client connected: {client_id}")
     
-    def disconnect(self, client_id: str):
+    def disconnect(self, client_id: str, websocket: WebSocket):
         """
-        Ngắt kết nối websocket
+        Ngắt kết nối websocket. Không làm gì nếu client_id đã kết nối lại bằng websocket khác
+        (socket cũ đóng sau khi kết nối mới đã được đăng ký)
         """
-        if client_id in self.active_connections:
+        if self.active_connections.get(client_id) is websocket:
             # Không cần đóng websocket vì nó đã được đóng bởi FastAPI
             del self.active_connections[client_id]
             
+            # Dừng task ghi, bỏ các tin nhắn còn chờ gửi
+            outbound = self.outbound_queues.pop(client_id, None)
+            if outbound is not None:
+                outbound.close()
+            
             # Xóa client khỏi danh sách đang stream
             if client_id in self.streaming_clients:
                 self.streaming_clients.remove(client_id)
-                
+            
+            self._stop_chat_worker(client_id)
+            
             logger.info(f"Client disconnected: {client_id}")
     
+    def _stop_chat_worker(self, client_id: str):
+        """
+        Bỏ các lượt chat còn chờ và dừng worker của kết nối; lượt đang stream bị dừng nhưng vẫn lưu
+        phần trả lời dở, lượt chưa bắt đầu stream (ví dụ đang chờ slot) bị hủy luôn
+        """
+        jobs = self.chat_jobs.pop(client_id, None)
+        worker = self.chat_workers.pop(client_id, None)
+        if jobs is not None:
+            while not jobs.empty():
+                jobs.get_nowait()
+            jobs.put_nowait(None)
+        if not self.stop_generation(client_id) and worker is not None:
+            worker.cancel()
+    
+    def _connection_replaced(self, client_id: str) -> bool:
+        """
+        Lượt chat đang chạy thuộc về một kết nối cũ đã bị thay bằng kết nối mới cùng client_id:
+        không gửi tin nhắn và không ghi lịch sử nữa (kết nối mới đã có lượt của nó)
+        """
+        owner = _worker_outbound.get()
+        current = self.outbound_queues.get(client_id)
+        return owner is not None and current is not None and current is not owner
+    
+    def _on_outbound_closed(self, client_id: str):
+        """
+        Task ghi dừng vì socket lỗi hoặc client đọc quá chậm (policy "disconnect")
+        """
+        outbound = self.outbound_queues.get(client_id)
+        if outbound is not None:
+            self.disconnect(client_id, outbound.websocket)
+    
+    def outbound_snapshot(self) -> Dict[str, Dict]:
+        """
+        Độ sâu hàng đợi gửi và thống kê slow consumer của từng kết nối
+        """
+        return {client_id: outbound.snapshot() for client_id, outbound in self.outbound_queues.items()}
+    
+    def stop_generation(self, client_id: str) -> bool:
+        """
+        Dừng lượt sinh đang chạy của client: hủy task gọi VLLM, kết nối HTTP tới VLLM bị đóng
+        nên request được hủy ngay phía backend
+        """
+        task = self.generation_tasks.get(client_id)
+        if task is None or task.done():
+            return False
+        self.stop_requested.add(client_id)
+        task.cancel()
+        logger.info(f"Generation stopped for client {client_id}")
+        return True
+    
+    async def submit_chat(self, client_id: str, message_content: str = None, action: str = None,
+                          document_ids: Optional[List[str]] = None) -> bool:
+        """
+        Đưa một lượt chat (hoặc thao tác thay đổi lịch sử) vào hàng đợi của client.
+        Worker của client xử lý lần lượt theo thứ tự gửi, vòng nhận tin nhắn không bị chặn.
+        document_ids: với pdf_query, chỉ tìm trong các tài liệu này.
+        """
+        jobs = self.chat_jobs.get(client_id)
+        if jobs is None:
+            logger.warning(f"Client {client_id} is no longer connected")
+            return False
+        try:
+            jobs.put_nowait((message_content, action, document_ids))
+        except asyncio.QueueFull:
+            logger.warning(f"Chat job queue full for client {client_id}")
+            await self.send_message(client_id, {
+                "type": "error",
+                "code": "too_many_requests",
+                "message": "Bạn đang gửi quá nhiều tin nhắn. Vui lòng chờ câu trả lời hiện tại."
+            })
+            return False
+        return True
+    
+    async def _chat_worker(self, client_id: str, jobs: asyncio.Queue, outbound: OutboundQueue):
+        """
+        Xử lý tuần tự các lượt chat của một kết nối cho tới khi nhận None (ngắt kết nối)
+        """
+        _worker_outbound.set(outbound)
+        while True:
+            job = await jobs.get()
+            if job is None:
+                return
+            message_content, action, document_ids = job
+            try:
+                await self.handle_chat(client_id, message_content, action, document_ids)
+            except Exception as e:
+                logger.exception(f"Error in chat worker for client {client_id}: {str(e)}")
+    
     def clear_history(self, client_id: str):
         """
         Xóa lịch sử trò chuyện của một client
@@ -76,57 +230,249 @@ class ConnectionManager:
                 7. Đảm bảo code được định dạng đúng và dễ đọc.
                 """}
             ]
+            self.invalidate_prompt(client_id)
             logger.info(f"Chat history cleared for client: {client_id}")
     
-    async def send_message(self, client_id: str, message: Dict):
+    def truncate_history(self, client_id: str, reserved_tokens: int = 0):
+        """
+        Cắt các lượt cũ nhất để lịch sử vừa với context_window - max_tokens - reserved_tokens,
+        luôn giữ system message
         """
-        Gửi tin nhắn đến một client cụ thể
+        history = self.chat_histories[client_id]
+        budget = prompt_budget(reserved_tokens=reserved_tokens)
+        target = None if PROMPT_LAYOUT == "legacy" else int(budget * HISTORY_TRIM_TARGET_RATIO)
+        
+        trimmed = trim_history(history, budget, target)
+        if trimmed is not history:
+            self.chat_histories[client_id] = trimmed
+            self.invalidate_prompt(client_id)
+            logger.info(
+                f"History truncated for client {client_id}: "
+                f"{len(history) - 1} -> {len(trimmed) - 1} messages (budget {budget} tokens)"
+            )
+    
+    def invalidate_prompt(self, client_id: str):
+        """
+        Bỏ prompt đã render khi lịch sử bị cắt hoặc xóa
+        """
+        rendered = self.rendered_prompts.get(client_id)
+        if rendered is not None:
+            rendered.invalidate()
+    
+    def build_prompt(self, client_id: str, last_message: Dict[str, str] = None) -> str:
+        """
+        Lấy prompt ChatML của lịch sử hiện tại, chỉ render các tin nhắn mới từ lượt trước.
+        Nếu có last_message, nó thay cho tin nhắn cuối của lịch sử (ví dụ câu hỏi kèm context PDF)
+        mà không cần sao chép lịch sử.
+        """
+        history = self.chat_histories[client_id]
+        rendered = self.rendered_prompts.get(client_id)
+        if rendered is None:
+            rendered = self.rendered_prompts[client_id] = ConversationPrompt()
+        if last_message is not None:
+            return rendered.render(history, upto=len(history) - 1, tail=last_message)
+        return rendered.render(history)
+    
+    def schedule_compaction(self, client_id: str):
+        """
+        Khởi động task nền tóm tắt các lượt cũ nếu lịch sử đã vượt ngưỡng (không chặn lượt chat)
+        """
+        if not HISTORY_COMPACTION_ENABLED:
+            return
+        running = self.compaction_tasks.get(client_id)
+        if running is not None and not running.done():
+            return
+        history = self.chat_histories.get(client_id)
+        if history is None or not history_compactor.needs_compaction(history):
+            return
+        self.compaction_tasks[client_id] = asyncio.create_task(self.compact_history(client_id))
+    
+    async def compact_history(self, client_id: str):
+        """
+        Thay các lượt cũ nhất bằng một tin nhắn tóm tắt. Nếu máy chủ bận hoặc lịch sử đã bị
+        cắt/xóa trong lúc tóm tắt thì bỏ qua, truncate_history vẫn giữ lịch sử trong budget.
         """
         try:
-            if client_id in self.active_connections:
-                websocket = self.active_connections[client_id]
-                # Kiểm tra xem websocket có còn mở không
-                if websocket.client_state.CONNECTED:
-                    await websocket.send_text(json.dumps(message))
-                else:
-                    logger.warning(f"Cannot send message to client {client_id}: WebSocket is closed")
-                    # Xóa kết nối đã đóng
-                    self.disconnect(client_id)
-        except RuntimeError as e:
-            if "Cannot call 'send' once a close message has been sent" in str(e):
-                logger.warning(f"WebSocket for client {client_id} was closed during send operation")
-                self.disconnect(client_id)
-            else:
-                raise
+            history = self.chat_histories.get(client_id)
+            if history is None:
+                return
+            split = history_compactor.split_point(history)
+            if split == 0:
+                return
+            old_messages = history[1:split]
+            
+            summary = await history_compactor.summarize(client_id, old_messages)
+            if summary is None:
+                return
+            
+            # Lịch sử có thể đã thay đổi trong lúc tóm tắt (các lượt mới chỉ được nối thêm vào cuối)
+            if (self.chat_histories.get(client_id) is not history or len(history) < split
+                    or history[split - 1] is not old_messages[-1]):
+                logger.info(f"History changed during compaction for client {client_id}, discarding summary")
+                return
+            
+            summary_message = make_summary_message(summary)
+            self.chat_histories[client_id] = [history[0], summary_message] + history[split:]
+            self.invalidate_prompt(client_id)
+            history_compactor.record(old_messages, summary_message)
+            logger.info(f"History compacted for client {client_id}: {len(old_messages)} messages summarized")
+        except Exception as e:
+            logger.exception(f"Error compacting history for client {client_id}: {str(e)}")
+        finally:
+            self.compaction_tasks.pop(client_id, None)
+    
+    def response_cache_params(self, history: List[Dict], chunk_ids: List[str] = None):
+        """
+        Tính key cache (exact) và, với câu hỏi một lượt, câu hỏi + phạm vi cho tầng ngữ nghĩa
+        """
+        key = build_cache_key(history, chunk_ids)
+        if len(history) == 2 and history[-1]["role"] == "user":
+            return key, history[-1]["content"], build_scope_key(history[0]["content"], chunk_ids)
+        return key, None, None
+    
+    async def send_cached_response(self, client_id: str, answer: str) -> str:
+        """
+        Gửi câu trả lời từ cache theo đúng giao thức stream
+        """
+        self.streaming_clients.add(client_id)
+        await self.send_message(client_id, {
+            "type": "stream_start"
+        })
+        await self.stream_callback(client_id, answer)
+        
+        if client_id in self.active_connections:
+            await self.send_message(client_id, {
+                "type": "stream_end"
+            })
+        
+        if client_id in self.streaming_clients:
+            self.streaming_clients.remove(client_id)
+        
+        if not self._connection_replaced(client_id):
+            self.chat_histories[client_id].append({"role": "assistant", "content": answer})
+        logger.info(f"Served cached response for client {client_id}")
+        return answer
+    
+    async def send_message(self, client_id: str, message: Dict):
+        """
+        Gửi tin nhắn đến một client cụ thể qua hàng đợi gửi của kết nối (giữ đúng thứ tự)
+        """
+        if self._connection_replaced(client_id):
+            return
+        outbound = self.outbound_queues.get(client_id)
+        if outbound is None or not outbound.put(message):
+            logger.warning(f"Cannot send message to client {client_id}: WebSocket is closed")
     
     async def stream_callback(self, client_id: str, chunk: str):
         """
         Callback để xử lý từng chunk của stream response
         """
+        if client_id in self.streaming_clients:
+            await self.send_message(client_id, {
+                "type": "stream_chunk",
+                "content": chunk
+            })
+    
+    async def stream_ai_response(self, client_id: str, prompt: str):
+        """
+        Xin slot từ scheduler, stream prompt đã render và gửi câu trả lời của AI tới client.
+        Trả về (câu trả lời, completed); completed = False nếu bị dừng hoặc quá thời gian chờ.
+        Trả về (None, False) nếu request bị từ chối vì máy chủ quá tải (tin nhắn của người dùng bị gỡ khỏi lịch sử).
+        """
+        try:
+            await generation_scheduler.acquire(
+                client_id,
+                on_queued=lambda position: self.send_message(client_id, {
+                    "type": "queued",
+                    "position": position
+                })
+            )
+        except GenerationRejected as e:
+            # Gỡ câu hỏi chưa được trả lời khỏi lịch sử
+            history = self.chat_histories.get(client_id)
+            if history and history[-1]["role"] == "user":
+                history.pop()
+            await self.send_message(client_id, {
+                "type": "error",
+                "code": e.reason,
+                "message": "Máy chủ đang quá tải. Vui lòng thử lại sau ít phút."
+            })
+            return None, False
+        
+        completed = True
         try:
-            if client_id in self.active_connections and client_id in self.streaming_clients:
-                # Kiểm tra trạng thái kết nối trước khi gửi
-                websocket = self.active_connections[client_id]
-                if hasattr(websocket, 'client_state') and websocket.client_state.CONNECTED:
+            # Đánh dấu client đang nhận stream
+            self.streaming_clients.add(client_id)
+            
+            # Gửi message bắt đầu stream
+            await self.send_message(client_id, {
+                "type": "stream_start"
+            })
+            
+            # Thiết lập timeout cho toàn bộ quá trình xử lý
+            try:
+                # Gom các delta thành ít frame stream_chunk hơn
+                coalescer = StreamCoalescer(lambda text: self.stream_callback(client_id, text))
+                # Giữ lại các delta đã nhận để còn phần trả lời dở nếu bị dừng giữa chừng
+                received_parts: List[str] = []
+                
+                def on_delta(delta: str):
+                    received_parts.append(delta)
+                    coalescer.push(delta)
+                
+                # Gọi AI để lấy phản hồi với streaming và timeout
+                ai_response_task = asyncio.create_task(
+                    AIService.generate_response_stream(None, on_delta, affinity_key=client_id, prompt=prompt)
+                )
+                self.generation_tasks[client_id] = ai_response_task
+                
+                try:
+                    # Đặt timeout 60 giây cho toàn bộ quá trình
+                    ai_response = await asyncio.wait_for(ai_response_task, timeout=60)
+                except asyncio.CancelledError:
+                    if client_id not in self.stop_requested:
+                        raise
+                    # Người dùng dừng hoặc ngắt kết nối: giữ phần trả lời đã nhận
+                    ai_response = "".join(received_parts).strip()
+                    completed = False
+                finally:
+                    # Lượt của kết nối mới (sau khi kết nối lại) có thể đã đăng ký task của nó
+                    if self.generation_tasks.get(client_id) is ai_response_task:
+                        del self.generation_tasks[client_id]
+                        self.stop_requested.discard(client_id)
+                    # Luôn flush phần còn lại trước stream_end
+                    await coalescer.close()
+                
+            except asyncio.TimeoutError:
+                logger.warning(f"Response generation timeout for client {client_id}")
+                # Gửi thông báo timeout
+                try:
                     await self.send_message(client_id, {
                         "type": "stream_chunk",
-                        "content": chunk
+                        "content": "\n\n[Quá thời gian chờ. Phản hồi bị cắt ngắn.]"
                     })
-                else:
-                    logger.warning(f"Cannot send stream chunk to client {client_id}: WebSocket is closed")
-                    # Xóa client khỏi danh sách streaming
-                    if client_id in self.streaming_clients:
-                        self.streaming_clients.remove(client_id)
-        except RuntimeError as e:
-            if "Cannot call 'send' once a close message has been sent" in str(e):
-                logger.warning(f"WebSocket for client {client_id} was closed during streaming")
-                # Xóa client khỏi danh sách streaming
-                if client_id in self.streaming_clients:
-                    self.streaming_clients.remove(client_id)
-            else:
-                raise
+                except Exception as e:
+                    logger.error(f"Error sending timeout message: {str(e)}")
+                ai_response = "(Phản hồi bị cắt ngắn do quá thời gian chờ)"
+                completed = False
+            
+            # Kiểm tra xem client có còn kết nối không
+            if client_id in self.active_connections:
+                # Gửi message kết thúc stream
+                await self.send_message(client_id, {
+                    "type": "stream_end"
+                })
+            
+            # Xóa client khỏi danh sách đang stream
+            if client_id in self.streaming_clients:
+                self.streaming_clients.remove(client_id)
+            
+            return ai_response, completed
+        finally:
+            generation_scheduler.release(client_id)
     
-    async def handle_chat(self, client_id: str, message_content: str = None, action: str = None):
+    async def handle_chat(self, client_id: str, message_content: str = None, action: str = None,
+                          document_ids: Optional[List[str]] = None):
         """
         Xử lý tin nhắn chat và gọi AI để phản hồi với streaming
         """
@@ -143,6 +489,15 @@ class ConnectionManager:
                 })
                 return
                 
+            # Xử lý stop_generation
+            if action == "stop_generation":
+                stopped = self.stop_generation(client_id)
+                await self.send_message(client_id, {
+                    "type": "generation_stopped",
+                    "stopped": stopped
+                })
+                return
+            
             # Xử lý clear history
             if action == "clear_history":
                 self.clear_history(client_id)
@@ -151,7 +506,7 @@ class ConnectionManager:
             
             # Xử lý get_pdf_info
             if action == "get_pdf_info":
-                pdf_info = get_pdf_db_info(client_id)
+                pdf_info = await asyncio.to_thread(get_pdf_db_info, client_id)
                 await self.send_message(client_id, {
                     "type": "pdf_info",
                     "info": pdf_info
@@ -160,36 +515,56 @@ class ConnectionManager:
             
             # Xử lý clear_pdf_data
             if action == "clear_pdf_data":
-                clear_pdf_data(client_id)
+                await asyncio.to_thread(clear_pdf_data, client_id)
                 await self.send_message(client_id, {
                     "type": "pdf_cleared"
                 })
                 return
             
+            # Xử lý remove_pdf: xóa một tài liệu khỏi workspace
+            if action == "remove_pdf":
+                removed = [
+                    doc_id for doc_id in document_ids or []
+                    if await asyncio.to_thread(remove_document, client_id, doc_id)
+                ]
+                await self.send_message(client_id, {
+                    "type": "pdf_removed",
+                    "document_ids": removed,
+                    "info": await asyncio.to_thread(get_pdf_db_info, client_id)
+                })
+                return
+            
             # Xử lý pdf_query
             if action == "pdf_query" and message_content:
                 # Thêm tin nhắn của người dùng vào lịch sử
                 self.chat_histories[client_id].append({"role": "user", "content": message_content})
                 
-                # Tìm kiếm các đoạn văn bản liên quan từ PDF
-                relevant_chunks = retrieve_relevant_chunks(message_content, client_id)
-                
-                # Đánh dấu client đang nhận stream
-                self.streaming_clients.add(client_id)
-                
-                # Gửi message bắt đầu stream
-                await self.send_message(client_id, {
-                    "type": "stream_start"
-                })
+                # Tìm kiếm các đoạn văn bản liên quan từ PDF: câu hỏi được encode chung batch với các
+                # client khác, tìm trong FAISS chạy trong thread riêng để không chặn event loop
+                query_vector = await embedding_service.embed(message_content)
+                relevant_chunks = await asyncio.to_thread(
+                    retrieve_relevant_chunks, message_content, client_id,
+                    document_ids=document_ids, query_vector=query_vector
+                )
                 
                 try:
                     # Chuẩn bị prompt với context từ PDF
                     enhanced_prompt = message_content
                     
                     if relevant_chunks:
+                        # Context PDF và lịch sử dùng chung một budget token: chunk được thêm theo
+                        # thứ tự liên quan cho đến khi hết phần dành cho PDF
+                        context_budget = int(prompt_budget() * PDF_CONTEXT_MAX_RATIO)
                         context = "Thông tin từ tài liệu PDF:\n\n"
+                        context_tokens = count_tokens(context)
                         for i, chunk in enumerate(relevant_chunks):
-                            context += f"{i+1}. {chunk['content']}\n\n"
+                            entry = f"{i+1}. {chunk['content']}\n\n"
+                            entry_tokens = count_tokens(entry)
+                            if context_tokens + entry_tokens > context_budget:
+                                logger.info(f"PDF context budget reached for client {client_id}: using {i} chunks")
+                                break
+                            context += entry
+                            context_tokens += entry_tokens
                         
                         # Thêm context vào prompt
                         enhanced_prompt = f"{message_content}\n\n{context}\n\nTrả lời dựa trên thông tin từ tài liệu. Nếu thông tin không có trong tài liệu, hãy nói rõ điều đó. Không đề cập đến các tham chiếu hoặc nguồn trong câu trả lời."
@@ -197,47 +572,40 @@ class ConnectionManager:
                         # Nếu không có chunk nào liên quan
                         enhanced_prompt = f"{message_content}\n\n(Lưu ý: Không tìm thấy thông tin liên quan trong tài liệu PDF đã tải lên. Vui lòng kiểm tra lại câu hỏi hoặc tải lên tài liệu phù hợp.)"
                     
-                    # Thiết lập timeout cho toàn bộ quá trình xử lý
-                    try:
-                        # Tạo chat history tạm thời với enhanced_prompt
-                        temp_history = self.chat_histories[client_id][:-1] + [{"role": "user", "content": enhanced_prompt}]
-                        
-                        # Gọi AI để lấy phản hồi với streaming và timeout
-                        ai_response_task = asyncio.create_task(
-                            AIService.generate_response_stream(
-                                temp_history,
-                                lambda chunk: asyncio.create_task(self.stream_callback(client_id, chunk))
-                            )
+                    # Cắt lịch sử để vừa phần budget còn lại sau context PDF
+                    pdf_context_tokens = count_tokens(enhanced_prompt) - count_tokens(message_content)
+                    self.truncate_history(client_id, reserved_tokens=pdf_context_tokens)
+                    
+                    # Tra cache câu trả lời theo lịch sử + các chunk PDF được truy xuất
+                    if RESPONSE_CACHE_ENABLED:
+                        chunk_ids = [
+                            f"{chunk['metadata']['source_file']}#{chunk['metadata']['chunk_index']}"
+                            for chunk in relevant_chunks
+                        ]
+                        cache_key, cache_question, cache_scope = self.response_cache_params(
+                            self.chat_histories[client_id], chunk_ids
                         )
-                        
-                        # Đặt timeout 60 giây cho toàn bộ quá trình
-                        ai_response = await asyncio.wait_for(ai_response_task, timeout=60)
-                        
-                    except asyncio.TimeoutError:
-                        logger.warning(f"Response generation timeout for client {client_id}")
-                        # Gửi thông báo timeout
-                        try:
-                            await self.send_message(client_id, {
-                                "type": "stream_chunk",
-                                "content": "\n\n[Quá thời gian chờ. Phản hồi bị cắt ngắn.]"
-                            })
-                        except Exception as e:
-                            logger.error(f"Error sending timeout message: {str(e)}")
-                        ai_response = "(Phản hồi bị cắt ngắn do quá thời gian chờ)"
+                        cached_answer, cache_vector = await response_cache.lookup(cache_key, cache_question, cache_scope)
+                        if cached_answer is not None:
+                            return await self.send_cached_response(client_id, cached_answer)
                     
-                    # Kiểm tra xem client có còn kết nối không
-                    if client_id in self.active_connections:
-                        # Gửi message kết thúc stream
-                        await self.send_message(client_id, {
-                            "type": "stream_end"
-                        })
+                    # Prompt với enhanced_prompt: lịch sử (prefix ổn định, đã render sẵn) đi trước,
+                    # context PDF của lượt này thay cho câu hỏi ở tin nhắn cuối cùng
+                    prompt = self.build_prompt(client_id, last_message={"role": "user", "content": enhanced_prompt})
                     
-                    # Xóa client khỏi danh sách đang stream
-                    if client_id in self.streaming_clients:
-                        self.streaming_clients.remove(client_id)
+                    ai_response, completed = await self.stream_ai_response(client_id, prompt)
+                    if ai_response is None:
+                        return
+                    
+                    # Lưu câu trả lời hợp lệ vào cache
+                    if RESPONSE_CACHE_ENABLED and completed and not AIService.is_error_response(ai_response):
+                        await response_cache.store(cache_key, ai_response, cache_question, cache_scope, cache_vector)
                     
                     # Thêm phản hồi của AI vào lịch sử
+                    if self._connection_replaced(client_id):
+                        return ai_response
                     self.chat_histories[client_id].append({"role": "assistant", "content": ai_response})
+                    self.schedule_compaction(client_id)
                     
                     return ai_response
                     
@@ -272,57 +640,28 @@ class ConnectionManager:
                 self.chat_histories[client_id].append({"role": "user", "content": message_content})
                 
                 # Giới hạn lịch sử để tránh context quá dài
-                # Giữ system message và 10 tin nhắn gần nhất
-                if len(self.chat_histories[client_id]) > 11:  # 1 system + 10 messages
-                    system_message = self.chat_histories[client_id][0]
-                    self.chat_histories[client_id] = [system_message] + self.chat_histories[client_id][-10:]
+                self.truncate_history(client_id)
                 
-                # Đánh dấu client đang nhận stream
-                self.streaming_clients.add(client_id)
+                # Tra cache câu trả lời theo lịch sử hội thoại
+                if RESPONSE_CACHE_ENABLED:
+                    cache_key, cache_question, cache_scope = self.response_cache_params(self.chat_histories[client_id])
+                    cached_answer, cache_vector = await response_cache.lookup(cache_key, cache_question, cache_scope)
+                    if cached_answer is not None:
+                        return await self.send_cached_response(client_id, cached_answer)
                 
-                # Gửi message bắt đầu stream
-                await self.send_message(client_id, {
-                    "type": "stream_start"
-                })
+                ai_response, completed = await self.stream_ai_response(client_id, self.build_prompt(client_id))
+                if ai_response is None:
+                    return
                 
-                # Thiết lập timeout cho toàn bộ quá trình xử lý
-                try:
-                    # Gọi AI để lấy phản hồi với streaming và timeout
-                    ai_response_task = asyncio.create_task(
-                        AIService.generate_response_stream(
-                            self.chat_histories[client_id],
-                            lambda chunk: asyncio.create_task(self.stream_callback(client_id, chunk))
-                        )
-                    )
-                    
-                    # Đặt timeout 60 giây cho toàn bộ quá trình
-                    ai_response = await asyncio.wait_for(ai_response_task, timeout=60)
-                    
-                except asyncio.TimeoutError:
-                    logger.warning(f"Response generation timeout for client {client_id}")
-                    # Gửi thông báo timeout
-                    try:
-                        await self.send_message(client_id, {
-                            "type": "stream_chunk",
-                            "content": "\n\n[Quá thời gian chờ. Phản hồi bị cắt ngắn.]"
-                        })
-                    except Exception as e:
-                        logger.error(f"Error sending timeout message: {str(e)}")
-                    ai_response = "(Phản hồi bị cắt ngắn do quá thời gian chờ)"
-                
-                # Kiểm tra xem client có còn kết nối không
-                if client_id in self.active_connections:
-                    # Gửi message kết thúc stream
-                    await self.send_message(client_id, {
-                        "type": "stream_end"
-                    })
-                
-                # Xóa client khỏi danh sách đang stream
-                if client_id in self.streaming_clients:
-                    self.streaming_clients.remove(client_id)
+                # Lưu câu trả lời hợp lệ vào cache
+                if RESPONSE_CACHE_ENABLED and completed and not AIService.is_error_response(ai_response):
+                    await response_cache.store(cache_key, ai_response, cache_question, cache_scope, cache_vector)
                 
                 # Thêm phản hồi của AI vào lịch sử
+                if self._connection_replaced(client_id):
+                    return ai_response
                 self.chat_histories[client_id].append({"role": "assistant", "content": ai_response})
+                self.schedule_compaction(client_id)
                 
                 return ai_response
                 
@@ -0,0 +1,165 @@
+# document_cache.py
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Bật/tắt cache kết quả xử lý PDF theo nội dung file
+DOC_CACHE_ENABLED = os.getenv("DOC_CACHE_ENABLED", "1") == "1"
+# Thư mục lưu cache (dùng chung cho mọi người dùng)
+DOC_CACHE_DIR = os.getenv("DOC_CACHE_DIR", os.path.join("cache", "documents"))
+# Dung lượng tối đa của cache trên đĩa (MB), vượt quá thì xóa các mục dùng lâu nhất
+DOC_CACHE_MAX_MB = int(os.getenv("DOC_CACHE_MAX_MB", "1024"))
+
+# Tăng khi thay đổi định dạng lưu để bỏ qua các mục cũ
+CACHE_FORMAT_VERSION = 1
+
+CHUNKS_FILE = "chunks.json"
+VECTORS_FILE = "vectors.npy"
+
+def hash_file(file_path: str, block_size: int = 1024 * 1024) -> str:
+    """SHA-256 của nội dung file"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def make_cache_key(content_hash: str, model_id: str, params: Dict) -> str:
+    """Khóa cache = nội dung file + model embedding + tham số chia chunk"""
+    payload = json.dumps({
+        "version": CACHE_FORMAT_VERSION,
+        "content": content_hash,
+        "model": model_id,
+        "params": params
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class DocumentCache:
+    """
+    Cache trên đĩa các chunk và vector của file PDF đã xử lý, đánh địa chỉ theo nội dung.
+    Mỗi mục là một thư mục gồm chunks.json và vectors.npy (đọc bằng memory mapping).
+    Thời gian dùng gần nhất được lưu bằng mtime của thư mục để xóa theo LRU khi vượt dung lượng.
+    """
+
+    def __init__(self, cache_dir: str = DOC_CACHE_DIR, max_bytes: int = DOC_CACHE_MAX_MB * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # key -> [dung lượng (bytes), thời gian dùng gần nhất]; được nạp từ đĩa ở lần dùng đầu tiên
+        self.entries: Optional[Dict[str, List[float]]] = None
+        # Thống kê
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def _entry_dir(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def _load_entries(self):
+        if self.entries is not None:
+            return
+        self.entries = {}
+        os.makedirs(self.cache_dir, exist_ok=True)
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith(".") or not os.path.isdir(path):
+                continue
+            size = sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+            self.entries[name] = [size, os.path.getmtime(path)]
+
+    def get(self, key: str) -> Optional[Tuple[List[Dict], np.ndarray, Dict]]:
+        """
+        Trả về (chunks, vectors, info) nếu có trong cache, vectors là mảng memory-mapped chỉ đọc
+        """
+        with self.lock:
+            self._load_entries()
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            entry_dir = self._entry_dir(key)
+            try:
+                with open(os.path.join(entry_dir, CHUNKS_FILE), "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                vectors = np.load(os.path.join(entry_dir, VECTORS_FILE), mmap_mode="r")
+                now = time.time()
+                os.utime(entry_dir, (now, now))
+                self.entries[key][1] = now
+            except Exception as e:
+                logger.warning(f"Removing unreadable document cache entry {key}: {str(e)}")
+                self._remove(key)
+                self.misses += 1
+                return None
+            self.hits += 1
+            return data["chunks"], vectors, data["info"]
+
+    def put(self, key: str, chunks: List[Dict], vectors: np.ndarray, info: Dict):
+        """Lưu kết quả xử lý một file, ghi vào thư mục tạm rồi đổi tên để không ai đọc được mục ghi dở"""
+        with self.lock:
+            self._load_entries()
+            if key in self.entries:
+                return
+        tmp_dir = os.path.join(self.cache_dir, f".tmp-{uuid.uuid4().hex}")
+        try:
+            os.makedirs(tmp_dir)
+            with open(os.path.join(tmp_dir, CHUNKS_FILE), "w", encoding="utf-8") as f:
+                json.dump({"chunks": chunks, "info": info}, f, ensure_ascii=False)
+            np.save(os.path.join(tmp_dir, VECTORS_FILE), np.ascontiguousarray(vectors, dtype=np.float32))
+            size = sum(entry.stat().st_size for entry in os.scandir(tmp_dir))
+            with self.lock:
+                if key in self.entries:
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+                    return
+                os.rename(tmp_dir, self._entry_dir(key))
+                self.entries[key] = [size, time.time()]
+                self.stores += 1
+                self._evict()
+        except Exception as e:
+            logger.error(f"Error writing document cache entry {key}: {str(e)}")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _remove(self, key: str):
+        shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+        self.entries.pop(key, None)
+
+    def _evict(self):
+        total = sum(size for size, _ in self.entries.values())
+        if total <= self.max_bytes:
+            return
+        # Xóa các mục dùng lâu nhất cho tới khi dưới giới hạn
+        for key, (size, _) in sorted(self.entries.items(), key=lambda item: item[1][1]):
+            if total <= self.max_bytes:
+                break
+            self._remove(key)
+            total -= size
+            self.evictions += 1
+            logger.info(f"Evicted document cache entry {key} ({size} bytes)")
+
+    def snapshot(self) -> Dict:
+        with self.lock:
+            entries = self.entries or {}
+            lookups = self.hits + self.misses
+            return {
+                "enabled": DOC_CACHE_ENABLED,
+                "entries": len(entries),
+                "bytes": sum(size for size, _ in entries.values()),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "stores": self.stores,
+                "evictions": self.evictions
+            }
+
+# Instance dùng chung
+document_cache = DocumentCache()
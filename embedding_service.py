@@ -0,0 +1,197 @@
+# embedding_service.py
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Deque, Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Thời gian gom các câu hỏi cần encode thành một batch (ms) và kích thước batch tối đa
+EMBED_BATCH_WINDOW_MS = float(os.getenv("EMBED_BATCH_WINDOW_MS", "5"))
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "32"))
+# Số batch được encode song song (mỗi batch một thread)
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "1"))
+# Số vector câu hỏi gần đây được giữ trong cache LRU (0 = tắt)
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "2048"))
+
+def _default_encode(texts: List[str]) -> np.ndarray:
+    from pdf_service import embedding_model
+    return embedding_model.encode(texts, batch_size=len(texts))
+
+class EmbeddingService:
+    """
+    Encode câu hỏi theo micro-batch: các coroutine gọi embed() đồng thời được gom trong
+    EMBED_BATCH_WINDOW_MS (hoặc tới khi đủ EMBED_MAX_BATCH câu), encode bằng một lần gọi model
+    trên thread riêng rồi trả kết quả cho từng coroutine. Khi mọi worker đang bận, câu hỏi mới
+    tiếp tục được gom và được encode ngay khi có worker rảnh, nên batch lớn dần theo tải.
+    Khi không có request nào khác trong khoảng EMBED_BATCH_WINDOW_MS trước đó, câu hỏi được encode
+    ngay (không có gì để gom nên không phải chờ thêm).
+    Vector trả về đã chuẩn hóa (cosine similarity = tích vô hướng) và chỉ đọc.
+    """
+
+    def __init__(
+        self,
+        encode: Callable[[List[str]], np.ndarray] = _default_encode,
+        window: float = EMBED_BATCH_WINDOW_MS / 1000,
+        max_batch: int = EMBED_MAX_BATCH,
+        workers: int = EMBED_WORKERS,
+        cache_size: int = EMBED_CACHE_SIZE
+    ):
+        self.encode = encode
+        self.window = window
+        self.max_batch = max(1, max_batch)
+        self.workers = max(1, workers)
+        self.cache_size = cache_size
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        # Các câu đang chờ encode và đang được encode (câu trùng nhau dùng chung một future)
+        self._pending: "OrderedDict[str, asyncio.Future]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._running = 0
+        self._last_arrival = 0.0
+        # Thống kê
+        self.requests = 0
+        self.cache_hits = 0
+        self.deduplicated = 0
+        self.batches = 0
+        self.errors = 0
+        self.batch_sizes: Dict[int, int] = {}
+        self._latencies: Deque[float] = deque(maxlen=1000)
+        self._encode_times: Deque[float] = deque(maxlen=1000)
+
+    async def embed(self, text: str) -> np.ndarray:
+        """Vector (đã chuẩn hóa) của text, encode chung batch với các request đồng thời khác"""
+        start = time.perf_counter()
+        self.requests += 1
+        vector = self._cache.get(text)
+        if vector is not None:
+            self._cache.move_to_end(text)
+            self.cache_hits += 1
+            self._latencies.append(time.perf_counter() - start)
+            return vector
+
+        future = self._pending.get(text) or self._inflight.get(text)
+        if future is not None:
+            self.deduplicated += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self._pending[text] = future
+            self._schedule()
+        # shield: request bị hủy (ví dụ dừng câu trả lời) không hủy kết quả của các request dùng chung
+        vector = await asyncio.shield(future)
+        self._latencies.append(time.perf_counter() - start)
+        return vector
+
+    def _schedule(self):
+        now = time.perf_counter()
+        idle = now - self._last_arrival > self.window
+        self._last_arrival = now
+        if self._running >= self.workers:
+            # Batch tiếp theo được encode khi một worker xong việc
+            return
+        if len(self._pending) >= self.max_batch or idle:
+            self._dispatch()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._on_window)
+
+    def _on_window(self):
+        self._timer = None
+        if self._pending and self._running < self.workers:
+            self._dispatch()
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch = []
+        while self._pending and len(batch) < self.max_batch:
+            text, future = self._pending.popitem(last=False)
+            self._inflight[text] = future
+            batch.append((text, future))
+        self._running += 1
+        asyncio.get_running_loop().create_task(self._run_batch(batch))
+
+    async def _run_batch(self, batch):
+        texts = [text for text, _ in batch]
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="embed")
+        start = time.perf_counter()
+        try:
+            vectors = await asyncio.get_running_loop().run_in_executor(self._executor, self._encode_batch, texts)
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Error encoding batch of {len(texts)} queries: {str(e)}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        else:
+            self._encode_times.append(time.perf_counter() - start)
+            self.batches += 1
+            self.batch_sizes[len(texts)] = self.batch_sizes.get(len(texts), 0) + 1
+            for (text, future), vector in zip(batch, vectors):
+                self._store(text, vector)
+                if not future.done():
+                    future.set_result(vector)
+        finally:
+            for text, _ in batch:
+                self._inflight.pop(text, None)
+            self._running -= 1
+            if self._pending:
+                # Các câu hỏi đến trong lúc encode đã chờ đủ lâu: encode ngay
+                if len(self._pending) >= self.max_batch or self._timer is None:
+                    self._dispatch()
+
+    def _encode_batch(self, texts: List[str]) -> np.ndarray:
+        vectors = np.asarray(self.encode(texts), dtype=np.float32).reshape(len(texts), -1)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms > 0, norms, 1)
+        vectors.flags.writeable = False
+        return vectors
+
+    def _store(self, text: str, vector: np.ndarray):
+        if self.cache_size <= 0:
+            return
+        self._cache[text] = vector
+        self._cache.move_to_end(text)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def snapshot(self) -> Dict:
+        latencies = sorted(self._latencies)
+        encode_times = sorted(self._encode_times)
+
+        def percentile(values, q):
+            return round(values[min(len(values) - 1, int(len(values) * q))] * 1000, 2) if values else 0.0
+
+        encoded = sum(size * count for size, count in self.batch_sizes.items())
+        return {
+            "requests": self.requests,
+            "cache_hits": self.cache_hits,
+            "cache_entries": len(self._cache),
+            "deduplicated": self.deduplicated,
+            "batches": self.batches,
+            "errors": self.errors,
+            "pending": len(self._pending),
+            "avg_batch_size": round(encoded / self.batches, 2) if self.batches else 0.0,
+            "batch_size_histogram": {str(size): self.batch_sizes[size] for size in sorted(self.batch_sizes)},
+            "latency_ms_p50": percentile(latencies, 0.5),
+            "latency_ms_p95": percentile(latencies, 0.95),
+            "latency_ms_p99": percentile(latencies, 0.99),
+            "encode_ms_p50": percentile(encode_times, 0.5),
+            "encode_ms_p95": percentile(encode_times, 0.95)
+        }
+
+# Instance dùng chung
+embedding_service = EmbeddingService()
@@ -0,0 +1,224 @@
+# generation_scheduler.py
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Số lượt sinh câu trả lời chạy đồng thời tối đa trên toàn server
+GENERATION_MAX_CONCURRENT = int(os.getenv("GENERATION_MAX_CONCURRENT", "32"))
+# Số lượt sinh đồng thời tối đa của một client
+GENERATION_PER_CLIENT_LIMIT = int(os.getenv("GENERATION_PER_CLIENT_LIMIT", "1"))
+# Số request tối đa được xếp hàng chờ; vượt quá sẽ bị từ chối ngay
+GENERATION_MAX_QUEUE = int(os.getenv("GENERATION_MAX_QUEUE", "128"))
+# Thời gian chờ tối đa trong hàng đợi (giây)
+GENERATION_QUEUE_TIMEOUT = float(os.getenv("GENERATION_QUEUE_TIMEOUT", "30"))
+# Tác vụ nền (ví dụ tóm tắt lịch sử) chỉ chạy khi số slot đang dùng dưới tỉ lệ này và không ai xếp hàng
+GENERATION_BACKGROUND_MAX_LOAD = float(os.getenv("GENERATION_BACKGROUND_MAX_LOAD", "0.75"))
+
+class GenerationRejected(Exception):
+    """
+    Request không được nhận vào: hàng đợi đầy ("queue_full") hoặc chờ quá lâu ("queue_timeout")
+    """
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+class GenerationScheduler:
+    """
+    Kiểm soát số lượt sinh đồng thời gửi tới VLLM: giới hạn toàn cục, giới hạn theo client,
+    hàng đợi có giới hạn và phục vụ xoay vòng (round-robin) giữa các client đang chờ
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = GENERATION_MAX_CONCURRENT,
+        per_client_limit: int = GENERATION_PER_CLIENT_LIMIT,
+        max_queue: int = GENERATION_MAX_QUEUE,
+        queue_timeout: float = GENERATION_QUEUE_TIMEOUT,
+        background_max_load: float = GENERATION_BACKGROUND_MAX_LOAD
+    ):
+        self.max_concurrent = max_concurrent
+        self.per_client_limit = per_client_limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.background_max_load = background_max_load
+        self._active = 0
+        self._inflight: Dict[str, int] = {}
+        # Hàng đợi riêng của từng client và thứ tự xoay vòng giữa các client
+        self._waiters: Dict[str, Deque[Tuple[asyncio.Future, float]]] = {}
+        self._rotation: Deque[str] = deque()
+        self._queue_depth = 0
+        # Thống kê
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.background_admitted = 0
+        self.background_skipped = 0
+        self._wait_times: Deque[float] = deque(maxlen=1000)
+        self.max_wait_time = 0.0
+
+    async def acquire(
+        self,
+        client_id: str,
+        on_queued: Optional[Callable[[int], Awaitable[None]]] = None
+    ) -> float:
+        """
+        Chờ đến lượt sinh câu trả lời. Gọi on_queued(vị trí) nếu request phải xếp hàng.
+        Trả về thời gian đã chờ (giây). Phải gọi release() khi sinh xong.
+        """
+        if self._queue_depth >= self.max_queue:
+            self.rejected += 1
+            logger.warning(f"Generation queue full, rejecting client {client_id}")
+            raise GenerationRejected("queue_full")
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        enqueued_at = time.monotonic()
+        self._waiters.setdefault(client_id, deque()).append((future, enqueued_at))
+        if client_id not in self._rotation:
+            self._rotation.append(client_id)
+        self._queue_depth += 1
+        self._dispatch()
+
+        if not future.done():
+            if on_queued is not None:
+                try:
+                    await on_queued(self.queue_position(client_id, future))
+                except Exception as e:
+                    logger.error(f"Error sending queue position to client {client_id}: {str(e)}")
+            try:
+                await asyncio.wait_for(asyncio.shield(future), timeout=self.queue_timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if future.done() and not future.cancelled():
+                    # Đã được cấp slot đúng lúc bị hủy: trả lại slot
+                    self.release(client_id)
+                else:
+                    future.cancel()
+                    self._remove_waiter(client_id, future)
+                if isinstance(e, asyncio.TimeoutError):
+                    self.timed_out += 1
+                    raise GenerationRejected("queue_timeout")
+                raise
+
+        return time.monotonic() - enqueued_at
+
+    def try_acquire_background(self, key: str) -> bool:
+        """
+        Lấy slot cho tác vụ nền ưu tiên thấp mà không chờ. Chỉ thành công khi không có request nào
+        đang xếp hàng và tải hiện tại dưới background_max_load. Phải gọi release(key) khi xong.
+        """
+        if self._queue_depth > 0 or self._active >= int(self.max_concurrent * self.background_max_load):
+            self.background_skipped += 1
+            return False
+        self._active += 1
+        self._inflight[key] = self._inflight.get(key, 0) + 1
+        self.background_admitted += 1
+        return True
+
+    def release(self, client_id: str):
+        """
+        Trả lại slot sau khi sinh xong và cấp slot cho request kế tiếp
+        """
+        self._active = max(0, self._active - 1)
+        count = self._inflight.get(client_id, 0) - 1
+        if count > 0:
+            self._inflight[client_id] = count
+        else:
+            self._inflight.pop(client_id, None)
+        self._dispatch()
+
+    def queue_position(self, client_id: str, future: asyncio.Future) -> int:
+        """
+        Vị trí (bắt đầu từ 1) của request trong thứ tự phục vụ xoay vòng
+        """
+        waiters = self._waiters.get(client_id)
+        if not waiters:
+            return 0
+        index = next((i for i, (f, _) in enumerate(waiters) if f is future), len(waiters))
+        position = index + 1
+        ahead = True
+        for other in self._rotation:
+            if other == client_id:
+                ahead = False
+                continue
+            # Client đứng trước trong vòng xoay được phục vụ trước ở mỗi vòng
+            position += min(len(self._waiters.get(other, ())), index + 1 if ahead else index)
+        return position
+
+    def _remove_waiter(self, client_id: str, future: asyncio.Future):
+        waiters = self._waiters.get(client_id)
+        if not waiters:
+            return
+        for item in waiters:
+            if item[0] is future:
+                waiters.remove(item)
+                self._queue_depth -= 1
+                break
+        if not waiters:
+            self._drop_client(client_id)
+
+    def _drop_client(self, client_id: str):
+        self._waiters.pop(client_id, None)
+        try:
+            self._rotation.remove(client_id)
+        except ValueError:
+            pass
+
+    def _dispatch(self):
+        while self._active < self.max_concurrent and self._rotation:
+            granted = False
+            for _ in range(len(self._rotation)):
+                if not self._rotation:
+                    break
+                client_id = self._rotation[0]
+                self._rotation.rotate(-1)
+                if self._inflight.get(client_id, 0) >= self.per_client_limit:
+                    continue
+                waiters = self._waiters.get(client_id)
+                if not waiters:
+                    self._drop_client(client_id)
+                    continue
+                future, enqueued_at = waiters.popleft()
+                self._queue_depth -= 1
+                if not waiters:
+                    self._drop_client(client_id)
+                if future.done():
+                    continue
+
+                self._active += 1
+                self._inflight[client_id] = self._inflight.get(client_id, 0) + 1
+                self.admitted += 1
+                wait_time = time.monotonic() - enqueued_at
+                self._wait_times.append(wait_time)
+                self.max_wait_time = max(self.max_wait_time, wait_time)
+                future.set_result(None)
+                granted = True
+                break
+            if not granted:
+                break
+
+    def snapshot(self) -> Dict:
+        waits = sorted(self._wait_times)
+        return {
+            "active": self._active,
+            "max_concurrent": self.max_concurrent,
+            "queue_depth": self._queue_depth,
+            "max_queue": self.max_queue,
+            "waiting_clients": len(self._rotation),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "background_admitted": self.background_admitted,
+            "background_skipped": self.background_skipped,
+            "wait_time_p50": round(waits[len(waits) // 2], 4) if waits else 0.0,
+            "wait_time_p95": round(waits[int(len(waits) * 0.95)], 4) if waits else 0.0,
+            "wait_time_max": round(self.max_wait_time, 4)
+        }
+
+# Instance dùng chung
+generation_scheduler = GenerationScheduler()
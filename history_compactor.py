@@ -0,0 +1,132 @@
+# history_compactor.py
+import logging
+import os
+from typing import Dict, List, Optional
+
+from ai_service import AIService
+from generation_scheduler import generation_scheduler
+from token_budget import history_tokens, message_tokens, prompt_budget
+
+logger = logging.getLogger(__name__)
+
+# Tóm tắt các lượt cũ của hội thoại dài (tùy chọn, mặc định tắt)
+HISTORY_COMPACTION_ENABLED = os.getenv("HISTORY_COMPACTION_ENABLED", "0") == "1"
+# Bắt đầu tóm tắt khi lịch sử vượt tỉ lệ này của budget prompt (nên nhỏ hơn HISTORY_TRIM_TARGET_RATIO)
+HISTORY_COMPACTION_TRIGGER_RATIO = float(os.getenv("HISTORY_COMPACTION_TRIGGER_RATIO", "0.5"))
+# Phần lịch sử gần nhất được giữ nguyên văn (tỉ lệ của budget prompt)
+HISTORY_COMPACTION_KEEP_RATIO = float(os.getenv("HISTORY_COMPACTION_KEEP_RATIO", "0.25"))
+# Số token tối đa của bản tóm tắt
+HISTORY_COMPACTION_MAX_TOKENS = int(os.getenv("HISTORY_COMPACTION_MAX_TOKENS", "512"))
+
+SUMMARY_PREFIX = "Tóm tắt phần trước của cuộc trò chuyện:\n"
+SUMMARY_INSTRUCTION = (
+    "Bạn là trợ lý tóm tắt hội thoại. Hãy viết bản tóm tắt ngắn gọn bằng tiếng Việt cho đoạn hội thoại "
+    "dưới đây, giữ lại các thông tin, yêu cầu, quyết định, tên riêng, số liệu và đoạn code quan trọng "
+    "để trợ lý có thể tiếp tục cuộc trò chuyện. Chỉ trả về bản tóm tắt."
+)
+ROLE_LABELS = {"user": "Người dùng", "assistant": "Trợ lý"}
+
+def make_summary_message(summary: str) -> Dict:
+    return {"role": "system", "content": SUMMARY_PREFIX + summary, "summary": True}
+
+class HistoryCompactor:
+    """
+    Gộp các lượt cũ nhất của hội thoại thành một tin nhắn tóm tắt (role system) bằng
+    AIService.generate_response. Chỉ chạy khi máy chủ còn rảnh (slot nền của generation_scheduler);
+    nếu không, lịch sử vẫn được cắt như bình thường bởi truncate_history.
+    """
+
+    def __init__(
+        self,
+        trigger_ratio: float = HISTORY_COMPACTION_TRIGGER_RATIO,
+        keep_ratio: float = HISTORY_COMPACTION_KEEP_RATIO,
+        max_tokens: int = HISTORY_COMPACTION_MAX_TOKENS
+    ):
+        self.trigger_ratio = trigger_ratio
+        self.keep_ratio = keep_ratio
+        self.max_tokens = max_tokens
+        # Thống kê
+        self.runs = 0
+        self.compacted_messages = 0
+        self.tokens_saved = 0
+        self.skipped_saturated = 0
+        self.failures = 0
+
+    def needs_compaction(self, history: List[Dict]) -> bool:
+        return history_tokens(history) > int(prompt_budget() * self.trigger_ratio)
+
+    def split_point(self, history: List[Dict]) -> int:
+        """
+        Vị trí bắt đầu phần lịch sử được giữ nguyên (luôn là tin nhắn user).
+        history[1:split] sẽ được tóm tắt; trả về 0 nếu không có gì để tóm tắt.
+        """
+        keep = int(prompt_budget() * self.keep_ratio)
+        used = 0
+        start = len(history)
+        for i in range(len(history) - 1, 0, -1):
+            tokens = message_tokens(history[i])
+            if used + tokens > keep and start < len(history):
+                break
+            used += tokens
+            start = i
+        while start < len(history) and history[start]["role"] != "user":
+            start += 1
+        if start >= len(history):
+            return 0
+        old_messages = history[1:start]
+        if sum(1 for msg in old_messages if not msg.get("summary")) < 2:
+            return 0
+        return start
+
+    def build_request(self, old_messages: List[Dict]) -> List[Dict]:
+        lines = []
+        for msg in old_messages:
+            if msg.get("summary"):
+                lines.append(f"[Tóm tắt trước đó]\n{msg['content'][len(SUMMARY_PREFIX):]}")
+            else:
+                lines.append(f"{ROLE_LABELS.get(msg['role'], msg['role'])}: {msg['content']}")
+        return [
+            {"role": "system", "content": SUMMARY_INSTRUCTION},
+            {"role": "user", "content": "\n\n".join(lines)}
+        ]
+
+    async def summarize(self, client_id: str, old_messages: List[Dict]) -> Optional[str]:
+        """
+        Tóm tắt các tin nhắn cũ với ưu tiên thấp. Trả về None nếu máy chủ bận hoặc VLLM lỗi.
+        """
+        key = f"{client_id}:compaction"
+        if not generation_scheduler.try_acquire_background(key):
+            self.skipped_saturated += 1
+            logger.info(f"Backend busy, skipping history compaction for client {client_id}")
+            return None
+        try:
+            summary = await AIService.generate_response(
+                self.build_request(old_messages),
+                max_tokens=self.max_tokens
+            )
+        finally:
+            generation_scheduler.release(key)
+
+        if AIService.is_error_response(summary):
+            self.failures += 1
+            logger.warning(f"History compaction failed for client {client_id}")
+            return None
+        return summary
+
+    def record(self, old_messages: List[Dict], summary_message: Dict):
+        self.runs += 1
+        self.compacted_messages += len(old_messages)
+        self.tokens_saved += sum(message_tokens(msg) for msg in old_messages) - message_tokens(summary_message)
+
+    def snapshot(self) -> Dict:
+        return {
+            "enabled": HISTORY_COMPACTION_ENABLED,
+            "runs": self.runs,
+            "compacted_messages": self.compacted_messages,
+            "tokens_saved": self.tokens_saved,
+            "skipped_saturated": self.skipped_saturated,
+            "failures": self.failures
+        }
+
+# Instance dùng chung
+history_compactor = HistoryCompactor()
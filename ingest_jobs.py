@@ -0,0 +1,214 @@
+# ingest_jobs.py
+import asyncio
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from pdf_service import process_pdf_file
+
+logger = logging.getLogger(__name__)
+
+# Số worker xử lý PDF chạy song song (mỗi worker dùng một thread)
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+# Số file tối đa chờ xử lý; vượt quá thì /upload_pdf trả về 503
+INGEST_MAX_QUEUE = int(os.getenv("INGEST_MAX_QUEUE", "32"))
+# Thời gian giữ trạng thái của job đã xong (giây)
+INGEST_JOB_TTL = float(os.getenv("INGEST_JOB_TTL", "3600"))
+# Khoảng thời gian tối thiểu giữa hai thông báo tiến độ gửi cho client (giây)
+INGEST_PROGRESS_INTERVAL = float(os.getenv("INGEST_PROGRESS_INTERVAL", "0.25"))
+
+class IngestQueueFull(Exception):
+    pass
+
+class IngestJob:
+    def __init__(self, client_id: str, file_path: str, file_name: str):
+        self.job_id = uuid.uuid4().hex
+        self.client_id = client_id
+        self.file_path = file_path
+        self.file_name = file_name
+        self.status = "queued"  # queued -> running -> done | error
+        self.pages_done = 0
+        self.total_pages = 0
+        self.chunks_indexed = 0
+        self.result: Optional[Dict] = None
+        self.error: Optional[str] = None
+        self.created = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self._last_progress = 0.0
+
+    def snapshot(self) -> Dict:
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "file_name": self.file_name,
+            "pages_done": self.pages_done,
+            "total_pages": self.total_pages,
+            "chunks_indexed": self.chunks_indexed,
+            "result": self.result,
+            "error": self.error,
+            "queued_sec": round((self.started or time.time()) - self.created, 3),
+            "processing_sec": round((self.finished or time.time()) - self.started, 3) if self.started else None
+        }
+
+class IngestJobManager:
+    """
+    Hàng đợi xử lý PDF có giới hạn với một pool worker chạy trên thread riêng,
+    để việc đọc/encode PDF không chặn event loop. Tiến độ được đẩy về client qua websocket.
+    """
+
+    def __init__(self, workers: int = INGEST_WORKERS, max_queue: int = INGEST_MAX_QUEUE):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.jobs: Dict[str, IngestJob] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._tasks: List[asyncio.Task] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._notify: Optional[Callable[[str, Dict], Awaitable[None]]] = None
+        # Thống kê
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    async def start(self, notify: Callable[[str, Dict], Awaitable[None]] = None):
+        """
+        Khởi động các worker. notify(client_id, message) dùng để gửi tin nhắn websocket cho client.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._notify = notify
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="pdf-ingest")
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"PDF ingest workers started: {self.workers} workers, queue size {self.max_queue}")
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def submit(self, client_id: str, file_path: str, file_name: str) -> IngestJob:
+        """
+        Đưa file vào hàng đợi xử lý, trả về job ngay lập tức
+        """
+        if self._queue is None:
+            raise RuntimeError("Ingest workers are not started")
+        self._prune()
+        job = IngestJob(client_id, file_path, file_name)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise IngestQueueFull()
+        self.jobs[job.job_id] = job
+        return job
+
+    def get(self, job_id: str) -> Optional[IngestJob]:
+        return self.jobs.get(job_id)
+
+    def _prune(self):
+        now = time.time()
+        expired = [
+            job_id for job_id, job in self.jobs.items()
+            if job.finished is not None and now - job.finished > INGEST_JOB_TTL
+        ]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    async def _send(self, client_id: str, message: Dict):
+        if self._notify is None:
+            return
+        try:
+            await self._notify(client_id, message)
+        except Exception as e:
+            logger.error(f"Error sending ingest message to client {client_id}: {str(e)}")
+
+    def _on_progress(self, job: IngestJob, pages_done: int, total_pages: int, chunks_indexed: int):
+        """
+        Được gọi từ thread xử lý PDF; chuyển thông báo tiến độ về event loop (có giới hạn tần suất)
+        """
+        job.pages_done = pages_done
+        job.total_pages = total_pages
+        job.chunks_indexed = chunks_indexed
+        now = time.monotonic()
+        if now - job._last_progress < INGEST_PROGRESS_INTERVAL and pages_done < total_pages:
+            return
+        job._last_progress = now
+        message = {
+            "type": "pdf_ingest_progress",
+            "job_id": job.job_id,
+            "file_name": job.file_name,
+            "pages_done": pages_done,
+            "total_pages": total_pages,
+            "chunks_indexed": chunks_indexed
+        }
+        asyncio.run_coroutine_threadsafe(self._send(job.client_id, message), self._loop)
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            job.status = "running"
+            job.started = time.time()
+            try:
+                result = await self._loop.run_in_executor(
+                    self._executor,
+                    lambda: process_pdf_file(
+                        job.file_path,
+                        job.client_id,
+                        progress=lambda *args: self._on_progress(job, *args),
+                        document_name=job.file_name
+                    )
+                )
+                job.result = result
+                job.chunks_indexed = result["chunks"]
+                job.status = "done"
+                self.completed += 1
+                await self._send(job.client_id, {
+                    "type": "pdf_upload_success",
+                    "job_id": job.job_id,
+                    "document_id": result["document_id"],
+                    "file_name": job.file_name,
+                    "chunks": result["chunks"],
+                    "total_chunks": result["total_chunks"],
+                    "pages": result.get("pages", 0),
+                    "truncated": result.get("truncated", False)
+                })
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"Error processing PDF job {job.job_id}: {str(e)}")
+                job.status = "error"
+                job.error = str(e)
+                self.failed += 1
+                try:
+                    os.unlink(job.file_path)
+                except OSError:
+                    pass
+                await self._send(job.client_id, {
+                    "type": "pdf_upload_error",
+                    "job_id": job.job_id,
+                    "message": f"Lỗi khi xử lý file PDF: {str(e)}"
+                })
+            finally:
+                job.finished = time.time()
+
+    def snapshot(self) -> Dict:
+        return {
+            "workers": self.workers,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "max_queue": self.max_queue,
+            "running": sum(1 for job in self.jobs.values() if job.status == "running"),
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected
+        }
+
+# Instance dùng chung
+ingest_jobs = IngestJobManager()
@@ -16,9 +16,17 @@ import threading
 from fastapi import UploadFile, File, Form
 from fastapi.responses import JSONResponse, RedirectResponse
 
-from pdf_service import process_pdf_file, clear_pdf_data, retrieve_relevant_chunks, get_pdf_db_info
+from pdf_service import clear_pdf_data, retrieve_relevant_chunks, get_pdf_db_info, get_pdf_session_stats
 
 from chat_manager import connection_manager
+from ai_service import AIService
+from response_cache import response_cache
+from generation_scheduler import generation_scheduler
+from history_compactor import history_compactor
+from ingest_jobs import ingest_jobs, IngestQueueFull
+from pdf_extract import shutdown_extract_pool
+from document_cache import document_cache
+from embedding_service import embedding_service
 
 # Cấu hình logging
 logging.basicConfig(
@@ -36,6 +44,8 @@ DEBUG = True
 
 # Thêm thư mục uploads nếu chưa tồn tại
 UPLOAD_DIR = "uploads"
+# Dung lượng tối đa của file PDF tải lên (MB)
+PDF_MAX_UPLOAD_MB = int(os.getenv("PDF_MAX_UPLOAD_MB", "50"))
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
 # Lifespan context manager
@@ -66,9 +76,19 @@ async def lifespan(app: FastAPI):
     cleanup_thread = threading.Thread(target=cleanup_temp_files, daemon=True)
     cleanup_thread.start()
     
+    # Khởi tạo connection pool dùng chung đến VLLM
+    await AIService.start()
+    
+    # Khởi động các worker xử lý PDF nền, tiến độ được gửi qua websocket của client
+    await ingest_jobs.start(notify=connection_manager.send_message)
+    
     yield
     
     # Dọn dẹp khi ứng dụng đóng
+    await ingest_jobs.close()
+    shutdown_extract_pool()
+    embedding_service.close()
+    await AIService.close()
     logger.info("Application shutdown")
 
 # Khởi tạo FastAPI app với lifespan
@@ -89,6 +109,24 @@ async def read_root(request: Request):
 async def pdf_chat_page(request: Request):
     return templates.TemplateResponse("pdf_chat.html", {"request": request})
 
+@app.get("/metrics")
+async def metrics():
+    # Trạng thái các replica VLLM, tỉ lệ tái sử dụng prefix, cache câu trả lời, hàng đợi sinh câu trả lời
+    # hàng đợi gửi của từng kết nối websocket, ingest/session PDF và micro-batch embedding câu hỏi
+    return JSONResponse(content={
+        "vllm_backends": AIService.get_pool().snapshot(),
+        "prefix_cache": AIService.prefix_stats.snapshot(),
+        "response_cache": response_cache.snapshot(),
+        "generation_scheduler": generation_scheduler.snapshot(),
+        "aborted_generations": AIService.abort_stats.snapshot(),
+        "outbound_queues": connection_manager.outbound_snapshot(),
+        "history_compaction": history_compactor.snapshot(),
+        "pdf_ingest": ingest_jobs.snapshot(),
+        "document_cache": document_cache.snapshot(),
+        "pdf_sessions": get_pdf_session_stats(),
+        "query_embedding": embedding_service.snapshot()
+    })
+
 @app.post("/upload_pdf")
 async def upload_pdf(pdf_file: UploadFile = File(...), client_id: str = Form(...)):
     if not pdf_file.filename.lower().endswith('.pdf'):
@@ -101,11 +139,11 @@ async def upload_pdf(pdf_file: UploadFile = File(...), client_id: str = Form(...
     content = await pdf_file.read()
     file_size = len(content)
     
-    # Giới hạn 10MB
-    if file_size > 10 * 1024 * 1024:
+    # Giới hạn dung lượng file
+    if file_size > PDF_MAX_UPLOAD_MB * 1024 * 1024:
         return JSONResponse(content={
             "status": "error",
-            "message": "File quá lớn. Vui lòng tải lên file PDF nhỏ hơn 10MB."
+            "message": f"File quá lớn. Vui lòng tải lên file PDF nhỏ hơn {PDF_MAX_UPLOAD_MB}MB."
         }, status_code=400)
     
     try:
@@ -117,17 +155,25 @@ async def upload_pdf(pdf_file: UploadFile = File(...), client_id: str = Form(...
         with open(temp_file_path, "wb") as temp_file:
             temp_file.write(content)
         
-        # Xử lý file PDF
-        result = process_pdf_file(temp_file_path, client_id)
+        # Đưa file vào hàng đợi xử lý nền, trả về job id ngay
+        job = ingest_jobs.submit(client_id, temp_file_path, pdf_file.filename)
         
         # Không xóa file ngay, để cho thread dọn dẹp xử lý sau
         
         return JSONResponse(content={
-            "status": "success",
-            "file_name": pdf_file.filename,
-            "chunks": result["chunks"],
-            "total_chunks": result["total_chunks"]
-        })
+            "status": "queued",
+            "job_id": job.job_id,
+            "file_name": pdf_file.filename
+        }, status_code=202)
+    except IngestQueueFull:
+        try:
+            os.unlink(temp_file_path)
+        except:
+            pass
+        return JSONResponse(content={
+            "status": "error",
+            "message": "Hệ thống đang xử lý quá nhiều file. Vui lòng thử lại sau."
+        }, status_code=503)
     except Exception as e:
         logger.exception(f"Error processing PDF: {str(e)}")
         
@@ -143,6 +189,16 @@ async def upload_pdf(pdf_file: UploadFile = File(...), client_id: str = Form(...
             "message": f"Lỗi khi xử lý file PDF: {str(e)}"
         }, status_code=500)
 
+@app.get("/upload_pdf/{job_id}")
+async def upload_pdf_status(job_id: str):
+    job = ingest_jobs.get(job_id)
+    if job is None:
+        return JSONResponse(content={
+            "status": "error",
+            "message": "Không tìm thấy job"
+        }, status_code=404)
+    return JSONResponse(content=job.snapshot())
+
 @app.websocket("/ws/{client_id}")
 async def websocket_endpoint(websocket: WebSocket, client_id: str):
     # Kết nối websocket
@@ -155,25 +211,37 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
                 data = await asyncio.wait_for(websocket.receive_text(), timeout=60)
                 message_data = json.loads(data)
                 
-                # Xử lý các loại tin nhắn khác nhau
+                # Xử lý các loại tin nhắn khác nhau: thao tác điều khiển được trả lời ngay
+                # (kể cả khi đang stream), các lượt chat được đưa vào hàng đợi của client
                 if message_data.get("action") == "clear_history":
-                    await connection_manager.handle_chat(client_id, action="clear_history")
+                    # Xếp hàng sau các lượt chat đã gửi trước đó vì nó thay đổi lịch sử
+                    await connection_manager.submit_chat(client_id, action="clear_history")
                 elif message_data.get("action") == "heartbeat":
                     await connection_manager.handle_chat(client_id, action="heartbeat")
                 elif message_data.get("action") == "get_pdf_info":
                     await connection_manager.handle_chat(client_id, action="get_pdf_info")
                 elif message_data.get("action") == "clear_pdf_data":
                     await connection_manager.handle_chat(client_id, action="clear_pdf_data")
-                elif message_data.get("action") == "pdf_query":
-                    # Xử lý truy vấn PDF
+                elif message_data.get("action") == "remove_pdf":
                     await connection_manager.handle_chat(
+                        client_id,
+                        action="remove_pdf",
+                        document_ids=[message_data.get("document_id")]
+                    )
+                elif message_data.get("action") == "stop_generation":
+                    # Dừng câu trả lời đang stream
+                    await connection_manager.handle_chat(client_id, action="stop_generation")
+                elif message_data.get("action") == "pdf_query":
+                    # Truy vấn PDF được worker của client xử lý theo thứ tự
+                    await connection_manager.submit_chat(
                         client_id=client_id,
                         message_content=message_data.get("content", ""),
-                        action="pdf_query"
+                        action="pdf_query",
+                        document_ids=message_data.get("document_ids")
                     )
                 elif "content" in message_data:
-                    # Xử lý tin nhắn thông thường
-                    await connection_manager.handle_chat(
+                    # Tin nhắn thông thường được worker của client xử lý theo thứ tự
+                    await connection_manager.submit_chat(
                         client_id=client_id,
                         message_content=message_data.get("content", "")
                     )
@@ -200,14 +268,15 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
             
     except WebSocketDisconnect:
         # Ngắt kết nối
-        connection_manager.disconnect(client_id)
+        connection_manager.disconnect(client_id, websocket)
         logger.info(f"Client disconnected: {client_id}")
     except Exception as e:
         # Xử lý lỗi
         logger.exception(f"Error in websocket: {str(e)}")
-        connection_manager.disconnect(client_id)
+        connection_manager.disconnect(client_id, websocket)
 
 # Chạy ứng dụng
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", host=APP_HOST, port=APP_PORT, reload=DEBUG)
+    # Bật permessage-deflate cho websocket (trình duyệt tự thỏa thuận khi bắt tay)
+    uvicorn.run("main:app", host=APP_HOST, port=APP_PORT, reload=DEBUG, ws_per_message_deflate=True)
@@ -0,0 +1,193 @@
+# outbound_queue.py
+import asyncio
+import logging
+import os
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional
+
+from ws_protocol import encode_message
+
+logger = logging.getLogger(__name__)
+
+# Số tin nhắn tối đa chờ gửi trên mỗi kết nối websocket
+WS_SEND_QUEUE_MAX = int(os.getenv("WS_SEND_QUEUE_MAX", "256"))
+# Cách xử lý client đọc chậm khi hàng đợi đầy:
+# "coalesce" gộp chunk mới vào chunk cuối đang chờ, "drop" bỏ các chunk đang chờ rồi gửi lại
+# toàn bộ câu trả lời (stream_resync) trước stream_end, "disconnect" đóng kết nối
+WS_SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "coalesce")
+
+SLOW_CONSUMER_POLICIES = ("coalesce", "drop", "disconnect")
+
+class OutboundQueue:
+    """
+    Hàng đợi gửi có giới hạn của một websocket với một task ghi duy nhất:
+    mọi tin nhắn (stream_start, chunk, stream_end, error, heartbeat...) được gửi đúng thứ tự.
+    put() không chờ socket; khi hàng đợi đầy, chính sách slow consumer được áp dụng.
+    """
+
+    def __init__(
+        self,
+        websocket,
+        client_id: str,
+        max_messages: int = WS_SEND_QUEUE_MAX,
+        policy: str = WS_SLOW_CONSUMER_POLICY,
+        on_closed: Optional[Callable[[str], None]] = None,
+        binary: bool = False
+    ):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            logger.warning(f"Unknown slow consumer policy '{policy}', using 'coalesce'")
+            policy = "coalesce"
+        self.websocket = websocket
+        self.client_id = client_id
+        self.max_messages = max_messages
+        self.policy = policy
+        self.on_closed = on_closed
+        # True nếu client đã chọn giao thức nhị phân (ws_protocol)
+        self.binary = binary
+        self._queue: Deque[Dict] = deque()
+        self._has_data = asyncio.Event()
+        self._closed = False
+        self._task: Optional[asyncio.Task] = None
+        # Nội dung câu trả lời đang stream, dùng để gửi lại khi đã bỏ chunk (policy "drop")
+        self._stream_parts: List[str] = []
+        self._resync = False
+        # Thống kê
+        self.sent = 0
+        self.bytes_sent = 0
+        self.max_depth = 0
+        self.overflows = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.resyncs = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+
+    def put(self, message: Dict) -> bool:
+        """
+        Đưa tin nhắn vào hàng đợi. Trả về False nếu kết nối đã đóng.
+        """
+        if self._closed:
+            return False
+
+        kind = message.get("type")
+        if self.policy == "drop":
+            if kind == "stream_start":
+                self._stream_parts = []
+                self._resync = False
+            elif kind == "stream_chunk":
+                self._stream_parts.append(message.get("content", ""))
+                if self._resync:
+                    # Đã bỏ chunk trong stream này: phần còn lại được gửi trong stream_resync
+                    self.dropped += 1
+                    return True
+            elif kind == "stream_end":
+                if self._resync:
+                    self._append({"type": "stream_resync", "content": "".join(self._stream_parts)})
+                    self._resync = False
+                    self.resyncs += 1
+                self._stream_parts = []
+
+        if len(self._queue) >= self.max_messages and not self._handle_overflow(message):
+            return not self._closed
+        self._append(message)
+        return True
+
+    def _append(self, message: Dict):
+        self._queue.append(message)
+        self.max_depth = max(self.max_depth, len(self._queue))
+        self._has_data.set()
+
+    def _handle_overflow(self, message: Dict) -> bool:
+        """
+        Áp dụng chính sách khi hàng đợi đầy. Trả về True nếu vẫn cần đưa tin nhắn vào hàng đợi.
+        Các tin nhắn điều khiển (không phải stream_chunk) luôn được giữ lại.
+        """
+        self.overflows += 1
+        if self.policy == "disconnect":
+            logger.warning(f"Outbound queue full for client {self.client_id}, disconnecting slow consumer")
+            self.close(code=1013)
+            return False
+
+        if message.get("type") != "stream_chunk":
+            return True
+
+        if self.policy == "coalesce":
+            last = self._queue[-1]
+            if last.get("type") == "stream_chunk":
+                # Gộp vào chunk cuối đang chờ (tạo dict mới, không sửa tin nhắn của phía gọi)
+                self._queue[-1] = {"type": "stream_chunk", "content": last["content"] + message.get("content", "")}
+                self.coalesced += 1
+                return False
+            return True
+
+        # policy "drop": bỏ các chunk đang chờ, câu trả lời đầy đủ sẽ được gửi lại trước stream_end
+        remaining = deque(msg for msg in self._queue if msg.get("type") != "stream_chunk")
+        self.dropped += len(self._queue) - len(remaining) + 1
+        self._queue = remaining
+        self._resync = True
+        return False
+
+    def close(self, code: Optional[int] = None):
+        """
+        Dừng task ghi và bỏ các tin nhắn còn chờ. Nếu có code, websocket được đóng với mã đó.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.clear()
+        self._has_data.set()
+        current = asyncio.current_task()
+        if self._task is not None and self._task is not current:
+            self._task.cancel()
+        if code is not None:
+            asyncio.create_task(self._close_websocket(code))
+        if self.on_closed is not None:
+            self.on_closed(self.client_id)
+
+    async def _close_websocket(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception as e:
+            logger.debug(f"Error closing websocket for client {self.client_id}: {str(e)}")
+
+    async def _run(self):
+        try:
+            while not self._closed:
+                if not self._queue:
+                    self._has_data.clear()
+                    await self._has_data.wait()
+                    continue
+                message = self._queue.popleft()
+                payload = encode_message(message, self.binary)
+                if isinstance(payload, bytes):
+                    await self.websocket.send_bytes(payload)
+                    self.bytes_sent += len(payload)
+                else:
+                    await self.websocket.send_text(payload)
+                    self.bytes_sent += len(payload.encode("utf-8"))
+                self.sent += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Socket đã đóng hoặc lỗi khi gửi: ngừng gửi cho kết nối này
+            logger.warning(f"WebSocket send failed for client {self.client_id}: {str(e)}")
+            self.close()
+
+    def snapshot(self) -> Dict:
+        return {
+            "protocol": "binary" if self.binary else "json",
+            "depth": len(self._queue),
+            "max_depth": self.max_depth,
+            "sent": self.sent,
+            "bytes_sent": self.bytes_sent,
+            "overflows": self.overflows,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "resyncs": self.resyncs
+        }
@@ -0,0 +1,90 @@
+# pdf_extract.py
+import logging
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Tuple
+
+import PyPDF2
+
+logger = logging.getLogger(__name__)
+
+# Số process trích xuất văn bản PDF song song (0 = trích xuất ngay trong thread đang xử lý file)
+PDF_EXTRACT_PROCESSES = int(os.getenv("PDF_EXTRACT_PROCESSES", "0"))
+# Số trang mỗi process trích xuất trong một lần gửi việc
+PDF_EXTRACT_BATCH_PAGES = int(os.getenv("PDF_EXTRACT_BATCH_PAGES", "8"))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# Reader được giữ lại trong process con để không phải phân tích lại file cho mỗi batch trang
+_reader_cache = {}
+
+def extract_page_range(file_path: str, start: int, end: int) -> List[str]:
+    """Trích xuất văn bản các trang [start, end) (chạy trong process con)"""
+    reader = _reader_cache.get(file_path)
+    if reader is None:
+        _reader_cache.clear()
+        reader = PyPDF2.PdfReader(file_path)
+        _reader_cache[file_path] = reader
+    return [reader.pages[i].extract_text() or "" for i in range(start, end)]
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # spawn thay vì fork: fork một process đang chạy nhiều thread (model embedding, event loop)
+            # có thể làm process con bị treo. Pool được giữ lại nên chi phí khởi động chỉ tính một lần
+            _executor = ProcessPoolExecutor(
+                max_workers=PDF_EXTRACT_PROCESSES,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+            logger.info(f"PDF extraction pool started with {PDF_EXTRACT_PROCESSES} processes")
+        return _executor
+
+def shutdown_extract_pool():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+def open_pdf_pages(file_path: str, max_pages: int) -> Tuple[int, Iterator[Tuple[int, str]]]:
+    """
+    Mở file PDF, trả về (tổng số trang của file, iterator (số trang, văn bản)) cho tối đa max_pages trang đầu.
+    Khi PDF_EXTRACT_PROCESSES > 0 các batch trang được trích xuất trước trong pool process
+    trong khi trang đã có đang được chia chunk/encode.
+    """
+    reader = PyPDF2.PdfReader(file_path)
+    num_pages = len(reader.pages)
+    pages_to_read = min(num_pages, max_pages)
+
+    def iter_local():
+        for page_num in range(pages_to_read):
+            yield page_num + 1, reader.pages[page_num].extract_text() or ""
+
+    def iter_processes():
+        executor = _get_executor()
+        batches = deque(
+            (start, min(start + PDF_EXTRACT_BATCH_PAGES, pages_to_read))
+            for start in range(0, pages_to_read, PDF_EXTRACT_BATCH_PAGES)
+        )
+        pending = deque()
+        try:
+            while batches or pending:
+                # Giữ tối đa 2 batch cho mỗi process để trích xuất đi trước các bước sau
+                while batches and len(pending) < PDF_EXTRACT_PROCESSES * 2:
+                    start, end = batches.popleft()
+                    pending.append((start, executor.submit(extract_page_range, file_path, start, end)))
+                start, future = pending.popleft()
+                for offset, text in enumerate(future.result()):
+                    yield start + offset + 1, text
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+    if PDF_EXTRACT_PROCESSES > 0 and pages_to_read > PDF_EXTRACT_BATCH_PAGES:
+        return num_pages, iter_processes()
+    return num_pages, iter_local()
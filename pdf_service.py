@@ -2,41 +2,141 @@
 import os
 import logging
 import uuid
-import PyPDF2
 import re
 import numpy as np
-import faiss
 import time
-from typing import List, Dict, Any
 from sentence_transformers import SentenceTransformer
 import threading
+from contextlib import contextmanager
+
+from rw_lock import RWLock
+from semantic_chunker import chunk_sentences
+from pdf_extract import open_pdf_pages
+from document_cache import DOC_CACHE_ENABLED, document_cache, hash_file, make_cache_key
+from session_store import PDF_SESSION_PERSIST, chunk_document_id, session_store
+from vector_index import (
+    compaction_target, create_index, export_vectors, index_type_name, normalize, promote, promotion_target,
+    remove_vectors
+)
 
 logger = logging.getLogger(__name__)
 
 # Khởi tạo model embedding
-embedding_model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+embedding_model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+EMBEDDING_DIM = embedding_model.get_sentence_embedding_dimension()
 
 # Lưu trữ dữ liệu PDF của người dùng
 user_pdf_data = {}
 
-# Khóa để đồng bộ hóa truy cập vào dữ liệu
-pdf_data_lock = threading.Lock()
+# Khóa cho bảng user_pdf_data (chỉ giữ trong lúc tra/thêm/bỏ session). Dữ liệu của từng session
+# được bảo vệ bằng khóa đọc/ghi riêng session["lock"]: truy vấn của các người dùng chạy song song,
+# ingest/xóa tài liệu chỉ chặn truy vấn trên chính session đó. Encode bằng model luôn chạy ngoài khóa.
+# Thứ tự lấy khóa: khóa session trước, session_map_lock sau (session_map_lock không bao giờ chờ khóa session)
+session_map_lock = threading.Lock()
+# Khóa cho việc ghi/xóa session trên đĩa (giữ riêng để không chặn truy vấn khi đang ghi file)
+session_io_lock = threading.Lock()
+
+# Số câu/đoạn được encode trong mỗi batch của embedding model
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+# Cách tạo vector cho chunk: "encode" encode lại nội dung chunk (một lần gọi model cho cả file),
+# "sentence_mean" dùng trung bình các vector câu đã tính trong semantic_chunking (không encode lại)
+CHUNK_EMBEDDING_MODE = os.getenv("CHUNK_EMBEDDING_MODE", "encode")
+# Chia chunk trên toàn bộ văn bản (chunk có thể nối qua nhiều trang) thay vì từng trang riêng
+CHUNK_ACROSS_PAGES = os.getenv("CHUNK_ACROSS_PAGES", "0") == "1"
+# Độ dài tối đa (ký tự) và ngưỡng similarity khi gom câu thành chunk
+CHUNK_MAX_SIZE = 1000
+CHUNK_SIMILARITY_THRESHOLD = 0.7
+# Giới hạn số trang và dung lượng văn bản (UTF-8) được trích xuất từ một file PDF
+PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", "1000"))
+PDF_MAX_TEXT_BYTES = int(os.getenv("PDF_MAX_TEXT_BYTES", str(20 * 1024 * 1024)))
+# Thời gian tối đa giữa hai lần thêm chunk vào FAISS index khi đang ingest (giây),
+# để các trang đầu truy vấn được trước khi cả file được xử lý xong
+INGEST_FLUSH_INTERVAL = float(os.getenv("INGEST_FLUSH_INTERVAL", "1.0"))
 
 # Thời gian tồn tại tối đa của session (30 phút)
 SESSION_TIMEOUT = 30 * 60  # 30 phút tính bằng giây
 
-# Định kỳ xóa các session hết hạn
+def new_pdf_session():
+    """Tạo session PDF rỗng"""
+    return {
+        # Tìm theo cosine similarity (inner product trên vector đã chuẩn hóa), tự chuyển sang ANN khi lớn
+        "index": create_index(EMBEDDING_DIM),
+        "chunks": [],
+        "metadata": [],
+        # Id của vector trong FAISS index cho từng chunk (cùng thứ tự với chunks)
+        "chunk_ids": [],
+        "id_to_pos": {},
+        "next_id": 0,
+        # Thông tin các tài liệu trong workspace, theo document id
+        "file_info": {},
+        "last_access": time.time(),
+        "dirty": False,
+        # Tăng sau mỗi lần dữ liệu thay đổi, để biết bản chụp (ghi đĩa, dựng index ANN) còn mới không
+        "version": 0,
+        "resident_bytes": 0,
+        "lock": RWLock()
+    }
+
+def is_current(client_id, session):
+    """Session còn là session của người dùng (chưa bị xóa/thay thế/đẩy khỏi RAM)"""
+    with session_map_lock:
+        return user_pdf_data.get(client_id) is session
+
+def mark_changed(session):
+    """Đánh dấu dữ liệu session đã thay đổi (gọi khi đang giữ khóa ghi của session)"""
+    session["dirty"] = PDF_SESSION_PERSIST
+    session["version"] += 1
+    session["last_access"] = time.time()
+
+def drop_idle_session(client_id):
+    """
+    Bỏ session khỏi RAM nếu không ai đang đọc/ghi, đã lưu xong và không đang xử lý file
+    (gọi khi đang giữ session_map_lock). Trả về True nếu đã bỏ.
+    """
+    session = user_pdf_data[client_id]
+    if not session["lock"].acquire_write(blocking=False):
+        return False
+    try:
+        if session.get("dirty"):
+            return False
+        if any(not info.get("complete", True) for info in session["file_info"].values()):
+            return False
+        del user_pdf_data[client_id]
+        return True
+    finally:
+        session["lock"].release_write()
+
+def evict_sessions_over_budget(protect=None):
+    """
+    Đẩy các session ít dùng nhất khỏi RAM khi vượt PDF_SESSION_MEMORY_MB, dữ liệu vẫn còn trên đĩa
+    và được mở lại khi người dùng truy cập (gọi khi đang giữ session_map_lock)
+    """
+    if not PDF_SESSION_PERSIST:
+        return
+    for client_id in session_store.select_evictions(user_pdf_data, protect):
+        if drop_idle_session(client_id):
+            logger.info(f"Evicted PDF session for client {client_id} to disk")
+
+# Định kỳ đẩy các session không hoạt động khỏi RAM
 def cleanup_expired_sessions():
     current_time = time.time()
-    with pdf_data_lock:
-        expired_clients = []
-        for client_id, data in user_pdf_data.items():
-            if current_time - data.get("last_access", 0) > SESSION_TIMEOUT:
-                expired_clients.append(client_id)
+    with session_map_lock:
+        expired_clients = [
+            client_id for client_id, data in user_pdf_data.items()
+            if current_time - data.get("last_access", 0) > SESSION_TIMEOUT
+        ]
         
         for client_id in expired_clients:
-            logger.info(f"Cleaning up expired session for client: {client_id}")
-            del user_pdf_data[client_id]
+            # Khi lưu session xuống đĩa, session chỉ bị bỏ khỏi RAM và được mở lại khi cần.
+            # Session đang được dùng, chưa lưu xong hoặc đang xử lý file được giữ lại
+            if drop_idle_session(client_id):
+                logger.info(f"Cleaned up expired session for client: {client_id}")
+        
+        evict_sessions_over_budget()
+    
+    if PDF_SESSION_PERSIST:
+        session_store.prune_disk()
 
 # Khởi động một thread để định kỳ dọn dẹp các session hết hạn
 def start_cleanup_thread():
@@ -59,181 +159,506 @@ def simple_sentence_tokenize(text):
     sentences = re.split(r'(?<=[.!?])\s+(?=[A-Z])', text)
     return [s.strip() for s in sentences if s.strip()]
 
-def semantic_chunking(text, max_chunk_size=1000, similarity_threshold=0.7):
+def make_chunk(sentences, sentence_embeddings, start, end, sentence_pages=None):
+    """Tạo chunk từ các câu [start, end)"""
+    chunk = {
+        "content": " ".join(sentences[start:end]),
+        "sentences": list(sentences[start:end])
+    }
+    if sentence_pages is not None:
+        # Chunk nhiều trang được gán trang của câu đầu tiên
+        chunk["page"] = sentence_pages[start]
+    if CHUNK_EMBEDDING_MODE == "sentence_mean":
+        # Vector của chunk = trung bình các vector câu (đã chuẩn hóa)
+        vector = np.mean(sentence_embeddings[start:end], axis=0)
+        norm = np.linalg.norm(vector)
+        chunk["embedding"] = vector / norm if norm > 0 else vector
+    return chunk
+
+def build_chunks(sentences, sentence_embeddings, max_chunk_size=CHUNK_MAX_SIZE, similarity_threshold=CHUNK_SIMILARITY_THRESHOLD, sentence_pages=None):
+    """Tạo các chunk từ danh sách câu và vector câu tương ứng"""
+    return [
+        make_chunk(sentences, sentence_embeddings, start, end, sentence_pages)
+        for start, end in chunk_sentences(sentences, sentence_embeddings, max_chunk_size, similarity_threshold)
+    ]
+
+def semantic_chunking(text, max_chunk_size=CHUNK_MAX_SIZE, similarity_threshold=CHUNK_SIMILARITY_THRESHOLD):
     """Chia văn bản thành các đoạn có ngữ nghĩa liên quan"""
     sentences = simple_sentence_tokenize(text)
     
     if not sentences:
         return []
     
-    sentence_embeddings = embedding_model.encode(sentences)
+    sentence_embeddings = embedding_model.encode(sentences, batch_size=EMBEDDING_BATCH_SIZE)
+    return build_chunks(sentences, sentence_embeddings, max_chunk_size, similarity_threshold)
+
+def iter_pdf_chunks(file_path, max_pages=PDF_MAX_PAGES, max_bytes=PDF_MAX_TEXT_BYTES, stats=None):
+    """
+    Trích xuất và chia chunk file PDF theo từng trang.
+    Sau mỗi trang yield (pages_done, total_pages, chunks mới). Nếu có, stats được điền
+    số trang của file, số trang đã đọc và truncated khi file vượt giới hạn trang/dung lượng.
+    """
+    source = os.path.basename(file_path)
+    num_pages, pages = open_pdf_pages(file_path, max_pages)
+    total_pages = min(num_pages, max_pages)
+    if stats is None:
+        stats = {}
+    stats.update({"num_pages": num_pages, "pages_read": 0, "truncated": num_pages > max_pages})
+    text_bytes = 0
     
-    from sklearn.metrics.pairwise import cosine_similarity
-    similarity_matrix = cosine_similarity(sentence_embeddings)
+    # Các câu của chunk cuối chưa đóng (chỉ dùng khi CHUNK_ACROSS_PAGES): chunk có thể nối sang trang sau
+    open_sentences = []
+    open_pages = []
+    open_embeddings = None
     
-    chunks = []
-    current_chunk = []
-    current_chunk_text = ""
+    for page_number, page_text in pages:
+        page_chunks = []
+        
+        if page_text:
+            text_bytes += len(page_text.encode("utf-8"))
+            if text_bytes > max_bytes:
+                stats["truncated"] = True
+                break
+        
+        if page_text and CHUNK_ACROSS_PAGES:
+            page_sentences = simple_sentence_tokenize(page_text)
+            if page_sentences:
+                page_embeddings = embedding_model.encode(page_sentences, batch_size=EMBEDDING_BATCH_SIZE)
+                open_sentences.extend(page_sentences)
+                open_pages.extend([page_number] * len(page_sentences))
+                open_embeddings = page_embeddings if open_embeddings is None else np.vstack([open_embeddings, page_embeddings])
+                # Chunk cuối có thể còn nhận thêm câu của trang sau nên chỉ trả về các chunk trước nó
+                ranges = chunk_sentences(open_sentences, open_embeddings, CHUNK_MAX_SIZE, CHUNK_SIMILARITY_THRESHOLD)
+                for start, end in ranges[:-1]:
+                    page_chunks.append(make_chunk(open_sentences, open_embeddings, start, end, open_pages))
+                last_start = ranges[-1][0]
+                open_sentences = open_sentences[last_start:]
+                open_pages = open_pages[last_start:]
+                open_embeddings = open_embeddings[last_start:]
+        elif page_text:
+            page_chunks = semantic_chunking(page_text)
+            for chunk in page_chunks:
+                chunk["page"] = page_number
+        
+        stats["pages_read"] = page_number
+        if page_number == total_pages and open_sentences:
+            page_chunks.append(make_chunk(open_sentences, open_embeddings, 0, len(open_sentences), open_pages))
+            open_sentences = []
+        
+        for chunk in page_chunks:
+            chunk["source"] = source
+            chunk["type"] = "PDF"
+        yield page_number, total_pages, page_chunks
     
-    for i, sentence in enumerate(sentences):
-        if not current_chunk or (len(current_chunk) > 0 and 
-                               np.mean([similarity_matrix[i][j] for j in current_chunk]) >= similarity_threshold):
-            if len(current_chunk_text + sentence) <= max_chunk_size:
-                current_chunk.append(i)
-                current_chunk_text += " " + sentence
-            else:
-                chunks.append({
-                    "content": current_chunk_text.strip(),
-                    "sentences": [sentences[j] for j in current_chunk]
-                })
-                current_chunk = [i]
-                current_chunk_text = sentence
-        else:
-            chunks.append({
-                "content": current_chunk_text.strip(),
-                "sentences": [sentences[j] for j in current_chunk]
-            })
-            current_chunk = [i]
-            current_chunk_text = sentence
+    # Hủy các trang đang được trích xuất trước nếu dừng sớm
+    pages.close()
     
-    if current_chunk_text:
-        chunks.append({
-            "content": current_chunk_text.strip(),
-            "sentences": [sentences[j] for j in current_chunk]
-        })
+    if open_sentences:
+        # Dừng sớm do giới hạn dung lượng: đóng chunk cuối
+        chunk = make_chunk(open_sentences, open_embeddings, 0, len(open_sentences), open_pages)
+        chunk["source"] = source
+        chunk["type"] = "PDF"
+        yield stats["pages_read"], total_pages, [chunk]
     
-    return chunks
+    if stats["truncated"]:
+        logger.warning(f"PDF {source} exceeds ingest limits: read {stats['pages_read']} of {num_pages} pages")
 
-def read_pdf(file_path, max_pages=30):
-    """Đọc file PDF và chia thành các đoạn văn bản"""
+def read_pdf(file_path, max_pages=PDF_MAX_PAGES, progress=None):
+    """
+    Đọc file PDF và chia thành các đoạn văn bản.
+    progress(pages_done, total_pages) được gọi sau mỗi trang nếu có.
+    """
     try:
-        pdf_reader = PyPDF2.PdfReader(file_path)
-        num_pages = len(pdf_reader.pages)
-        pages_to_read = min(num_pages, max_pages)
-        
         all_chunks = []
-        
-        for page_num in range(pages_to_read):
-            page = pdf_reader.pages[page_num]
-            page_text = page.extract_text()
-            
-            if not page_text:
-                continue
-                
-            page_chunks = semantic_chunking(page_text)
-            
-            for chunk in page_chunks:
-                chunk["source"] = os.path.basename(file_path)
-                chunk["page"] = page_num + 1
-                chunk["type"] = "PDF"
-                all_chunks.append(chunk)
-                
+        for pages_done, total_pages, page_chunks in iter_pdf_chunks(file_path, max_pages):
+            all_chunks.extend(page_chunks)
+            if progress is not None:
+                progress(pages_done, total_pages)
         return all_chunks
     except Exception as e:
         logger.exception(f"Lỗi khi đọc file PDF: {str(e)}")
         return [{"content": f"Lỗi khi đọc file PDF: {str(e)}", "source": os.path.basename(file_path), "type": "Error"}]
 
+def encode_chunks(chunks):
+    """
+    Tạo vector (đã chuẩn hóa) cho tất cả chunk của một file trong một lần gọi model (chia theo batch)
+    """
+    if not chunks:
+        return np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+    if all("embedding" in chunk for chunk in chunks):
+        return normalize(np.vstack([chunk["embedding"] for chunk in chunks]))
+    embeddings = embedding_model.encode(
+        [chunk["content"] for chunk in chunks],
+        batch_size=EMBEDDING_BATCH_SIZE
+    )
+    return normalize(embeddings)
+
 def get_user_pdf_session(client_id):
-    """Lấy hoặc tạo session mới cho người dùng"""
-    with pdf_data_lock:
-        if client_id not in user_pdf_data:
-            user_pdf_data[client_id] = {
-                "index": faiss.IndexFlatL2(384),  # Dimension của embedding model
-                "chunks": [],
-                "metadata": [],
-                "file_info": {},
-                "last_access": time.time()
-            }
-        else:
+    """Lấy session của người dùng: trong RAM, mở lại từ đĩa hoặc tạo mới"""
+    with session_map_lock:
+        session = user_pdf_data.get(client_id)
+        if session is not None:
             # Cập nhật thời gian truy cập
-            user_pdf_data[client_id]["last_access"] = time.time()
-        
-        return user_pdf_data[client_id]
-
-def process_pdf_file(file_path, client_id):
-    """Xử lý file PDF và lưu trữ dữ liệu"""
-    # Xóa dữ liệu cũ khi người dùng tải lên file mới
-    clear_pdf_data(client_id)
+            session["last_access"] = time.time()
+            return session
     
-    session = get_user_pdf_session(client_id)
-    
-    # Đọc và xử lý file PDF
-    file_name = os.path.basename(file_path)
-    chunks = read_pdf(file_path)
+    # Mở lại session đã lưu ngoài lock để không chặn người dùng khác
+    loaded = session_store.load(client_id) if PDF_SESSION_PERSIST else None
     
-    with pdf_data_lock:
-        # Thêm vào FAISS index
-        for i, chunk in enumerate(chunks):
-            # Tạo metadata cho chunk
-            metadata = {
-                "source_file": file_name,
-                "chunk_index": i,
-                "page": chunk.get("page", 1)
-            }
-            
-            # Lưu chunk và metadata
-            chunk_embedding = embedding_model.encode([chunk["content"]])
-            session["index"].add(chunk_embedding)
-            session["chunks"].append(chunk["content"])
-            session["metadata"].append(metadata)
-        
-        # Lưu thông tin file
-        session["file_info"][file_name] = {
-            "path": file_path,
-            "chunks": len(chunks),
-            "pages": max([chunk.get("page", 1) for chunk in chunks], default=0)
-        }
-        
-        # Cập nhật thời gian truy cập
+    with session_map_lock:
+        session = user_pdf_data.get(client_id)
+        if session is None:
+            # Nếu trong lúc đọc đĩa session đã được tạo/xóa thì dùng session trong RAM
+            session = loaded if loaded is not None else new_pdf_session()
+            user_pdf_data[client_id] = session
+            if loaded is not None:
+                session_store.touch(client_id)
+                evict_sessions_over_budget(protect=client_id)
         session["last_access"] = time.time()
-    
+        return session
+
+@contextmanager
+def locked_session(client_id):
+    """Session hiện tại của người dùng, giữ khóa ghi (lấy lại nếu session bị đẩy khỏi RAM trong lúc chờ khóa)"""
+    while True:
+        session = get_user_pdf_session(client_id)
+        session["lock"].acquire_write()
+        if is_current(client_id, session):
+            break
+        session["lock"].release_write()
+    try:
+        yield session
+    finally:
+        session["lock"].release_write()
+
+def rebuild_session_index(client_id, session):
+    """
+    Dựng lại index của session khi vượt ngưỡng số chunk (chuyển sang HNSW/IVF-PQ) hoặc khi có nhiều
+    vector đã xóa còn nằm trong index (tombstone). Index mới được dựng ngoài khóa từ bản sao các vector
+    gốc còn dùng, trong lúc đó truy vấn vẫn dùng index cũ
+    """
+    with session["lock"].read():
+        index = session["index"]
+        live_ids = session["chunk_ids"]
+        target = promotion_target(index) or compaction_target(index, len(live_ids))
+        if target is None:
+            return
+        vectors, ids = export_vectors(index)
+        if len(ids) != len(live_ids):
+            # Bỏ các vector của tài liệu đã xóa
+            live = np.isin(ids, np.asarray(live_ids, dtype=np.int64))
+            vectors, ids = vectors[live], ids[live]
+        version = session["version"]
+    try:
+        promoted = promote(vectors, ids, target)
+    except Exception as e:
+        logger.error(f"Error rebuilding vector index for client {client_id}: {str(e)}")
+        return
+    with session["lock"].write():
+        # Bỏ qua nếu dữ liệu đã thay đổi trong lúc dựng index
+        if session["version"] == version:
+            session["index"] = promoted
+            session["mmap"] = False
+            mark_changed(session)
+            session["resident_bytes"] = session_store.resident_bytes(session)
+
+def persist_session(client_id, session):
+    """Ghi index và bảng chunk của session xuống đĩa"""
+    if not PDF_SESSION_PERSIST:
+        return
+    with session_io_lock:
+        with session["lock"].read():
+            # Session đã bị xóa/thay thế thì không ghi nữa
+            if not is_current(client_id, session):
+                return
+            payload = session_store.serialize(client_id, session)
+            version = session["version"]
+        try:
+            session_store.write(client_id, payload)
+        except Exception as e:
+            logger.error(f"Error saving PDF session for client {client_id}: {str(e)}")
+            return
+    with session["lock"].write():
+        # Có thay đổi sau bản chụp thì session vẫn cần được lưu lại
+        if session["version"] == version:
+            session["dirty"] = False
+    with session_map_lock:
+        evict_sessions_over_budget(protect=client_id)
+
+def chunking_params():
+    """Các tham số ảnh hưởng tới kết quả chia chunk/vector, dùng trong khóa cache tài liệu"""
     return {
-        "status": "success",
-        "file_name": file_name,
-        "chunks": len(chunks),
-        "total_chunks": len(session["chunks"])
+        "max_chunk_size": CHUNK_MAX_SIZE,
+        "similarity_threshold": CHUNK_SIMILARITY_THRESHOLD,
+        "embedding_mode": CHUNK_EMBEDDING_MODE,
+        "across_pages": CHUNK_ACROSS_PAGES,
+        "max_pages": PDF_MAX_PAGES,
+        "max_text_bytes": PDF_MAX_TEXT_BYTES,
+        "vector_norm": "l2"
     }
 
+def process_pdf_file(file_path, client_id, progress=None, document_name=None):
+    """
+    Thêm file PDF vào workspace của người dùng theo dạng pipeline: trích xuất trang -> chia chunk ->
+    encode theo batch -> thêm dần vào FAISS index. Các chunk đã thêm truy vấn được ngay
+    trong khi phần còn lại của file đang được xử lý. Các tài liệu khác trong workspace được giữ
+    nguyên (không encode lại); tài liệu cùng tên document_name được thay bằng file mới khi file mới
+    xử lý xong (nếu lỗi thì giữ bản cũ).
+    Kết quả được lưu vào cache tài liệu theo nội dung file: tải lên lại cùng một file
+    chỉ cần nạp chunk và vector từ cache.
+    progress(pages_done, total_pages, chunks_indexed) được gọi sau mỗi trang nếu có.
+    """
+    file_name = os.path.basename(file_path)
+    document_name = document_name or file_name
+    doc_id = uuid.uuid4().hex[:12]
+    file_info = {
+        "name": document_name,
+        "path": file_path,
+        "chunks": 0,
+        "pages": 0,
+        "complete": False,
+        "truncated": False
+    }
+    
+    with locked_session(client_id) as session:
+        # Tải lên lại tài liệu cùng tên: bản cũ vẫn được dùng tới khi bản mới xử lý xong
+        replaced = [
+            existing_id for existing_id, info in session["file_info"].items()
+            if info.get("name", existing_id) == document_name
+        ]
+        session["file_info"][doc_id] = file_info
+        mark_changed(session)
+    
+    chunks_indexed = 0
+    
+    def index_chunks(chunks, chunk_embeddings):
+        nonlocal chunks_indexed
+        with session["lock"].write():
+            if not is_current(client_id, session) or session["file_info"].get(doc_id) is not file_info:
+                raise RuntimeError("Tài liệu đã bị xóa trong khi đang xử lý file")
+            session_store.ensure_writable(session)
+            ids = np.arange(session["next_id"], session["next_id"] + len(chunks), dtype=np.int64)
+            session["index"].add_with_ids(chunk_embeddings, ids)
+            session["next_id"] += len(chunks)
+            mark_changed(session)
+            for chunk, chunk_id in zip(chunks, ids.tolist()):
+                # Lưu chunk và metadata
+                session["id_to_pos"][chunk_id] = len(session["chunks"])
+                session["chunk_ids"].append(chunk_id)
+                session["chunks"].append(chunk["content"])
+                session["metadata"].append({
+                    "source_file": file_name,
+                    "doc_id": doc_id,
+                    "chunk_index": chunks_indexed,
+                    "page": chunk.get("page", 1)
+                })
+                chunks_indexed += 1
+            file_info["chunks"] = chunks_indexed
+            file_info["pages"] = max(file_info["pages"], max(chunk.get("page", 1) for chunk in chunks))
+    
+    def complete(truncated):
+        """Đánh dấu file đã xử lý xong, lưu session xuống đĩa, trả về tổng số chunk của session"""
+        with session["lock"].write():
+            if not is_current(client_id, session) or session["file_info"].get(doc_id) is not file_info:
+                raise RuntimeError("Tài liệu đã bị xóa trong khi đang xử lý file")
+            for existing_id in replaced:
+                if existing_id in session["file_info"]:
+                    remove_document_locked(session, existing_id)
+            file_info["complete"] = True
+            file_info["truncated"] = truncated
+            session["resident_bytes"] = session_store.resident_bytes(session)
+            total_chunks = len(session["chunks"])
+        rebuild_session_index(client_id, session)
+        persist_session(client_id, session)
+        return total_chunks
+    
+    try:
+        cache_key = None
+        if DOC_CACHE_ENABLED:
+            cache_key = make_cache_key(hash_file(file_path), EMBEDDING_MODEL_NAME, chunking_params())
+            cached = document_cache.get(cache_key)
+            if cached is not None:
+                chunks, chunk_embeddings, info = cached
+                logger.info(f"Document cache hit for {file_name}: {len(chunks)} chunks")
+                if chunks:
+                    index_chunks(chunks, chunk_embeddings)
+                total_chunks = complete(info["truncated"])
+                if progress is not None:
+                    progress(info["pages"], info["pages"], chunks_indexed)
+                return {
+                    "status": "success",
+                    "document_id": doc_id,
+                    "file_name": file_name,
+                    "chunks": chunks_indexed,
+                    "total_chunks": total_chunks,
+                    "pages": info["pages"],
+                    "truncated": info["truncated"],
+                    "cached": True
+                }
+    
+        pending = []
+        # Chunk và vector của cả file, để lưu vào cache khi xử lý xong
+        cache_chunks = []
+        cache_vectors = []
+        last_flush = time.time() - INGEST_FLUSH_INTERVAL
+    
+        def flush():
+            nonlocal last_flush
+            # Encode ngoài lock để không chặn truy vấn của người dùng khác
+            chunk_embeddings = encode_chunks(pending)
+            index_chunks(pending, chunk_embeddings)
+            if cache_key is not None:
+                cache_chunks.extend({"content": chunk["content"], "page": chunk.get("page", 1)} for chunk in pending)
+                cache_vectors.append(chunk_embeddings)
+            pending.clear()
+            last_flush = time.time()
+    
+        stats = {}
+        pages_done = total_pages = 0
+        for pages_done, total_pages, page_chunks in iter_pdf_chunks(file_path, stats=stats):
+            pending.extend(page_chunks)
+            if pending and (len(pending) >= EMBEDDING_BATCH_SIZE or time.time() - last_flush >= INGEST_FLUSH_INTERVAL):
+                flush()
+            if progress is not None:
+                progress(pages_done, total_pages, chunks_indexed)
+        if pending:
+            flush()
+    
+        total_chunks = complete(stats.get("truncated", False))
+    
+        if cache_key is not None:
+            dimension = embedding_model.get_sentence_embedding_dimension()
+            document_cache.put(
+                cache_key,
+                cache_chunks,
+                np.vstack(cache_vectors) if cache_vectors else np.empty((0, dimension), dtype=np.float32),
+                {"pages": pages_done, "truncated": file_info["truncated"]}
+            )
+    
+        if progress is not None:
+            progress(pages_done, total_pages, chunks_indexed)
+    
+        return {
+            "status": "success",
+            "document_id": doc_id,
+            "file_name": file_name,
+            "chunks": chunks_indexed,
+            "total_chunks": total_chunks,
+            "pages": pages_done,
+            "truncated": file_info["truncated"],
+            "cached": False
+        }
+    except Exception:
+        # Bỏ phần đã thêm của file lỗi: tài liệu dở dang làm session không bao giờ được dọn/đẩy khỏi RAM
+        with session["lock"].write():
+            discard = is_current(client_id, session) and session["file_info"].get(doc_id) is file_info
+            if discard:
+                remove_document_locked(session, doc_id)
+        if discard:
+            rebuild_session_index(client_id, session)
+            persist_session(client_id, session)
+        raise
+
 def clear_pdf_data(client_id):
-    """Xóa toàn bộ dữ liệu PDF của người dùng"""
-    with pdf_data_lock:
-        if client_id in user_pdf_data:
-            user_pdf_data[client_id] = {
-                "index": faiss.IndexFlatL2(384),
-                "chunks": [],
-                "metadata": [],
-                "file_info": {},
-                "last_access": time.time()
-            }
-            return True
-    return False
-
-def retrieve_relevant_chunks(query, client_id, top_k=5):
-    """Tìm kiếm các đoạn văn bản liên quan đến câu hỏi"""
+    """Xóa toàn bộ dữ liệu PDF của người dùng (cả bản lưu trên đĩa)"""
+    with session_map_lock:
+        existed = client_id in user_pdf_data
+        if existed or PDF_SESSION_PERSIST:
+            # Session rỗng trong RAM để không mở lại bản cũ trên đĩa trong lúc đang xóa.
+            # Các thao tác đang chạy trên session cũ thấy nó không còn là session hiện tại và dừng lại
+            user_pdf_data[client_id] = new_pdf_session()
+    if PDF_SESSION_PERSIST:
+        with session_io_lock:
+            existed = session_store.delete(client_id) or existed
+    return existed
+
+def remove_document_locked(session, doc_id):
+    """
+    Xóa vector của tài liệu theo id khỏi FAISS index và thu gọn bảng chunk
+    (gọi khi đang giữ khóa ghi của session). Trả về số chunk đã xóa.
+    """
+    session_store.ensure_writable(session)
+    keep = []
+    removed_ids = []
+    for pos, metadata in enumerate(session["metadata"]):
+        if chunk_document_id(metadata) == doc_id:
+            removed_ids.append(session["chunk_ids"][pos])
+        else:
+            keep.append(pos)
+    # Index không xóa được tại chỗ giữ lại vector như tombstone: id không còn trong id_to_pos
+    # nên bị bỏ qua khi tìm, index được dựng lại ngoài khóa bằng rebuild_session_index
+    remove_vectors(session["index"], removed_ids)
+    session["chunks"] = [session["chunks"][pos] for pos in keep]
+    session["metadata"] = [session["metadata"][pos] for pos in keep]
+    session["chunk_ids"] = [session["chunk_ids"][pos] for pos in keep]
+    session["id_to_pos"] = {chunk_id: pos for pos, chunk_id in enumerate(session["chunk_ids"])}
+    del session["file_info"][doc_id]
+    mark_changed(session)
+    session["resident_bytes"] = session_store.resident_bytes(session)
+    return len(removed_ids)
+
+def remove_document(client_id, doc_id):
+    """
+    Xóa một tài liệu khỏi workspace, các tài liệu khác không bị encode lại.
+    Trả về False nếu không có tài liệu này.
+    """
+    with locked_session(client_id) as session:
+        if doc_id not in session["file_info"]:
+            return False
+        removed = remove_document_locked(session, doc_id)
+    
+    logger.info(f"Removed document {doc_id} for client {client_id}: {removed} chunks")
+    rebuild_session_index(client_id, session)
+    persist_session(client_id, session)
+    return True
+
+def retrieve_relevant_chunks(query, client_id, top_k=5, document_ids=None, query_vector=None):
+    """
+    Tìm kiếm các đoạn văn bản liên quan đến câu hỏi.
+    document_ids: chỉ tìm trong các tài liệu này (None = cả workspace).
+    query_vector: vector của câu hỏi nếu đã encode sẵn (ví dụ qua embedding_service).
+    """
     session = get_user_pdf_session(client_id)
+    if len(session["chunks"]) == 0:
+        return []
     
-    with pdf_data_lock:
+    # Tạo embedding (đã chuẩn hóa) cho câu hỏi, ngoài khóa để không chặn ingest/truy vấn khác
+    if query_vector is None:
+        query_vector = embedding_model.encode([query])
+    query_embedding = normalize(query_vector)
+    
+    with session["lock"].read():
         if len(session["chunks"]) == 0:
             return []
         
-        # Cập nhật thời gian truy cập
-        session["last_access"] = time.time()
-        
-        # Tạo embedding cho câu hỏi
-        query_embedding = embedding_model.encode([query])
-        
-        # Tìm kiếm các đoạn văn bản gần nhất
-        distances, indices = session["index"].search(query_embedding, min(top_k, len(session["chunks"])))
-        
-        results = []
-        for i, idx in enumerate(indices[0]):
-            if idx < len(session["chunks"]):
+        index = session["index"]
+        wanted = set(document_ids) if document_ids else None
+        top_k = min(top_k, len(session["chunks"]))
+        # Khi lọc theo tài liệu, lấy nhiều kết quả hơn rồi lọc; tăng dần nếu chưa đủ top_k
+        fetch_k = top_k if wanted is None else min(index.ntotal, top_k * 4)
+        while True:
+            # Tìm kiếm các đoạn văn bản gần nhất, score là cosine similarity (càng lớn càng liên quan)
+            scores, ids = index.search(query_embedding, fetch_k)
+            results = []
+            for score, chunk_id in zip(scores[0], ids[0]):
+                # Index ANN trả về -1 khi không đủ kết quả
+                pos = session["id_to_pos"].get(int(chunk_id))
+                if pos is None:
+                    continue
+                metadata = session["metadata"][pos]
+                if wanted is not None and chunk_document_id(metadata) not in wanted:
+                    continue
                 results.append({
-                    "content": session["chunks"][idx],
-                    "metadata": session["metadata"][idx],
-                    "score": float(distances[0][i]),
-                    "ref_id": i + 1
+                    "content": session["chunks"][pos],
+                    "metadata": metadata,
+                    "score": float(score),
+                    "ref_id": len(results) + 1
                 })
+                if len(results) == top_k:
+                    break
+            if len(results) == top_k or fetch_k >= index.ntotal:
+                break
+            fetch_k = min(index.ntotal, fetch_k * 4)
     
     return results
 
@@ -241,23 +666,30 @@ def get_pdf_db_info(client_id):
     """Lấy thông tin về dữ liệu PDF đã tải lên"""
     session = get_user_pdf_session(client_id)
     
-    with pdf_data_lock:
-        # Cập nhật thời gian truy cập
-        session["last_access"] = time.time()
-        
+    with session["lock"].read():
         total_chunks = len(session["chunks"])
         total_files = len(session["file_info"])
+        index_type = index_type_name(session["index"])
         
         file_info = []
-        for file_name, info in session["file_info"].items():
+        for doc_id, info in session["file_info"].items():
             file_info.append({
-                "name": file_name,
+                "id": doc_id,
+                "name": info.get("name", doc_id),
                 "chunks": info["chunks"],
-                "pages": info["pages"]
+                "pages": info["pages"],
+                "complete": info.get("complete", True),
+                "truncated": info.get("truncated", False)
             })
     
     return {
         "total_chunks": total_chunks,
         "total_files": total_files,
-        "files": file_info
-    }
\ No newline at end of file
+        "files": file_info,
+        "index_type": index_type
+    }
+
+def get_pdf_session_stats():
+    """Thống kê session PDF: số session trong RAM/trên đĩa, dung lượng RAM, thời gian mở lại từ đĩa"""
+    with session_map_lock:
+        return session_store.snapshot(user_pdf_data)
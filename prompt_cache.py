@@ -0,0 +1,56 @@
+# prompt_cache.py
+from typing import Dict, List, Optional
+
+from ai_service import AIService, CHATML_ASSISTANT_START
+
+class ConversationPrompt:
+    """
+    Prompt ChatML đã render của một hội thoại, chỉ nối thêm (append-only):
+    mỗi lượt mới chỉ render các tin nhắn mới, phần lịch sử đã render được giữ nguyên.
+    Bị render lại từ đầu khi lịch sử bị cắt/xóa (invalidate()) hoặc không còn khớp với phần đã render.
+    """
+
+    def __init__(self):
+        self._history: Optional[List[Dict]] = None
+        self._count = 0
+        self._last: Optional[Dict] = None
+        self._text = ""
+        # Thống kê
+        self.rendered_messages = 0
+        self.rebuilds = 0
+
+    def invalidate(self):
+        self._history = None
+        self._count = 0
+        self._last = None
+        self._text = ""
+
+    def _in_sync(self, history: List[Dict], upto: int) -> bool:
+        # Lịch sử phải là cùng một list, không bị rút ngắn và tin nhắn cuối đã render vẫn ở đúng chỗ
+        if history is not self._history or upto < self._count:
+            return False
+        return self._count == 0 or history[self._count - 1] is self._last
+
+    def render(self, history: List[Dict], upto: Optional[int] = None, tail: Optional[Dict] = None) -> str:
+        """
+        Trả về prompt của history[:upto] (+ tin nhắn tail nếu có, không được cache) kèm phần mở đầu
+        lượt trả lời của assistant
+        """
+        upto = len(history) if upto is None else upto
+        if not self._in_sync(history, upto):
+            if self._history is not None:
+                self.rebuilds += 1
+            self.invalidate()
+            self._history = history
+
+        if upto > self._count:
+            new_messages = history[self._count:upto]
+            self._text = "".join([self._text] + [AIService.render_message(msg) for msg in new_messages])
+            self.rendered_messages += len(new_messages)
+            self._count = upto
+            self._last = history[upto - 1]
+
+        # Chỉ còn một lần sao chép phần đã render để tạo chuỗi prompt gửi đi
+        if tail is not None:
+            return "".join((self._text, AIService.render_message(tail), CHATML_ASSISTANT_START))
+        return self._text + CHATML_ASSISTANT_START
@@ -0,0 +1,228 @@
+# response_cache.py
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Cache câu trả lời (tùy chọn, mặc định tắt)
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "0") == "1"
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))  # Thời gian sống (giây)
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "5000"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Tầng ngữ nghĩa: chỉ áp dụng cho câu hỏi một lượt, so khớp bằng cosine similarity
+RESPONSE_CACHE_SEMANTIC = os.getenv("RESPONSE_CACHE_SEMANTIC", "1") == "1"
+RESPONSE_CACHE_SEMANTIC_THRESHOLD = float(os.getenv("RESPONSE_CACHE_SEMANTIC_THRESHOLD", "0.95"))
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.split()).lower()
+
+def build_cache_key(messages: List[Dict], chunk_ids: Optional[List[str]] = None) -> str:
+    """
+    Tạo key cho tầng exact: hash của prompt đã chuẩn hóa (system prompt + lịch sử + id các chunk PDF)
+    """
+    hasher = hashlib.sha256()
+    for msg in messages:
+        hasher.update(msg["role"].encode("utf-8"))
+        hasher.update(b"\x00")
+        hasher.update(normalize_text(msg["content"]).encode("utf-8"))
+        hasher.update(b"\x01")
+    if chunk_ids:
+        hasher.update(b"chunks:")
+        hasher.update("\x00".join(chunk_ids).encode("utf-8"))
+    return hasher.hexdigest()
+
+def build_scope_key(system_prompt: str, chunk_ids: Optional[List[str]] = None) -> str:
+    """
+    Phạm vi của tầng ngữ nghĩa: chỉ so khớp các câu hỏi có cùng system prompt và cùng context PDF
+    """
+    return build_cache_key([{"role": "system", "content": system_prompt}], chunk_ids)
+
+class _Entry:
+    __slots__ = ("answer", "created", "size", "scope")
+
+    def __init__(self, answer: str, scope: Optional[str], vector: Optional[np.ndarray]):
+        self.answer = answer
+        self.created = time.time()
+        # Vector câu hỏi nằm trong ma trận của phạm vi (_ScopeVectors), entry chỉ tính dung lượng
+        self.scope = scope
+        self.size = len(answer.encode("utf-8")) + (vector.nbytes if vector is not None else 0)
+
+class _ScopeVectors:
+    """
+    Vector câu hỏi của một phạm vi tầng ngữ nghĩa, xếp thành một ma trận (mỗi entry một hàng) để
+    so khớp bằng một phép nhân ma trận. Xóa entry bằng cách chuyển hàng cuối vào chỗ trống.
+    """
+    __slots__ = ("matrix", "created", "keys", "rows")
+
+    def __init__(self, dim: int):
+        self.matrix = np.empty((8, dim), dtype=np.float32)
+        self.created = np.empty(8)
+        self.keys: List[str] = []
+        self.rows: Dict[str, int] = {}
+
+    def add(self, key: str, vector: np.ndarray, created: float):
+        row = len(self.keys)
+        if row == len(self.matrix):
+            # Tăng gấp đôi sức chứa để thêm entry có chi phí trung bình O(dim)
+            self.matrix = np.concatenate([self.matrix, np.empty_like(self.matrix)])
+            self.created = np.concatenate([self.created, np.empty_like(self.created)])
+        self.matrix[row] = vector
+        self.created[row] = created
+        self.keys.append(key)
+        self.rows[key] = row
+
+    def remove(self, key: str):
+        row = self.rows.pop(key)
+        last = len(self.keys) - 1
+        if row != last:
+            moved = self.keys[last]
+            self.matrix[row] = self.matrix[last]
+            self.created[row] = self.created[last]
+            self.keys[row] = moved
+            self.rows[moved] = row
+        self.keys.pop()
+
+class ResponseCache:
+    """
+    Cache câu trả lời hai tầng với LRU + TTL và giới hạn bộ nhớ:
+    - exact: key là hash của prompt đã chuẩn hóa
+    - semantic: câu hỏi một lượt gần giống nhau (vector từ embedding_service)
+    """
+
+    def __init__(
+        self,
+        ttl: float = RESPONSE_CACHE_TTL,
+        max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+        max_bytes: int = RESPONSE_CACHE_MAX_BYTES,
+        semantic_threshold: float = RESPONSE_CACHE_SEMANTIC_THRESHOLD
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.semantic_threshold = semantic_threshold
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._scopes: Dict[str, _ScopeVectors] = {}
+        self._bytes = 0
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    async def embed(self, question: str) -> np.ndarray:
+        """
+        Tạo vector đã chuẩn hóa cho câu hỏi qua embedding_service (encode theo batch, dùng chung
+        cache vector với truy vấn PDF)
+        """
+        from embedding_service import embedding_service
+        return await embedding_service.embed(question)
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry.created > self.ttl:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry.answer
+
+    def get_semantic(self, scope: str, vector: np.ndarray) -> Optional[str]:
+        vectors = self._scopes.get(scope)
+        if vectors is None:
+            return None
+        count = len(vectors.keys)
+        expired = np.flatnonzero(time.time() - vectors.created[:count] > self.ttl)
+        if len(expired):
+            for key in [vectors.keys[row] for row in expired]:
+                self._remove(key)
+            if scope not in self._scopes:
+                return None
+            count = len(vectors.keys)
+        # Các vector đã chuẩn hóa: cosine similarity của mọi entry trong một phép nhân ma trận
+        scores = vectors.matrix[:count] @ vector
+        best = int(np.argmax(scores))
+        if scores[best] < self.semantic_threshold:
+            return None
+        best_key = vectors.keys[best]
+        self._entries.move_to_end(best_key)
+        return self._entries[best_key].answer
+
+    async def lookup(
+        self,
+        key: str,
+        question: str = None,
+        scope: str = None
+    ) -> Tuple[Optional[str], Optional[np.ndarray]]:
+        """
+        Tìm câu trả lời: tầng exact trước, sau đó tầng ngữ nghĩa nếu có question và scope.
+        Trả về (câu trả lời, vector câu hỏi) để store() không phải encode lại khi miss.
+        """
+        answer = self.get(key)
+        if answer is not None:
+            self.exact_hits += 1
+            return answer, None
+        vector = None
+        if RESPONSE_CACHE_SEMANTIC and question and scope:
+            vector = await self.embed(question)
+            answer = self.get_semantic(scope, vector)
+            if answer is not None:
+                self.semantic_hits += 1
+                return answer, vector
+        self.misses += 1
+        return None, vector
+
+    async def store(
+        self,
+        key: str,
+        answer: str,
+        question: str = None,
+        scope: str = None,
+        vector: Optional[np.ndarray] = None
+    ):
+        if vector is None and RESPONSE_CACHE_SEMANTIC and question and scope:
+            vector = await self.embed(question)
+        entry = _Entry(answer, scope if vector is not None else None, vector)
+        if entry.size > self.max_bytes:
+            return
+        self._remove(key)
+        self._entries[key] = entry
+        self._bytes += entry.size
+        if entry.scope is not None:
+            vectors = self._scopes.get(entry.scope)
+            if vectors is None:
+                vectors = self._scopes[entry.scope] = _ScopeVectors(len(vector))
+            vectors.add(key, vector, entry.created)
+        # Loại bỏ các entry ít dùng nhất khi vượt giới hạn
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.size
+            if entry.scope is not None:
+                vectors = self._scopes[entry.scope]
+                vectors.remove(key)
+                if not vectors.keys:
+                    del self._scopes[entry.scope]
+
+    def snapshot(self) -> Dict:
+        lookups = self.exact_hits + self.semantic_hits + self.misses
+        return {
+            "enabled": RESPONSE_CACHE_ENABLED,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_ratio": round((self.exact_hits + self.semantic_hits) / lookups, 4) if lookups else 0.0
+        }
+
+# Instance dùng chung
+response_cache = ResponseCache()
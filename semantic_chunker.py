@@ -0,0 +1,56 @@
+# semantic_chunker.py
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+def normalize_rows(embeddings) -> np.ndarray:
+    """Chuẩn hóa từng vector về độ dài 1 (vector 0 được giữ nguyên)"""
+    vectors = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def chunk_sentences(
+    sentences: Sequence[str],
+    embeddings,
+    max_chunk_size: int = 1000,
+    similarity_threshold: float = 0.7
+) -> List[Tuple[int, int]]:
+    """
+    Gom các câu liên tiếp thành chunk, trả về danh sách khoảng câu [start, end).
+
+    Một câu được thêm vào chunk hiện tại nếu cosine similarity trung bình với các câu trong chunk
+    >= similarity_threshold và nội dung chunk không vượt max_chunk_size ký tự. Trung bình cosine
+    với các câu trong chunk bằng tích vô hướng với trung bình các vector đã chuẩn hóa, nên chỉ cần
+    giữ tổng các vector của chunk: mỗi câu một phép nhân vector, O(N·d) thời gian và không cần
+    ma trận similarity N×N. Dùng được cho cả văn bản nhiều trang.
+    """
+    if len(sentences) == 0:
+        return []
+    vectors = normalize_rows(embeddings)
+
+    ranges = []
+    start = 0
+    # Độ dài nội dung được tính như cách nối chuỗi cũ: chunk đầu tiên có thêm một khoảng trắng ở đầu
+    text_len = len(sentences[0]) + 1
+    if text_len - 1 > max_chunk_size:
+        text_len -= 1
+    centroid_sum = vectors[0].astype(np.float64)
+    count = 1
+
+    for i in range(1, len(sentences)):
+        sentence_len = len(sentences[i])
+        similarity = float(np.dot(centroid_sum, vectors[i])) / count
+        if similarity >= similarity_threshold and text_len + sentence_len <= max_chunk_size:
+            centroid_sum += vectors[i]
+            count += 1
+            text_len += 1 + sentence_len
+        else:
+            ranges.append((start, i))
+            start = i
+            centroid_sum = vectors[i].astype(np.float64)
+            count = 1
+            text_len = sentence_len
+
+    ranges.append((start, len(sentences)))
+    return ranges
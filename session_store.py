@@ -0,0 +1,270 @@
+# session_store.py
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+from rw_lock import RWLock
+from vector_index import upgrade_index
+
+logger = logging.getLogger(__name__)
+
+# Lưu dữ liệu PDF của từng session xuống đĩa để không mất khi khởi động lại server
+PDF_SESSION_PERSIST = os.getenv("PDF_SESSION_PERSIST", "1") == "1"
+# Thư mục lưu session
+PDF_SESSION_DIR = os.getenv("PDF_SESSION_DIR", os.path.join("cache", "sessions"))
+# Dung lượng RAM tối đa cho dữ liệu PDF của các session (MB); vượt quá thì session ít dùng nhất bị đẩy xuống đĩa
+PDF_SESSION_MEMORY_MB = int(os.getenv("PDF_SESSION_MEMORY_MB", "512"))
+# Thời gian giữ session trên đĩa kể từ lần truy cập cuối (giây, mặc định 7 ngày)
+PDF_SESSION_DISK_TTL = float(os.getenv("PDF_SESSION_DISK_TTL", str(7 * 24 * 3600)))
+
+TABLE_FILE = "table.json"
+
+def index_bytes(index) -> int:
+    """Ước lượng dung lượng vector trong FAISS index"""
+    try:
+        code_size = index.sa_code_size()
+    except Exception:
+        code_size = index.d * 4
+    return int(index.ntotal) * int(code_size)
+
+def chunk_document_id(metadata: Dict) -> str:
+    """Document id của chunk (session cũ chưa có doc_id thì tài liệu được định danh bằng tên file)"""
+    return metadata.get("doc_id", metadata["source_file"])
+
+def ivf_layer(index):
+    """
+    Lớp IVF trong index (None nếu không có). IO_FLAG_MMAP chỉ mmap các inverted list của IVF,
+    Flat/HNSW và lớp xếp hạng lại vẫn được đọc hết vào RAM.
+    """
+    try:
+        return faiss.extract_index_ivf(index)
+    except Exception:
+        return None
+
+class SessionStore:
+    """
+    Lưu FAISS index và bảng chunk của từng session trên đĩa. Session được mở lại khi cần,
+    index được đọc bằng memory mapping (FAISS IO_FLAG_MMAP): với IVF-PQ chỉ các trang inverted list được dùng
+    mới nằm trong RAM, Flat/HNSW được đọc hết vào RAM.
+    """
+
+    def __init__(self, root: str = PDF_SESSION_DIR, memory_budget: int = PDF_SESSION_MEMORY_MB * 1024 * 1024):
+        self.root = root
+        self.memory_budget = memory_budget
+        self.lock = threading.Lock()
+        # Thống kê
+        self.loads = 0
+        self.saves = 0
+        self.evictions = 0
+        self.load_ms = deque(maxlen=1000)
+
+    def _session_dir(self, client_id: str) -> str:
+        # client_id đến từ URL nên không dùng trực tiếp làm tên thư mục
+        return os.path.join(self.root, hashlib.sha256(client_id.encode("utf-8")).hexdigest()[:32])
+
+    def serialize(self, client_id: str, session: Dict) -> Tuple[np.ndarray, Dict]:
+        """Chụp lại index và bảng chunk của session (gọi khi đang giữ khóa đọc của session)"""
+        table = {
+            "client_id": client_id,
+            "chunks": list(session["chunks"]),
+            "metadata": list(session["metadata"]),
+            "chunk_ids": list(session["chunk_ids"]),
+            "next_id": session["next_id"],
+            "file_info": {name: dict(info) for name, info in session["file_info"].items()},
+            "last_access": session["last_access"]
+        }
+        return faiss.serialize_index(session["index"]), table
+
+    def write(self, client_id: str, payload: Tuple[np.ndarray, Dict]):
+        """
+        Ghi session xuống đĩa. Index được ghi ra file mới trước, bảng chunk trỏ tới file đó được
+        thay thế sau cùng, nên người đọc luôn thấy một cặp index/bảng nhất quán.
+        """
+        index_data, table = payload
+        session_dir = self._session_dir(client_id)
+        os.makedirs(session_dir, exist_ok=True)
+        index_file = f"index-{uuid.uuid4().hex[:12]}.faiss"
+        table["index_file"] = index_file
+        with open(os.path.join(session_dir, index_file), "wb") as f:
+            f.write(index_data.tobytes())
+        tmp_table = os.path.join(session_dir, f".{TABLE_FILE}.tmp")
+        with open(tmp_table, "w", encoding="utf-8") as f:
+            json.dump(table, f, ensure_ascii=False)
+        os.replace(tmp_table, os.path.join(session_dir, TABLE_FILE))
+        # Xóa các file index cũ (có thể vẫn đang được mmap, dữ liệu chỉ mất khi không còn ai dùng)
+        for name in os.listdir(session_dir):
+            if name.startswith("index-") and name != index_file:
+                try:
+                    os.unlink(os.path.join(session_dir, name))
+                except OSError:
+                    pass
+        with self.lock:
+            self.saves += 1
+
+    def load(self, client_id: str, mmap: bool = True) -> Optional[Dict]:
+        """Mở lại session từ đĩa (mmap=False: đọc toàn bộ index vào RAM), trả về None nếu không có"""
+        session_dir = self._session_dir(client_id)
+        table_path = os.path.join(session_dir, TABLE_FILE)
+        if not os.path.exists(table_path):
+            return None
+        start = time.perf_counter()
+        try:
+            with open(table_path, "r", encoding="utf-8") as f:
+                table = json.load(f)
+            index_path = os.path.join(session_dir, table["index_file"])
+            index = None
+            if mmap:
+                try:
+                    index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+                except Exception:
+                    # Loại index không hỗ trợ mmap: đọc toàn bộ vào RAM
+                    mmap = False
+            if index is None:
+                index = faiss.read_index(index_path)
+            upgraded = upgrade_index(index)
+            if upgraded is not index:
+                # Index cũ đã được dựng lại trong RAM
+                index = upgraded
+                mmap = False
+            if mmap and ivf_layer(index) is None:
+                # Không có gì được mmap: index đã nằm hết trong RAM
+                mmap = False
+        except Exception as e:
+            logger.error(f"Error loading PDF session for client {client_id}: {str(e)}")
+            return None
+        # Session lưu trước khi có id riêng cho chunk: id là vị trí của chunk
+        chunk_ids = table.get("chunk_ids", list(range(len(table["chunks"]))))
+        chunks, metadata = table["chunks"], table["metadata"]
+        file_info = {doc_id: info for doc_id, info in table["file_info"].items() if info.get("complete", True)}
+        if len(file_info) < len(table["file_info"]):
+            # Tài liệu đang xử lý dở khi session được lưu (server dừng giữa chừng) không bao giờ xong được:
+            # bỏ các chunk của nó, vector còn trong index bị bỏ qua khi tìm (id không có trong bảng chunk)
+            keep = [pos for pos, item in enumerate(metadata) if chunk_document_id(item) in file_info]
+            chunks = [chunks[pos] for pos in keep]
+            metadata = [metadata[pos] for pos in keep]
+            chunk_ids = [chunk_ids[pos] for pos in keep]
+        session = {
+            "index": index,
+            "chunks": chunks,
+            "metadata": metadata,
+            "chunk_ids": chunk_ids,
+            "id_to_pos": {chunk_id: pos for pos, chunk_id in enumerate(chunk_ids)},
+            "next_id": table.get("next_id", len(table["chunks"])),
+            "file_info": file_info,
+            "last_access": time.time(),
+            "index_path": index_path,
+            "mmap": mmap,
+            "dirty": False,
+            "version": 0,
+            "lock": RWLock()
+        }
+        session["resident_bytes"] = self.resident_bytes(session)
+        elapsed = (time.perf_counter() - start) * 1000
+        with self.lock:
+            self.loads += 1
+            self.load_ms.append(elapsed)
+        logger.info(f"Loaded PDF session for client {client_id} from disk in {elapsed:.1f}ms ({len(session['chunks'])} chunks)")
+        return session
+
+    def ensure_writable(self, session: Dict):
+        """Index mở bằng mmap là chỉ đọc: đọc lại vào RAM trước khi thêm vector (giữ khóa ghi của session)"""
+        if session.get("mmap"):
+            session["index"] = upgrade_index(faiss.read_index(session["index_path"]))
+            session["mmap"] = False
+
+    def delete(self, client_id: str) -> bool:
+        session_dir = self._session_dir(client_id)
+        if not os.path.isdir(session_dir):
+            return False
+        shutil.rmtree(session_dir, ignore_errors=True)
+        return True
+
+    def resident_bytes(self, session: Dict) -> int:
+        """Ước lượng RAM của session: vector (trừ các inverted list được mmap) + nội dung chunk"""
+        index = session["index"]
+        vectors = index_bytes(index)
+        ivf = ivf_layer(index) if session.get("mmap") else None
+        if ivf is not None:
+            vectors = max(0, vectors - int(ivf.ntotal) * int(ivf.code_size))
+        return vectors + sum(len(chunk) for chunk in session["chunks"])
+
+    def select_evictions(self, sessions: Dict[str, Dict], protect: str = None) -> List[str]:
+        """
+        Chọn các session ít được dùng nhất để đẩy khỏi RAM cho tới khi tổng dung lượng
+        dưới memory_budget. Bỏ qua session đang xử lý file hoặc chưa được lưu xuống đĩa.
+        """
+        total = sum(session.get("resident_bytes", 0) for session in sessions.values())
+        if total <= self.memory_budget:
+            return []
+        victims = []
+        for client_id, session in sorted(sessions.items(), key=lambda item: item[1]["last_access"]):
+            if total <= self.memory_budget:
+                break
+            if client_id == protect or session.get("dirty"):
+                continue
+            if any(not info.get("complete", True) for info in session["file_info"].values()):
+                continue
+            victims.append(client_id)
+            total -= session.get("resident_bytes", 0)
+        with self.lock:
+            self.evictions += len(victims)
+        return victims
+
+    def prune_disk(self):
+        """Xóa các session trên đĩa không được truy cập quá PDF_SESSION_DISK_TTL"""
+        if not os.path.isdir(self.root):
+            return
+        now = time.time()
+        for name in os.listdir(self.root):
+            table_path = os.path.join(self.root, name, TABLE_FILE)
+            try:
+                if now - os.path.getmtime(table_path) > PDF_SESSION_DISK_TTL:
+                    shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+            except OSError:
+                continue
+
+    def touch(self, client_id: str):
+        """Cập nhật thời gian truy cập của session trên đĩa"""
+        table_path = os.path.join(self._session_dir(client_id), TABLE_FILE)
+        try:
+            os.utime(table_path)
+        except OSError:
+            pass
+
+    def snapshot(self, sessions: Dict[str, Dict]) -> Dict:
+        with self.lock:
+            load_ms = sorted(self.load_ms)
+            stats = {
+                "persist": PDF_SESSION_PERSIST,
+                "loads": self.loads,
+                "saves": self.saves,
+                "evictions": self.evictions,
+                "load_ms_avg": round(sum(load_ms) / len(load_ms), 2) if load_ms else 0.0,
+                "load_ms_p95": round(load_ms[int(len(load_ms) * 0.95)], 2) if load_ms else 0.0
+            }
+        resident = {
+            client_id: session.get("resident_bytes", 0)
+            for client_id, session in sessions.items()
+        }
+        stats.update({
+            "sessions_in_memory": len(sessions),
+            "sessions_on_disk": len(os.listdir(self.root)) if os.path.isdir(self.root) else 0,
+            "mmap_sessions": sum(1 for session in sessions.values() if session.get("mmap")),
+            "resident_bytes": sum(resident.values()),
+            "memory_budget": self.memory_budget,
+            "resident_bytes_per_session": resident
+        })
+        return stats
+
+# Instance dùng chung
+session_store = SessionStore()
@@ -0,0 +1,118 @@
+# sse_parser.py
+import json
+import logging
+from typing import Iterator, List, Optional
+
+try:
+    # orjson nhanh hơn đáng kể khi parse nhiều event nhỏ, dùng nếu có cài đặt
+    import orjson
+
+    def _loads(data: bytes):
+        return orjson.loads(data)
+except ImportError:  # pragma: no cover - phụ thuộc vào môi trường
+    def _loads(data: bytes):
+        return json.loads(data)
+
+logger = logging.getLogger(__name__)
+
+SSE_DONE = b"[DONE]"
+
+class SSEDecoder:
+    """
+    Bộ giải mã Server-Sent Events tăng dần, làm việc trên buffer byte.
+
+    feed() nhận các khối byte bất kỳ từ mạng và trả về payload (bytes) của những
+    event đã hoàn chỉnh. Chỉ những dòng đã kết thúc mới được xử lý nên một ký tự
+    UTF-8 hay một event bị cắt ngang giữa hai khối sẽ nằm lại trong buffer cho
+    đến khi nhận đủ. Nhiều dòng "data:" trong cùng một event được nối bằng "\\n".
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._data_lines: List[bytes] = []
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        """
+        Thêm một khối byte, trả về danh sách payload của các event hoàn chỉnh
+        """
+        self._buffer += chunk
+        events = []
+        start = 0
+        buffer = self._buffer
+        while True:
+            end = buffer.find(b"\n", start)
+            if end < 0:
+                break
+            line = bytes(buffer[start:end])
+            start = end + 1
+            if line.endswith(b"\r"):
+                line = line[:-1]
+            event = self._process_line(line)
+            if event is not None:
+                events.append(event)
+        if start:
+            del buffer[:start]
+        return events
+
+    def flush(self) -> List[bytes]:
+        """
+        Kết thúc stream: xử lý dòng cuối chưa có ký tự xuống dòng và event đang dở
+        """
+        events = []
+        if self._buffer:
+            line = bytes(self._buffer).rstrip(b"\r")
+            self._buffer.clear()
+            event = self._process_line(line)
+            if event is not None:
+                events.append(event)
+        event = self._dispatch()
+        if event is not None:
+            events.append(event)
+        return events
+
+    def _process_line(self, line: bytes) -> Optional[bytes]:
+        # Dòng trống đánh dấu kết thúc một event
+        if not line:
+            return self._dispatch()
+        # Dòng comment
+        if line[:1] == b":":
+            return None
+        # Một số server gửi JSON thô không có prefix "data:", coi như một event riêng
+        if line[:1] == b"{":
+            self._data_lines.append(line)
+            return self._dispatch()
+        field, sep, value = line.partition(b":")
+        if sep and value[:1] == b" ":
+            value = value[1:]
+        if field == b"data":
+            self._data_lines.append(value)
+        return None
+
+    def _dispatch(self) -> Optional[bytes]:
+        if not self._data_lines:
+            return None
+        if len(self._data_lines) == 1:
+            data = self._data_lines[0]
+        else:
+            data = b"\n".join(self._data_lines)
+        self._data_lines = []
+        return data
+
+def iter_completion_deltas(events: List[bytes]) -> Iterator[str]:
+    """
+    Lấy phần text từ các event của endpoint /v1/completions, bỏ qua [DONE] và event lỗi
+    """
+    for data in events:
+        data = data.strip()
+        if not data or data == SSE_DONE:
+            continue
+        try:
+            chunk = _loads(data)
+        except ValueError as e:
+            logger.error(f"JSON decode error: {str(e)}, line: {data[:200]!r}")
+            continue
+        choices = chunk.get("choices") if isinstance(chunk, dict) else None
+        if choices:
+            delta = choices[0].get("text", "")
+            if delta:
+                yield delta
@@ -4,6 +4,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const chatContainer = document.getElementById('chat-container');
     const messageInput = document.getElementById('message-input');
     const sendButton = document.getElementById('send-button');
+    const stopButton = document.getElementById('stop-button');
     const clearChatButton = document.getElementById('clear-chat-btn');
     const clearPdfButton = document.getElementById('clear-pdf-btn');
     const typingIndicator = document.getElementById('typing-indicator');
@@ -19,6 +20,7 @@ document.addEventListener('DOMContentLoaded', () => {
     let currentStreamElement = null;
     let isStreaming = false;
     let streamedContent = ''; // Biến lưu trữ toàn bộ nội dung đang stream
+    let pendingUploadJob = null; // Job xử lý PDF đang chờ kết quả
     
     // Biến để theo dõi trạng thái kết nối
     let isReconnecting = false;
@@ -30,6 +32,16 @@ document.addEventListener('DOMContentLoaded', () => {
     let streamingTimeout = null;
     const MAX_STREAMING_TIME = 90000; // 90 giây (90000ms)
     
+    // Giao thức nhị phân: 1 byte loại tin nhắn + nội dung UTF-8 (loại 0 là JSON)
+    const WS_BINARY_PROTOCOL = 'chatbot.bin.v1';
+    const BINARY_MESSAGE_TYPES = {
+        1: 'stream_start',
+        2: 'stream_chunk',
+        3: 'stream_end',
+        4: 'stream_resync'
+    };
+    const textDecoder = new TextDecoder('utf-8');
+    
     // Generate a random client ID if not exists
     if (!clientId) {
         clientId = 'client_' + Math.random().toString(36).substr(2, 9);
@@ -46,7 +58,9 @@ document.addEventListener('DOMContentLoaded', () => {
         const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
         const wsUrl = `${protocol}//${window.location.host}/ws/${clientId}`;
         
-        websocket = new WebSocket(wsUrl);
+        // Đề nghị giao thức nhị phân gọn; máy chủ cũ bỏ qua và vẫn gửi JSON
+        websocket = new WebSocket(wsUrl, [WS_BINARY_PROTOCOL]);
+        websocket.binaryType = 'arraybuffer';
         
         websocket.onopen = (event) => {
             console.log('WebSocket connected');
@@ -110,15 +124,22 @@ document.addEventListener('DOMContentLoaded', () => {
              reconnectAttempts = 0;
              
              try {
-                 const data = JSON.parse(event.data);
+                 const data = decodeServerMessage(event.data);
                  
                  if (data.type === 'heartbeat_ack') {
                      console.log('Heartbeat acknowledged');
                      return;
                  }
                  
+                 if (data.type === 'queued') {
+                     // Máy chủ đang bận: hiển thị vị trí trong hàng đợi
+                     showQueuePosition(data.position);
+                     return;
+                 }
+                 
                  if (data.type === 'stream_start') {
                      // Start a new streaming message
+                     hideQueuePosition();
                      isStreaming = true;
                      streamedContent = '';
                      startStreamingMessage();
@@ -127,6 +148,10 @@ document.addEventListener('DOMContentLoaded', () => {
                      // Add chunk to the current streaming message
                      appendStreamChunk(data.content);
                      
+                 } else if (data.type === 'stream_resync') {
+                     // Máy chủ đã bỏ bớt chunk vì kết nối chậm: thay bằng toàn bộ nội dung
+                     replaceStreamContent(data.content);
+                     
                  } else if (data.type === 'stream_end') {
                      // Finalize the streaming message
                      isStreaming = false;
@@ -140,9 +165,12 @@ document.addEventListener('DOMContentLoaded', () => {
                      
                      // Clear streaming timeout
                      clearTimeout(streamingTimeout);
+                     stopButton.classList.add('hidden');
                      
-                     // Show error message
-                     addMessageToUI('assistant', 'Xin lỗi, tôi đang gặp vấn đề kỹ thuật. Vui lòng thử lại sau.');
+                     hideQueuePosition();
+                     
+                     // Show error message (lỗi có mã như queue_full thì hiển thị thông báo của máy chủ)
+                     addMessageToUI('assistant', data.code ? data.message : 'Xin lỗi, tôi đang gặp vấn đề kỹ thuật. Vui lòng thử lại sau.');
                      scrollToBottom();
                      
                  } else if (data.type === 'history_cleared') {
@@ -154,21 +182,23 @@ document.addEventListener('DOMContentLoaded', () => {
                  } else if (data.type === 'pdf_info') {
                      // Cập nhật thông tin PDF
                      updatePdfInfo(data.info);
+                 } else if (data.type === 'pdf_ingest_progress') {
+                     // Cập nhật tiến độ xử lý file PDF
+                     showIngestProgress(data);
                  } else if (data.type === 'pdf_upload_success') {
                      // Hiển thị thông báo tải lên thành công
-                     uploadStatus.innerHTML = `<span class="status-success">✓ Đã tải lên thành công file ${data.file_name}</span>`;
-                     uploadStatus.classList.add('status-success');
-                     
-                     // Cập nhật thông tin PDF
-                     fetchPdfInfo();
-                     
-                     // Thêm thông báo vào chat
-                     addMessageToUI('assistant', `Tôi đã xử lý file PDF "${data.file_name}" của bạn. Bạn có thể hỏi về nội dung của file này.`);
-                     
+                     showUploadSuccess(data);
                  } else if (data.type === 'pdf_upload_error') {
-                     // Hiển thị thông báo lỗi
-                     uploadStatus.innerHTML = `<span class="status-error">✗ Lỗi: ${data.message}</span>`;
-                     uploadStatus.classList.add('status-error');
+                     // Hiển thị thông báo lỗi (bỏ qua lỗi của job cũ đã bị thay thế)
+                     if (!data.job_id || data.job_id === pendingUploadJob) {
+                         showUploadError(data.message);
+                     }
+                 } else if (data.type === 'pdf_removed') {
+                     // Cập nhật danh sách tài liệu sau khi xóa một file
+                     updatePdfInfo(data.info);
+                     if (data.document_ids && data.document_ids.length > 0) {
+                         uploadStatus.innerHTML = '<span class="status-success">✓ Đã xóa tài liệu khỏi workspace</span>';
+                     }
                  } else if (data.type === 'pdf_cleared') {
                      // Hiển thị thông báo xóa PDF thành công
                      pdfInfoContent.innerHTML = '<p>Chưa có file PDF nào được tải lên.</p>';
@@ -246,6 +276,26 @@ document.addEventListener('DOMContentLoaded', () => {
          };
      }
      
+     // Hiển thị vị trí trong hàng đợi khi máy chủ đang bận
+     function showQueuePosition(position) {
+         let queueMsg = document.getElementById('queue-status');
+         if (!queueMsg) {
+             queueMsg = document.createElement('div');
+             queueMsg.id = 'queue-status';
+             queueMsg.className = 'system-message';
+             chatContainer.appendChild(queueMsg);
+         }
+         queueMsg.textContent = `Máy chủ đang bận. Yêu cầu của bạn đang ở vị trí ${position} trong hàng đợi...`;
+         scrollToBottom();
+     }
+     
+     function hideQueuePosition() {
+         const queueMsg = document.getElementById('queue-status');
+         if (queueMsg) {
+             queueMsg.remove();
+         }
+     }
+     
      // Hàm kiểm tra kết nối và kết nối lại nếu cần
      function checkConnection() {
          if (websocket === null || 
@@ -376,9 +426,10 @@ document.addEventListener('DOMContentLoaded', () => {
                          <div class="pdf-file-details">
                              <div class="pdf-file-name">${file.name}</div>
                              <div class="pdf-file-stats">
-                                 ${file.pages} trang | ${file.chunks} đoạn văn bản
+                                 ${file.pages} trang | ${file.chunks} đoạn văn bản${file.complete === false ? ' | đang xử lý' : ''}${file.truncated ? ' | đã cắt bớt' : ''}
                              </div>
                          </div>
+                         <button class="pdf-file-remove" data-document-id="${file.id}" title="Xóa tài liệu">✕</button>
                      </li>
                  `;
              });
@@ -387,10 +438,28 @@ document.addEventListener('DOMContentLoaded', () => {
          }
          
          pdfInfoContent.innerHTML = html;
+         
+         // Nút xóa từng tài liệu khỏi workspace
+         pdfInfoContent.querySelectorAll('.pdf-file-remove').forEach(button => {
+             button.addEventListener('click', () => removePdf(button.dataset.documentId));
+         });
+     }
+     
+     // Xóa một tài liệu khỏi workspace
+     function removePdf(documentId) {
+         if (websocket && websocket.readyState === WebSocket.OPEN) {
+             websocket.send(JSON.stringify({
+                 action: 'remove_pdf',
+                 document_id: documentId
+             }));
+         }
      }
      
      // Start a new streaming message
      function startStreamingMessage() {
+         // Hiện nút dừng trong khi đang stream
+         stopButton.classList.remove('hidden');
+         
          // Create message row
          const messageRow = document.createElement('div');
          messageRow.className = 'message-row';
@@ -451,6 +520,29 @@ document.addEventListener('DOMContentLoaded', () => {
          scrollToBottom();
      }
      
+     // Giải mã tin nhắn từ máy chủ (text frame JSON hoặc binary frame)
+     function decodeServerMessage(raw) {
+         if (typeof raw === 'string') {
+             return JSON.parse(raw);
+         }
+         
+         const bytes = new Uint8Array(raw);
+         const payload = textDecoder.decode(bytes.subarray(1));
+         if (bytes[0] === 0) {
+             return JSON.parse(payload);
+         }
+         return { type: BINARY_MESSAGE_TYPES[bytes[0]], content: payload };
+     }
+     
+     // Thay toàn bộ nội dung đang stream (sau stream_resync)
+     function replaceStreamContent(content) {
+         if (!currentStreamElement) return;
+         
+         streamedContent = content;
+         updateStreamDisplay();
+         scrollToBottom();
+     }
+     
      // Cập nhật hiển thị stream
      function updateStreamDisplay() {
          if (!currentStreamElement) return;
@@ -468,6 +560,7 @@ document.addEventListener('DOMContentLoaded', () => {
      function finishStreamingMessage() {
          // Xóa timeout khi hoàn thành streaming
          clearTimeout(streamingTimeout);
+         stopButton.classList.add('hidden');
          
          if (!currentStreamElement) return;
          
@@ -777,6 +870,15 @@ function addMessageToUI(role, content) {
          }
      }
      
+     // Dừng câu trả lời đang stream (phần đã nhận vẫn được giữ lại)
+     function stopGeneration() {
+         if (websocket && websocket.readyState === WebSocket.OPEN && isStreaming) {
+             websocket.send(JSON.stringify({
+                 action: 'stop_generation'
+             }));
+         }
+     }
+     
      // Clear chat history
      function clearChat() {
          if (websocket && websocket.readyState === WebSocket.OPEN && !isStreaming) {
@@ -807,9 +909,6 @@ function addMessageToUI(role, content) {
          uploadStatus.innerHTML = '<span class="status-pending">⟳ Đang tải lên và xử lý file...</span>';
          uploadStatus.classList.add('status-pending');
          
-         // Xóa lịch sử chat khi tải lên file mới
-         chatContainer.innerHTML = '';
-         
          // Tạo form data
          const formData = new FormData();
          formData.append('pdf_file', file);
@@ -822,18 +921,17 @@ function addMessageToUI(role, content) {
          })
          .then(response => response.json())
          .then(data => {
-             if (data.status === 'success') {
-                 uploadStatus.innerHTML = `<span class="status-success">✓ Đã tải lên thành công file ${data.file_name}</span>`;
-                 uploadStatus.classList.add('status-success');
+             if (data.status === 'queued') {
+                 // File được xử lý nền, kết quả và tiến độ được gửi qua websocket
+                 pendingUploadJob = data.job_id;
+                 uploadStatus.innerHTML = `<span class="status-pending">⟳ Đang chờ xử lý file ${data.file_name}...</span>`;
                  
-                 // Cập nhật thông tin PDF
-                 fetchPdfInfo();
-                 
-                 // Thêm thông báo vào chat
-                 addMessageToUI('assistant', `Tôi đã xử lý file PDF "${data.file_name}" của bạn. File này có ${data.chunks} đoạn văn bản. Bạn có thể hỏi về nội dung của file này.`);
+                 // Nếu websocket không kết nối thì hỏi trạng thái job định kỳ
+                 if (!websocket || websocket.readyState !== WebSocket.OPEN) {
+                     pollUploadJob(data.job_id);
+                 }
              } else {
-                 uploadStatus.innerHTML = `<span class="status-error">✗ Lỗi: ${data.message}</span>`;
-                 uploadStatus.classList.add('status-error');
+                 showUploadError(data.message);
              }
          })
          .catch(error => {
@@ -843,8 +941,64 @@ function addMessageToUI(role, content) {
          });
      }
      
+     // Hiển thị tiến độ xử lý file PDF
+     function showIngestProgress(data) {
+         if (data.job_id !== pendingUploadJob) return;
+         
+         // Các trang đã được lập chỉ mục có thể hỏi được ngay
+         if (data.chunks_indexed && data.pages_done < data.total_pages) {
+             fetchPdfInfo();
+         }
+         const chunksText = data.chunks_indexed ? `, ${data.chunks_indexed} đoạn đã lập chỉ mục` : '';
+         uploadStatus.innerHTML = `<span class="status-pending">⟳ Đang xử lý file ${data.file_name}: ${data.pages_done}/${data.total_pages} trang${chunksText}</span>`;
+         uploadStatus.classList.add('status-pending');
+     }
+     
+     // Hiển thị kết quả khi file PDF đã được xử lý xong
+     function showUploadSuccess(data) {
+         if (data.job_id && data.job_id !== pendingUploadJob) return;
+         pendingUploadJob = null;
+         uploadStatus.innerHTML = `<span class="status-success">✓ Đã tải lên thành công file ${data.file_name}</span>`;
+         uploadStatus.classList.add('status-success');
+         
+         // Cập nhật thông tin PDF
+         fetchPdfInfo();
+         
+         // Thêm thông báo vào chat
+         const truncatedText = data.truncated ? ' File vượt quá giới hạn xử lý nên chỉ phần đầu của file được sử dụng.' : '';
+         addMessageToUI('assistant', `Tôi đã xử lý file PDF "${data.file_name}" của bạn. File này có ${data.chunks} đoạn văn bản.${truncatedText} Bạn có thể hỏi về nội dung của file này.`);
+     }
+     
+     function showUploadError(message) {
+         pendingUploadJob = null;
+         uploadStatus.innerHTML = `<span class="status-error">✗ Lỗi: ${message}</span>`;
+         uploadStatus.classList.add('status-error');
+     }
+     
+     // Hỏi trạng thái job xử lý PDF (dùng khi không nhận được thông báo qua websocket)
+     function pollUploadJob(jobId) {
+         if (jobId !== pendingUploadJob) return;
+         fetch(`/upload_pdf/${jobId}`)
+         .then(response => response.json())
+         .then(job => {
+             if (job.status === 'done') {
+                 showUploadSuccess({ job_id: jobId, file_name: job.file_name, chunks: job.result.chunks, truncated: job.result.truncated });
+             } else if (job.status === 'error') {
+                 showUploadError(job.error || job.message);
+             } else {
+                 showIngestProgress(job);
+                 setTimeout(() => pollUploadJob(jobId), 1000);
+             }
+         })
+         .catch(error => {
+             console.error('Error polling PDF job:', error);
+             setTimeout(() => pollUploadJob(jobId), 3000);
+         });
+     }
+     
      // Event listeners
      sendButton.addEventListener('click', sendMessage);
+     stopButton.addEventListener('click', stopGeneration);
      
      messageInput.addEventListener('keydown', (e) => {
          if (e.key === 'Enter' && !e.shiftKey) {
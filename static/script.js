@@ -4,6 +4,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const chatContainer = document.getElementById('chat-container');
     const messageInput = document.getElementById('message-input');
     const sendButton = document.getElementById('send-button');
+    const stopButton = document.getElementById('stop-button');
     const clearChatButton = document.getElementById('clear-chat-btn');
     const typingIndicator = document.getElementById('typing-indicator');
     
@@ -24,6 +25,16 @@ document.addEventListener('DOMContentLoaded', () => {
     let streamingTimeout = null;
     const MAX_STREAMING_TIME = 90000; // 90 giây (90000ms)
     
+    // Giao thức nhị phân: 1 byte loại tin nhắn + nội dung UTF-8 (loại 0 là JSON)
+    const WS_BINARY_PROTOCOL = 'chatbot.bin.v1';
+    const BINARY_MESSAGE_TYPES = {
+        1: 'stream_start',
+        2: 'stream_chunk',
+        3: 'stream_end',
+        4: 'stream_resync'
+    };
+    const textDecoder = new TextDecoder('utf-8');
+    
     // Generate a random client ID if not exists
     if (!clientId) {
         clientId = 'client_' + Math.random().toString(36).substr(2, 9);
@@ -37,7 +48,9 @@ document.addEventListener('DOMContentLoaded', () => {
         const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
         const wsUrl = `${protocol}//${window.location.host}/ws/${clientId}`;
         
-        websocket = new WebSocket(wsUrl);
+        // Đề nghị giao thức nhị phân gọn; máy chủ cũ bỏ qua và vẫn gửi JSON
+        websocket = new WebSocket(wsUrl, [WS_BINARY_PROTOCOL]);
+        websocket.binaryType = 'arraybuffer';
         
         websocket.onopen = (event) => {
             console.log('WebSocket connected');
@@ -100,15 +113,22 @@ document.addEventListener('DOMContentLoaded', () => {
             reconnectAttempts = 0;
             
             try {
-                const data = JSON.parse(event.data);
+                const data = decodeServerMessage(event.data);
                 
                 if (data.type === 'heartbeat_ack') {
                     console.log('Heartbeat acknowledged');
                     return;
                 }
                 
+                if (data.type === 'queued') {
+                    // Máy chủ đang bận: hiển thị vị trí trong hàng đợi
+                    showQueuePosition(data.position);
+                    return;
+                }
+                
                 if (data.type === 'stream_start') {
                     // Start a new streaming message
+                    hideQueuePosition();
                     isStreaming = true;
                     streamedContent = '';
                     startStreamingMessage();
@@ -117,6 +137,10 @@ document.addEventListener('DOMContentLoaded', () => {
                     // Add chunk to the current streaming message
                     appendStreamChunk(data.content);
                     
+                } else if (data.type === 'stream_resync') {
+                    // Máy chủ đã bỏ bớt chunk vì kết nối chậm: thay bằng toàn bộ nội dung
+                    replaceStreamContent(data.content);
+                    
                 } else if (data.type === 'stream_end') {
                     // Finalize the streaming message
                     isStreaming = false;
@@ -130,9 +154,12 @@ document.addEventListener('DOMContentLoaded', () => {
                     
                     // Clear streaming timeout
                     clearTimeout(streamingTimeout);
+                    stopButton.classList.add('hidden');
+                    
+                    hideQueuePosition();
                     
-                    // Show error message
-                    addMessageToUI('assistant', 'Xin lỗi, tôi đang gặp vấn đề kỹ thuật. Vui lòng thử lại sau.');
+                    // Show error message (lỗi có mã như queue_full thì hiển thị thông báo của máy chủ)
+                    addMessageToUI('assistant', data.code ? data.message : 'Xin lỗi, tôi đang gặp vấn đề kỹ thuật. Vui lòng thử lại sau.');
                     scrollToBottom();
                     
                 } else if (data.type === 'history_cleared') {
@@ -210,6 +237,26 @@ document.addEventListener('DOMContentLoaded', () => {
         };
     }
     
+    // Hiển thị vị trí trong hàng đợi khi máy chủ đang bận
+    function showQueuePosition(position) {
+        let queueMsg = document.getElementById('queue-status');
+        if (!queueMsg) {
+            queueMsg = document.createElement('div');
+            queueMsg.id = 'queue-status';
+            queueMsg.className = 'system-message';
+            chatContainer.appendChild(queueMsg);
+        }
+        queueMsg.textContent = `Máy chủ đang bận. Yêu cầu của bạn đang ở vị trí ${position} trong hàng đợi...`;
+        scrollToBottom();
+    }
+    
+    function hideQueuePosition() {
+        const queueMsg = document.getElementById('queue-status');
+        if (queueMsg) {
+            queueMsg.remove();
+        }
+    }
+    
     // Hàm kiểm tra kết nối và kết nối lại nếu cần
     function checkConnection() {
         if (websocket === null || 
@@ -303,6 +350,9 @@ document.addEventListener('DOMContentLoaded', () => {
     
     // Start a new streaming message
     function startStreamingMessage() {
+        // Hiện nút dừng trong khi đang stream
+        stopButton.classList.remove('hidden');
+        
         // Create message row
         const messageRow = document.createElement('div');
         messageRow.className = 'message-row';
@@ -363,6 +413,29 @@ document.addEventListener('DOMContentLoaded', () => {
         scrollToBottom();
     }
     
+    // Giải mã tin nhắn từ máy chủ (text frame JSON hoặc binary frame)
+    function decodeServerMessage(raw) {
+        if (typeof raw === 'string') {
+            return JSON.parse(raw);
+        }
+        
+        const bytes = new Uint8Array(raw);
+        const payload = textDecoder.decode(bytes.subarray(1));
+        if (bytes[0] === 0) {
+            return JSON.parse(payload);
+        }
+        return { type: BINARY_MESSAGE_TYPES[bytes[0]], content: payload };
+    }
+    
+    // Thay toàn bộ nội dung đang stream (sau stream_resync)
+    function replaceStreamContent(content) {
+        if (!currentStreamElement) return;
+        
+        streamedContent = content;
+        updateStreamDisplay();
+        scrollToBottom();
+    }
+    
     // Cập nhật hiển thị stream
     function updateStreamDisplay() {
         if (!currentStreamElement) return;
@@ -380,6 +453,7 @@ document.addEventListener('DOMContentLoaded', () => {
     function finishStreamingMessage() {
         // Xóa timeout khi hoàn thành streaming
         clearTimeout(streamingTimeout);
+        stopButton.classList.add('hidden');
         
         if (!currentStreamElement) return;
         
@@ -689,6 +763,15 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
     
+    // Dừng câu trả lời đang stream (phần đã nhận vẫn được giữ lại)
+    function stopGeneration() {
+        if (websocket && websocket.readyState === WebSocket.OPEN && isStreaming) {
+            websocket.send(JSON.stringify({
+                action: 'stop_generation'
+            }));
+        }
+    }
+    
     // Clear chat history
     function clearChat() {
         if (websocket && websocket.readyState === WebSocket.OPEN && !isStreaming) {
@@ -700,6 +783,7 @@ document.addEventListener('DOMContentLoaded', () => {
     
     // Event listeners
     sendButton.addEventListener('click', sendMessage);
+    stopButton.addEventListener('click', stopGeneration);
     
     messageInput.addEventListener('keydown', (e) => {
         if (e.key === 'Enter' && !e.shiftKey) {
@@ -0,0 +1,92 @@
+# stream_coalescer.py
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Cấu hình gom token trước khi gửi qua websocket
+STREAM_FLUSH_INTERVAL = float(os.getenv("STREAM_FLUSH_INTERVAL_MS", "30")) / 1000  # Cửa sổ thời gian (giây)
+STREAM_FLUSH_BYTES = int(os.getenv("STREAM_FLUSH_BYTES", "256"))  # Ngưỡng kích thước (byte)
+
+class StreamCoalescer:
+    """
+    Gom các delta của một stream thành ít frame hơn.
+
+    Delta được đẩy vào bằng push() (đồng bộ, dùng được làm callback của AIService).
+    Một task ghi duy nhất sẽ flush khi hết cửa sổ thời gian hoặc khi buffer vượt
+    ngưỡng kích thước, nên thứ tự các frame luôn được giữ nguyên. close() flush
+    phần còn lại ngay lập tức và chờ task ghi kết thúc.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[str], Awaitable[None]],
+        flush_interval: float = STREAM_FLUSH_INTERVAL,
+        flush_bytes: int = STREAM_FLUSH_BYTES
+    ):
+        self.send = send
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self._buffer: List[str] = []
+        self._buffer_bytes = 0
+        self._has_data = asyncio.Event()
+        self._flush_now = asyncio.Event()
+        self._closed = False
+        self._task: Optional[asyncio.Task] = None
+        # Thống kê để đo hiệu quả gom frame
+        self.deltas = 0
+        self.frames = 0
+
+    def push(self, delta: str):
+        """
+        Thêm một delta vào buffer
+        """
+        if not delta or self._closed:
+            return
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        self._buffer.append(delta)
+        self._buffer_bytes += len(delta.encode("utf-8"))
+        self.deltas += 1
+        self._has_data.set()
+        if self._buffer_bytes >= self.flush_bytes:
+            self._flush_now.set()
+
+    async def close(self):
+        """
+        Flush phần còn lại và dừng task ghi
+        """
+        self._closed = True
+        if self._task is None:
+            return
+        self._has_data.set()
+        self._flush_now.set()
+        try:
+            await self._task
+        except Exception as e:
+            logger.error(f"Error flushing stream coalescer: {str(e)}")
+
+    async def _flush(self):
+        if not self._buffer:
+            return
+        text = "".join(self._buffer)
+        self._buffer = []
+        self._buffer_bytes = 0
+        self.frames += 1
+        await self.send(text)
+
+    async def _run(self):
+        while True:
+            await self._has_data.wait()
+            if not self._flush_now.is_set() and self.flush_interval > 0:
+                try:
+                    await asyncio.wait_for(self._flush_now.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._has_data.clear()
+            self._flush_now.clear()
+            await self._flush()
+            if self._closed and not self._buffer:
+                return
@@ -0,0 +1,108 @@
+# token_budget.py
+import logging
+import os
+import threading
+from typing import Dict, List, Optional
+
+from ai_service import VLLM_MODEL, VLLM_MAX_TOKENS
+
+logger = logging.getLogger(__name__)
+
+# Kích thước context window của model (phải khớp với --max-model-len của VLLM)
+MODEL_CONTEXT_WINDOW = int(os.getenv("MODEL_CONTEXT_WINDOW", "32768"))
+# Đường dẫn tới file tokenizer.json của Qwen đã tải sẵn; nếu trống sẽ tìm trong cache HuggingFace
+QWEN_TOKENIZER_FILE = os.getenv("QWEN_TOKENIZER_FILE", "")
+# Số token ChatML bao quanh mỗi tin nhắn: <|im_start|>role\n ... <|im_end|>\n
+CHATML_MESSAGE_OVERHEAD = 5
+# Số token của phần "<|im_start|>assistant\n" thêm vào cuối prompt
+CHATML_PROMPT_SUFFIX = 3
+
+_tokenizer = None
+_tokenizer_loaded = False
+_tokenizer_lock = threading.Lock()
+
+def get_tokenizer():
+    """
+    Nạp tokenizer Qwen một lần từ file cục bộ (không tải qua mạng).
+    Trả về None nếu không tìm thấy, khi đó số token được ước lượng theo số byte.
+    """
+    global _tokenizer, _tokenizer_loaded
+    if _tokenizer_loaded:
+        return _tokenizer
+    with _tokenizer_lock:
+        if _tokenizer_loaded:
+            return _tokenizer
+        try:
+            if QWEN_TOKENIZER_FILE:
+                from tokenizers import Tokenizer
+                _tokenizer = Tokenizer.from_file(QWEN_TOKENIZER_FILE)
+            else:
+                from transformers import AutoTokenizer
+                _tokenizer = AutoTokenizer.from_pretrained(VLLM_MODEL, local_files_only=True)
+            logger.info("Qwen tokenizer loaded for token budgeting")
+        except Exception as e:
+            logger.warning(f"Cannot load Qwen tokenizer, falling back to byte-based estimate: {str(e)}")
+            _tokenizer = None
+        _tokenizer_loaded = True
+    return _tokenizer
+
+def count_tokens(text: str) -> int:
+    """
+    Đếm số token của một đoạn văn bản
+    """
+    if not text:
+        return 0
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        # Ước lượng thận trọng: trung bình khoảng 3 byte UTF-8 mỗi token
+        return len(text.encode("utf-8")) // 3 + 1
+    encoding = tokenizer.encode(text, add_special_tokens=False)
+    # tokenizers.Tokenizer trả về Encoding, transformers trả về list id
+    return len(encoding.ids) if hasattr(encoding, "ids") else len(encoding)
+
+def message_tokens(message: Dict) -> int:
+    """
+    Số token của một tin nhắn (kể cả phần bao ChatML), được cache trong chính tin nhắn
+    """
+    tokens = message.get("tokens")
+    if tokens is None:
+        tokens = count_tokens(message["content"]) + CHATML_MESSAGE_OVERHEAD
+        message["tokens"] = tokens
+    return tokens
+
+def history_tokens(messages: List[Dict]) -> int:
+    return sum(message_tokens(msg) for msg in messages) + CHATML_PROMPT_SUFFIX
+
+def prompt_budget(max_tokens: int = VLLM_MAX_TOKENS, reserved_tokens: int = 0) -> int:
+    """
+    Số token còn lại cho prompt: context_window - max_tokens - phần đã dành riêng (ví dụ context PDF)
+    """
+    return MODEL_CONTEXT_WINDOW - max_tokens - reserved_tokens
+
+def trim_history(messages: List[Dict], budget: int, target: Optional[int] = None) -> List[Dict]:
+    """
+    Bỏ các lượt cũ nhất cho đến khi lịch sử nằm trong budget.
+    Nếu có target (< budget), khi phải cắt thì cắt xuống target để lần cắt tiếp theo đến muộn hơn.
+    Luôn giữ system message đầu tiên và tin nhắn mới nhất.
+    """
+    if history_tokens(messages) <= budget:
+        return messages
+
+    limit = budget if target is None else min(target, budget)
+    system_message = messages[0]
+    used = message_tokens(system_message) + CHATML_PROMPT_SUFFIX
+
+    # Lấy từ tin nhắn mới nhất ngược về trước cho đến khi hết budget
+    start = len(messages)
+    for i in range(len(messages) - 1, 0, -1):
+        tokens = message_tokens(messages[i])
+        if used + tokens > limit and start < len(messages):
+            break
+        used += tokens
+        start = i
+
+    kept = messages[start:]
+    # Bắt đầu bằng tin nhắn user để giữ đúng cặp hỏi/đáp
+    while len(kept) > 1 and kept[0]["role"] != "user":
+        kept = kept[1:]
+    return [system_message] + kept
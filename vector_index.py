@@ -0,0 +1,207 @@
+# vector_index.py
+import logging
+import math
+import os
+from typing import Optional
+
+import faiss
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Loại index cho session PDF: "auto" (tìm chính xác, tự chuyển sang ANN khi lớn), "flat", "hnsw", "ivfpq"
+PDF_INDEX_TYPE = os.getenv("PDF_INDEX_TYPE", "auto")
+# Ở chế độ auto: loại index ANN được dùng và số chunk để chuyển sang ANN
+PDF_ANN_TYPE = os.getenv("PDF_ANN_TYPE", "hnsw")
+PDF_ANN_PROMOTE_AT = int(os.getenv("PDF_ANN_PROMOTE_AT", "50000"))
+# Tham số HNSW
+PDF_HNSW_M = int(os.getenv("PDF_HNSW_M", "32"))
+PDF_HNSW_EF_CONSTRUCTION = int(os.getenv("PDF_HNSW_EF_CONSTRUCTION", "80"))
+PDF_HNSW_EF_SEARCH = int(os.getenv("PDF_HNSW_EF_SEARCH", "64"))
+# Tham số IVF-PQ (PDF_IVF_NLIST=0: tự chọn khoảng 4·sqrt(số vector))
+PDF_IVF_NLIST = int(os.getenv("PDF_IVF_NLIST", "0"))
+PDF_IVF_NPROBE = int(os.getenv("PDF_IVF_NPROBE", "16"))
+PDF_PQ_M = int(os.getenv("PDF_PQ_M", "48"))
+PDF_PQ_NBITS = int(os.getenv("PDF_PQ_NBITS", "8"))
+# Xếp hạng lại k·PDF_IVFPQ_REFINE kết quả IVF-PQ bằng vector đầy đủ (0 = tắt): recall cao hơn
+# nhưng phải giữ thêm vector gốc trong RAM
+PDF_IVFPQ_REFINE = int(os.getenv("PDF_IVFPQ_REFINE", "0"))
+# Index không xóa được tại chỗ (HNSW, IVF-PQ có lớp xếp hạng lại) giữ vector đã xóa như tombstone;
+# dựng lại index khi tỉ lệ tombstone vượt ngưỡng này
+PDF_INDEX_COMPACT_RATIO = float(os.getenv("PDF_INDEX_COMPACT_RATIO", "0.2"))
+
+# Số vector tối thiểu để train PQ tốt (39 điểm cho mỗi centroid) và tối đa dùng để train
+IVFPQ_MIN_TRAIN = 39 * 2 ** PDF_PQ_NBITS
+IVFPQ_TRAIN_MAX = 100000
+
+def normalize(vectors) -> np.ndarray:
+    """Chuẩn hóa vector về độ dài 1 để tích vô hướng bằng cosine similarity"""
+    vectors = np.array(vectors, dtype=np.float32, copy=True, order="C")
+    if vectors.ndim == 1:
+        vectors = vectors.reshape(1, -1)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+def _unwrap_ids(index):
+    """Index bên trong lớp ánh xạ id (nếu có)"""
+    if isinstance(index, faiss.IndexIDMap):
+        return faiss.downcast_index(index.index)
+    return index
+
+def _base_index(index):
+    """Index ANN bên trong lớp ánh xạ id và lớp xếp hạng lại (nếu có)"""
+    index = _unwrap_ids(index)
+    if isinstance(index, faiss.IndexRefine):
+        return faiss.downcast_index(index.base_index)
+    return index
+
+def index_type_name(index) -> str:
+    index = _base_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivfpq"
+    return "flat"
+
+def apply_search_params(index):
+    """Đặt tham số tìm kiếm cho index (dùng cả sau khi đọc index từ file)"""
+    base = _base_index(index)
+    if isinstance(base, faiss.IndexHNSW):
+        base.hnsw.efSearch = PDF_HNSW_EF_SEARCH
+    elif isinstance(base, faiss.IndexIVF):
+        base.nprobe = PDF_IVF_NPROBE
+    refine = _unwrap_ids(index)
+    if isinstance(refine, faiss.IndexRefine) and PDF_IVFPQ_REFINE:
+        refine.k_factor = PDF_IVFPQ_REFINE
+    return index
+
+def build_index(dim: int, index_type: str, vectors: Optional[np.ndarray] = None, add: bool = True):
+    """
+    Tạo index inner product theo loại và thêm sẵn vectors (đã chuẩn hóa) nếu có.
+    IVF-PQ cần train nên phải có vectors; add=False chỉ dùng vectors để train.
+    """
+    if index_type == "hnsw":
+        index = faiss.index_factory(dim, f"HNSW{PDF_HNSW_M},Flat", faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = PDF_HNSW_EF_CONSTRUCTION
+    elif index_type == "ivfpq":
+        if vectors is None or len(vectors) < 2 ** PDF_PQ_NBITS:
+            raise ValueError("IVF-PQ index needs at least 2^nbits vectors to train")
+        nlist = PDF_IVF_NLIST or int(4 * math.sqrt(len(vectors)))
+        # Mỗi cụm cần khoảng 39 điểm train
+        nlist = max(1, min(nlist, len(vectors) // 39))
+        description = f"IVF{nlist},PQ{PDF_PQ_M}x{PDF_PQ_NBITS}"
+        if PDF_IVFPQ_REFINE:
+            description += ",RFlat"
+        index = faiss.index_factory(dim, description, faiss.METRIC_INNER_PRODUCT)
+        if len(vectors) > IVFPQ_TRAIN_MAX:
+            sample = np.random.default_rng(0).choice(len(vectors), IVFPQ_TRAIN_MAX, replace=False)
+            index.train(vectors[np.sort(sample)])
+        else:
+            index.train(vectors)
+    else:
+        index = faiss.IndexFlatIP(dim)
+    apply_search_params(index)
+    if add and vectors is not None and len(vectors) > 0:
+        index.add(vectors)
+    return index
+
+def build_id_index(dim: int, index_type: str, vectors: Optional[np.ndarray] = None, ids: Optional[np.ndarray] = None):
+    """
+    Index có id riêng cho từng vector (IndexIDMap2) để xóa được theo id mà không phải đánh lại số
+    các vector còn lại. IVF-PQ không đủ dữ liệu để train thì dùng tìm chính xác.
+    """
+    if index_type == "ivfpq" and (vectors is None or len(vectors) < 2 ** PDF_PQ_NBITS):
+        index_type = "flat"
+    index = faiss.IndexIDMap2(build_index(dim, index_type, vectors, add=False))
+    if vectors is not None and len(vectors) > 0:
+        index.add_with_ids(vectors, np.asarray(ids, dtype=np.int64))
+    return index
+
+def stored_ids(index) -> np.ndarray:
+    """Id của các vector theo thứ tự lưu trong index"""
+    return faiss.vector_to_array(index.id_map)
+
+def _exact_vectors(index) -> np.ndarray:
+    """Các vector đầy đủ lưu trong index (không có lớp ánh xạ id)"""
+    if index.ntotal == 0:
+        return np.empty((0, index.d), dtype=np.float32)
+    if isinstance(index, faiss.IndexRefine):
+        index = faiss.downcast_index(index.refine_index)
+    elif isinstance(index, faiss.IndexIVF):
+        # PQ chỉ giữ vector nén nên vector khôi phục là xấp xỉ
+        index.make_direct_map()
+    return index.reconstruct_n(0, index.ntotal)
+
+def upgrade_index(index):
+    """
+    Index đọc từ file: đặt tham số tìm kiếm. Index cũ không có id được bọc lại với id là vị trí
+    của vector, index L2 cũ (vector chưa chuẩn hóa) chuyển sang inner product trên vector đã chuẩn hóa
+    """
+    if isinstance(index, faiss.IndexIDMap):
+        return apply_search_params(index)
+    vectors = _exact_vectors(index)
+    index_type = index_type_name(index)
+    if index.metric_type == faiss.METRIC_L2:
+        vectors = normalize(vectors)
+        index_type = "flat"
+    return build_id_index(index.d, index_type, vectors, np.arange(len(vectors)))
+
+def create_index(dim: int):
+    """Index cho session mới. IVF-PQ cần dữ liệu để train nên bắt đầu bằng tìm chính xác"""
+    if PDF_INDEX_TYPE == "hnsw":
+        return build_id_index(dim, "hnsw")
+    return build_id_index(dim, "flat")
+
+def remove_vectors(index, ids) -> bool:
+    """
+    Xóa các vector theo id tại chỗ (chỉ Flat). HNSW không hỗ trợ xóa, còn IVF-PQ trong IndexIDMap2 xóa
+    được nhưng làm lệch bảng id với vector còn lại: trả về False, các vector vẫn nằm trong index như
+    tombstone (người gọi bỏ qua id không còn trong bảng chunk khi tìm kiếm) cho tới khi index được
+    dựng lại bằng compaction_target/promote.
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    if len(ids) == 0:
+        return True
+    if index_type_name(index) == "ivfpq":
+        return False
+    try:
+        index.remove_ids(ids)
+        return True
+    except RuntimeError:
+        return False
+
+def compaction_target(index, live_vectors: int) -> Optional[str]:
+    """Loại index cần dựng lại khi tỉ lệ tombstone vượt PDF_INDEX_COMPACT_RATIO (None nếu chưa cần)"""
+    dead = index.ntotal - live_vectors
+    if dead <= 0 or dead < PDF_INDEX_COMPACT_RATIO * index.ntotal:
+        return None
+    return index_type_name(index)
+
+def promotion_target(index) -> Optional[str]:
+    """Loại index ANN cần chuyển sang khi session đủ lớn (None nếu giữ nguyên)"""
+    if index_type_name(index) != "flat":
+        return None
+    if PDF_INDEX_TYPE == "auto":
+        target = PDF_ANN_TYPE
+        threshold = PDF_ANN_PROMOTE_AT
+    elif PDF_INDEX_TYPE == "ivfpq":
+        target = "ivfpq"
+        threshold = 0
+    else:
+        return None
+    if target == "ivfpq":
+        threshold = max(threshold, IVFPQ_MIN_TRAIN)
+    return target if index.ntotal >= threshold else None
+
+def export_vectors(index):
+    """Bản sao các vector đầy đủ và id của chúng, để dựng index mới mà không giữ index cũ"""
+    return _exact_vectors(_unwrap_ids(index)), stored_ids(index)
+
+def promote(vectors: np.ndarray, ids: np.ndarray, index_type: str):
+    """
+    Dựng index mới từ các vector (và id) lấy ra bằng export_vectors: chuyển sang ANN hoặc
+    dựng lại để bỏ tombstone
+    """
+    promoted = build_id_index(vectors.shape[1], index_type, vectors, ids)
+    logger.info(f"Built {index_type} vector index ({len(ids)} vectors)")
+    return promoted
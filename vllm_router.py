@@ -0,0 +1,197 @@
+# vllm_router.py
+import asyncio
+import hashlib
+import logging
+import os
+import random
+import time
+from typing import Dict, Iterable, List, Optional, Set
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# Danh sách các replica VLLM, phân tách bằng dấu phẩy
+VLLM_BACKENDS = [
+    url.strip().rstrip("/")
+    for url in os.getenv("VLLM_BACKENDS", "http://localhost:8000").split(",")
+    if url.strip()
+]
+VLLM_COMPLETIONS_PATH = "/v1/completions"
+VLLM_HEALTH_PATH = "/health"
+
+# Chiến lược cân bằng tải: "least_outstanding" hoặc "p2c" (power of two choices)
+VLLM_LB_POLICY = os.getenv("VLLM_LB_POLICY", "least_outstanding")
+# Định tuyến cố định theo hội thoại (để tận dụng prefix cache của VLLM)
+VLLM_AFFINITY = os.getenv("VLLM_AFFINITY", "1") == "1"
+# Bỏ qua replica ưu tiên nếu nó có nhiều hơn replica rảnh nhất quá số request này
+VLLM_AFFINITY_MAX_IMBALANCE = int(os.getenv("VLLM_AFFINITY_MAX_IMBALANCE", "8"))
+# Số lần thử tối đa cho một request (mỗi lần trên một replica khác)
+VLLM_MAX_ATTEMPTS = int(os.getenv("VLLM_MAX_ATTEMPTS", "3"))
+# Health check định kỳ
+VLLM_HEALTH_INTERVAL = float(os.getenv("VLLM_HEALTH_INTERVAL", "5"))
+VLLM_HEALTH_TIMEOUT = float(os.getenv("VLLM_HEALTH_TIMEOUT", "2"))
+# Circuit breaker: số lỗi liên tiếp trước khi loại replica và thời gian loại
+VLLM_CB_FAILURE_THRESHOLD = int(os.getenv("VLLM_CB_FAILURE_THRESHOLD", "3"))
+VLLM_CB_COOLDOWN = float(os.getenv("VLLM_CB_COOLDOWN", "30"))
+
+class Backend:
+    """
+    Trạng thái của một replica VLLM
+    """
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url.rstrip("/")
+        self.completions_url = self.base_url + VLLM_COMPLETIONS_PATH
+        self.health_url = self.base_url + VLLM_HEALTH_PATH
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.total_requests = 0
+        self.total_failures = 0
+
+    def is_available(self, now: Optional[float] = None) -> bool:
+        return (now or time.time()) >= self.ejected_until
+
+    def snapshot(self) -> Dict:
+        return {
+            "url": self.base_url,
+            "available": self.is_available(),
+            "outstanding": self.outstanding,
+            "consecutive_failures": self.consecutive_failures,
+            "total_requests": self.total_requests,
+            "total_failures": self.total_failures
+        }
+
+class BackendPool:
+    """
+    Tập các replica VLLM với định tuyến least-outstanding-requests,
+    health check chủ động và circuit breaker
+    """
+
+    def __init__(
+        self,
+        urls: Iterable[str],
+        policy: str = VLLM_LB_POLICY,
+        failure_threshold: int = VLLM_CB_FAILURE_THRESHOLD,
+        cooldown: float = VLLM_CB_COOLDOWN
+    ):
+        self.backends: List[Backend] = [Backend(url) for url in urls]
+        if not self.backends:
+            raise ValueError("BackendPool cần ít nhất một backend")
+        self.policy = policy
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._health_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _affinity_score(key: str, backend: Backend) -> int:
+        # Rendezvous hashing: mỗi key luôn ưu tiên cùng một replica, và khi một replica
+        # bị loại thì chỉ các key của replica đó bị chuyển đi
+        digest = hashlib.md5(f"{key}|{backend.base_url}".encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big")
+
+    def acquire(
+        self,
+        exclude: Optional[Set[Backend]] = None,
+        affinity_key: Optional[str] = None
+    ) -> Optional[Backend]:
+        """
+        Chọn một replica cho request mới và tăng số request đang xử lý của nó.
+        Nếu có affinity_key, cùng một key luôn được định tuyến tới cùng một replica
+        (trừ khi replica đó bị ngắt mạch hoặc quá tải so với các replica khác).
+        Trả về None nếu mọi replica đều đã bị loại trừ.
+        """
+        exclude = exclude or set()
+        now = time.time()
+        candidates = [b for b in self.backends if b not in exclude and b.is_available(now)]
+        if not candidates:
+            # Mọi replica đều bị ngắt mạch: vẫn thử replica chưa dùng thay vì từ chối ngay
+            candidates = [b for b in self.backends if b not in exclude]
+            if not candidates:
+                return None
+            logger.warning("All VLLM backends are ejected, routing in degraded mode")
+
+        backend = None
+        if affinity_key is not None and VLLM_AFFINITY:
+            preferred = max(candidates, key=lambda b: self._affinity_score(affinity_key, b))
+            least_loaded = min(b.outstanding for b in candidates)
+            if preferred.outstanding - least_loaded <= VLLM_AFFINITY_MAX_IMBALANCE:
+                backend = preferred
+
+        if backend is None:
+            if self.policy == "p2c" and len(candidates) > 2:
+                candidates = random.sample(candidates, 2)
+            backend = min(candidates, key=lambda b: (b.outstanding, random.random()))
+
+        backend.outstanding += 1
+        backend.total_requests += 1
+        return backend
+
+    def release(self, backend: Backend):
+        backend.outstanding = max(0, backend.outstanding - 1)
+
+    def record_success(self, backend: Backend):
+        if backend.consecutive_failures or not backend.is_available():
+            logger.info(f"VLLM backend {backend.base_url} recovered")
+        backend.consecutive_failures = 0
+        backend.ejected_until = 0.0
+
+    def record_failure(self, backend: Backend):
+        backend.consecutive_failures += 1
+        backend.total_failures += 1
+        if backend.consecutive_failures >= self.failure_threshold:
+            backend.ejected_until = time.time() + self.cooldown
+            logger.warning(
+                f"VLLM backend {backend.base_url} ejected for {self.cooldown}s "
+                f"after {backend.consecutive_failures} consecutive failures"
+            )
+
+    async def check_health(self, session: aiohttp.ClientSession, backend: Backend):
+        try:
+            async with session.get(
+                backend.health_url,
+                timeout=aiohttp.ClientTimeout(total=VLLM_HEALTH_TIMEOUT)
+            ) as response:
+                if response.status == 200:
+                    # Chỉ nhận lại replica đã hết thời gian ngắt mạch và không xóa số lần lỗi trước đó:
+                    # replica trả lời /health nhưng lỗi khi sinh vẫn bị loại đủ VLLM_CB_COOLDOWN
+                    if backend.ejected_until and backend.is_available():
+                        self.record_success(backend)
+                else:
+                    logger.warning(f"Health check failed for {backend.base_url}: HTTP {response.status}")
+                    self.record_failure(backend)
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            logger.warning(f"Health check failed for {backend.base_url}: {str(e)}")
+            self.record_failure(backend)
+
+    def start_health_checks(self, session: aiohttp.ClientSession, interval: float = VLLM_HEALTH_INTERVAL):
+        """
+        Chạy health check định kỳ cho mọi replica trong một task nền
+        """
+        if self._health_task is not None or interval <= 0:
+            return
+
+        async def health_loop():
+            while True:
+                try:
+                    await asyncio.gather(*(self.check_health(session, b) for b in self.backends))
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"Error in VLLM health check loop: {str(e)}")
+                await asyncio.sleep(interval)
+
+        self._health_task = asyncio.create_task(health_loop())
+
+    async def stop_health_checks(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except asyncio.CancelledError:
+                pass
+            self._health_task = None
+
+    def snapshot(self) -> List[Dict]:
+        return [b.snapshot() for b in self.backends]
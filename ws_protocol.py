@@ -0,0 +1,44 @@
+# ws_protocol.py
+import json
+import os
+from typing import Dict, Optional, Union
+
+# Giao thức nhị phân gọn được thỏa thuận qua Sec-WebSocket-Protocol; client cũ không gửi
+# subprotocol nên vẫn nhận JSON như trước
+WS_BINARY_SUBPROTOCOL = "chatbot.bin.v1"
+WS_BINARY_ENABLED = os.getenv("WS_BINARY_ENABLED", "1") == "1"
+
+# Frame nhị phân: 1 byte loại tin nhắn + nội dung UTF-8.
+# Loại 0 chứa nguyên tin nhắn dạng JSON (dùng cho các tin nhắn điều khiển ít gặp)
+BINARY_JSON = 0
+BINARY_MESSAGE_TYPES = {
+    "stream_start": 1,
+    "stream_chunk": 2,
+    "stream_end": 3,
+    "stream_resync": 4
+}
+
+def negotiate_protocol(websocket) -> Optional[str]:
+    """
+    Chọn subprotocol cho kết nối: trả về WS_BINARY_SUBPROTOCOL nếu client đề nghị, None nếu dùng JSON
+    """
+    if not WS_BINARY_ENABLED:
+        return None
+    if WS_BINARY_SUBPROTOCOL in websocket.scope.get("subprotocols", []):
+        return WS_BINARY_SUBPROTOCOL
+    return None
+
+def encode_json(message: Dict) -> str:
+    # Không escape ký tự tiếng Việt và bỏ khoảng trắng thừa để giảm số byte
+    return json.dumps(message, ensure_ascii=False, separators=(",", ":"))
+
+def encode_message(message: Dict, binary: bool = False) -> Union[str, bytes]:
+    """
+    Mã hóa tin nhắn gửi tới client: chuỗi JSON (text frame) hoặc bytes (binary frame)
+    """
+    if not binary:
+        return encode_json(message)
+    code = BINARY_MESSAGE_TYPES.get(message.get("type"))
+    if code is not None and message.keys() <= {"type", "content"}:
+        return bytes((code,)) + message.get("content", "").encode("utf-8")
+    return bytes((BINARY_JSON,)) + encode_json(message).encode("utf-8")